@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the message dispatch hot path, run against a fake SlackClient
+and synthetic RTM event streams.
+
+    python benchmarks/bench_dispatch.py                   # run and report
+    python benchmarks/bench_dispatch.py --save base.json  # store a baseline
+    python benchmarks/bench_dispatch.py --compare base.json
+
+With --compare, the exit status is 1 if any case got slower than the
+baseline by more than --threshold (10% by default).
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import string
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from slackbot.dispatcher import Message, MessageDispatcher  # noqa: E402
+from slackbot.manager import CommandRegistry, PluginsManager  # noqa: E402
+from slackbot.slackclient import SlackClient  # noqa: E402
+
+BOT_ID = 'UBOT00001'
+BOT_NAME = 'benchbot'
+USERS = dict(('U{:08d}'.format(i), {'id': 'U{:08d}'.format(i),
+                                    'name': 'user{}'.format(i)})
+             for i in range(100))
+USERS[BOT_ID] = {'id': BOT_ID, 'name': BOT_NAME}
+
+CHANNEL_MIXES = {
+    'channels': {'C': 1.0},
+    'mixed': {'C': 0.6, 'G': 0.2, 'D': 0.2},
+    'direct': {'D': 1.0},
+}
+
+
+class FakeWebsocket(object):
+    def __init__(self):
+        self.frames = []
+        self.sock = None
+
+    def recv_data(self):
+        if not self.frames:
+            # what a drained non-blocking ssl socket raises
+            raise ssl.SSLWantReadError(2, 'The operation did not complete')
+        return 1, self.frames.pop()
+
+    def send(self, data):
+        pass
+
+
+class FakeSlackClient(SlackClient):
+    def __init__(self):
+        super(FakeSlackClient, self).__init__(None, connect=False)
+        self.login_data = {'self': {'id': BOT_ID, 'name': BOT_NAME},
+                           'team': {'domain': 'bench'}}
+        self.users = dict(USERS)
+        self.channels = {}
+        self.websocket = FakeWebsocket()
+
+    def rtm_send_message(self, channel, message, attachments=None,
+                         thread_ts=None):
+        pass
+
+
+def words(rng, size):
+    text = []
+    while sum(len(w) + 1 for w in text) < size:
+        text.append(''.join(rng.choice(string.ascii_lowercase)
+                            for __ in range(rng.randint(2, 9))))
+    return ' '.join(text)[:size]
+
+
+def make_events(rng, count, text_size, mix, mention_ratio=0.3, commands=()):
+    kinds, weights = zip(*CHANNEL_MIXES[mix].items())
+    user_ids = sorted(u for u in USERS if u != BOT_ID)
+    events = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        text = words(rng, text_size)
+        if commands and rng.random() < 0.5:
+            text = rng.choice(commands) + ' ' + text
+        if kind != 'D' and rng.random() < mention_ratio:
+            text = '<@{}> {}'.format(BOT_ID, text)
+        events.append({
+            'type': 'message',
+            'channel': '{}{:08d}'.format(kind, rng.randint(0, 50)),
+            'user': rng.choice(user_ids),
+            'text': text,
+            'ts': '{}.{:06d}'.format(1600000000 + i, i),
+        })
+    return events
+
+
+def make_plugins(rng, count, handler=None):
+    """A PluginsManager with ``count`` listen_to and respond_to patterns."""
+    manager = PluginsManager()
+    manager.commands = {
+        'respond_to': CommandRegistry(),
+        'listen_to': CommandRegistry(),
+        'default_reply': CommandRegistry(),
+    }
+    handler = handler or (lambda message, *args: None)
+    commands = []
+    for i in range(count):
+        word = '{}{}'.format(words(rng, 6).replace(' ', ''), i)
+        commands.append(word)
+        flags = re.IGNORECASE if i % 3 == 0 else 0
+        pattern = [r'{}$', r'^{} (.*)', r'{} (\w+) (\w+)', r'(?:{}|x{}y)'][i % 4]
+        category = 'respond_to' if i % 2 else 'listen_to'
+        manager.commands[category][re.compile(
+            pattern.format(word, word), flags)] = handler
+    manager.commands['default_reply'][re.compile(r'^.*$')] = handler
+    return manager, commands
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def measure(func, items, repeat):
+    """Call ``func`` on every item, ``repeat`` times over. Returns the best
+    ops/sec of the rounds, which is the least noisy, and all the latencies."""
+    best, latencies = 0, []
+    for __ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            t = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - t)
+        best = max(best, len(items) / (time.perf_counter() - started))
+    return best, latencies
+
+
+def result(name, ops, latencies):
+    return {
+        'name': name,
+        'ops_per_sec': ops,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def bench_filter_text(rng, opts):
+    client = FakeSlackClient()
+    dispatcher = MessageDispatcher(client, None, None)
+    for mix in CHANNEL_MIXES:
+        for size in (20, 200) if opts.quick else (20, 200, 2000):
+            events = make_events(rng, 2000, size, mix)
+            ops, lat = measure(lambda e: dispatcher.filter_text(dict(e)),
+                               events, opts.repeat)
+            yield result('filter_text[mix={},size={}]'.format(mix, size),
+                         ops, lat)
+
+
+def bench_get_plugins(rng, opts):
+    for count in (10, 100) if opts.quick else (10, 100, 500):
+        manager, commands = make_plugins(rng, count)
+        for size in (20, 200) if opts.quick else (20, 200, 2000):
+            texts = [e['text'] for e in make_events(rng, 1000, size, 'channels',
+                                                    commands=commands)]
+            ops, lat = measure(
+                lambda t: list(manager.get_plugins('listen_to', t)), texts, opts.repeat)
+            yield result('get_plugins[plugins={},size={}]'.format(count, size),
+                         ops, lat)
+
+
+def bench_rtm_read(rng, opts):
+    client = FakeSlackClient()
+    for burst in (1, 100) if opts.quick else (1, 10, 100, 1000):
+        frames = [json.dumps(e).encode('utf-8')
+                  for e in make_events(rng, burst, 200, 'mixed')]
+
+        def read(__):
+            client.websocket.frames = list(frames)
+            for __ in client.rtm_read(len(frames)):
+                pass
+        ops, lat = measure(read, range(max(20, 2000 // burst)), opts.repeat)
+        yield result('rtm_read[burst={}]'.format(burst), ops * burst, lat)
+
+
+def bench_message(rng, opts):
+    client = FakeSlackClient()
+    events = make_events(rng, 2000, 200, 'mixed')
+    ops, lat = measure(lambda e: Message(client, e).gen_reply('ok'), events,
+                       opts.repeat)
+    yield result('message[gen_reply]', ops, lat)
+
+
+def bench_dispatch(rng, opts):
+    """Events through _on_new_message to the plugin, on the worker pool."""
+    count = 2000 if opts.quick else 10000
+    for nworker in (1, 4) if opts.quick else (1, 4, 16):
+        for mix in ('channels', 'mixed'):
+            done = {}
+            finished = threading.Event()
+
+            def handler(message, *args):
+                done[message.body['ts']] = time.perf_counter()
+                if len(done) == count:
+                    finished.set()
+
+            manager, commands = make_plugins(rng, 100, handler)
+            # so every message ends up in the handler
+            manager.commands['listen_to'][re.compile(r'^')] = handler
+            client = FakeSlackClient()
+            dispatcher = MessageDispatcher(client, manager, None)
+            dispatcher._pool.nworker = dispatcher._pool.max_worker = nworker
+            dispatcher._pool.start()
+            events = make_events(rng, count, 200, mix, commands=commands)
+            sent = {}
+            started = time.perf_counter()
+            for event in events:
+                sent[event['ts']] = time.perf_counter()
+                dispatcher._on_new_message(dict(event))
+            if not finished.wait(60):
+                raise RuntimeError('dispatch benchmark timed out')
+            elapsed = time.perf_counter() - started
+            lat = [done[ts] - sent[ts] for ts in done]
+            yield result('dispatch[workers={},mix={}]'.format(nworker, mix),
+                         count / elapsed, lat)
+
+
+BENCHMARKS = {
+    'filter_text': bench_filter_text,
+    'get_plugins': bench_get_plugins,
+    'rtm_read': bench_rtm_read,
+    'message': bench_message,
+    'dispatch': bench_dispatch,
+}
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every case from ``baseline`` and return the names
+    of the cases that regressed: lower throughput and higher p50 latency,
+    both by more than ``threshold``."""
+    baseline = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        base = baseline.get(r['name'])
+        if base is None:
+            continue
+        change = r['ops_per_sec'] / base['ops_per_sec'] - 1
+        flag = ''
+        # a slower median as well rules out most of the scheduling noise
+        if (change < -threshold and
+                r['p50_us'] > base['p50_us'] * (1 + threshold)):
+            flag = '  REGRESSION'
+            regressions.append(r['name'])
+        print('{:<40} {:>+8.1%} ops/sec  p99 {:>10.1f}us -> {:>10.1f}us{}'.format(
+            r['name'], change, base['p99_us'], r['p99_us'], flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='one of {} (default: all)'.format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--quick', action='store_true',
+                        help='run a smaller sweep')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='rounds per micro benchmark case')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative slowdown flagged as a regression')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    logging.basicConfig(level=logging.ERROR)
+
+    results = []
+    print('{:<40} {:>14} {:>12} {:>12}'.format('benchmark', 'ops/sec',
+                                               'p50 (us)', 'p99 (us)'))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        rng = random.Random(args.seed)
+        for r in BENCHMARKS[name](rng, args):
+            print('{name:<40} {ops_per_sec:>14,.0f} {p50_us:>12.1f} '
+                  '{p99_us:>12.1f}'.format(**r))
+            results.append(r)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version, 'quick': args.quick,
+                       'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test: runs the whole bot (Bot.run()) against the fake Slack
+of tests/fakeslack.py, posts messages at a steady rate and measures how long
+the replies take to come back.
+
+    python benchmarks/bench_e2e.py --rate 200 --duration 10
+    python benchmarks/bench_e2e.py --event-loop asyncio --webapi \\
+        --latency 0.05 --rate-limits
+
+Every message is ``<@bot> ping <n>`` in a random channel, from a random user;
+the ``ping`` plugin below replies ``<n>``, over RTM or with --webapi over
+chat.postMessage.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from slackbot import settings  # noqa: E402
+from slackbot.bot import Bot, respond_to  # noqa: E402
+from tests import fakeslack  # noqa: E402
+
+REPLY_WITH_WEBAPI = False
+
+
+@respond_to(r'^ping (\d+)$')
+def ping(message, seq):
+    if REPLY_WITH_WEBAPI:
+        message.reply_webapi(seq)
+    else:
+        message.reply(seq)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class LoadGenerator(object):
+    def __init__(self, slack, rate, duration):
+        self.slack = slack
+        self.rate = rate
+        self.duration = duration
+        self.sent = {}
+        self.replied = {}
+        self._users = [u['id'] for u in slack.users[1:]]
+        self._channels = [c['id'] for c in slack.channels
+                          if not c.get('is_im')]
+
+    def send(self):
+        """Post ``rate`` messages a second for ``duration`` seconds."""
+        rng = random.Random(0)
+        started = time.perf_counter()
+        for seq in range(int(self.rate * self.duration)):
+            delay = started + seq / float(self.rate) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.sent[str(seq)] = time.perf_counter()
+            self.slack.post_message(
+                rng.choice(self._channels), rng.choice(self._users),
+                '<@{}> ping {}'.format(fakeslack.BOT_ID, seq))
+
+    def collect(self, stop):
+        while not stop.is_set() or not self.slack.bot_messages.empty():
+            try:
+                message = self.slack.bot_messages.get(timeout=0.1)
+            except Exception:
+                continue
+            m = re.search(r'(\d+)$', message.get('text') or '')
+            if m:
+                self.replied.setdefault(m.group(1), message['time'])
+
+    def run(self, drain):
+        stop = threading.Event()
+        collector = threading.Thread(target=self.collect, args=(stop,),
+                                     daemon=True)
+        collector.start()
+        started = time.perf_counter()
+        self.send()
+        deadline = time.perf_counter() + drain
+        while (len(self.replied) < len(self.sent) and
+               time.perf_counter() < deadline):
+            time.sleep(0.05)
+        stop.set()
+        collector.join()
+        latencies = [self.replied[seq] - self.sent[seq]
+                     for seq in self.replied if seq in self.sent]
+        elapsed = max(self.replied.values() or [started]) - started
+        return {
+            'sent': len(self.sent),
+            'replied': len(latencies),
+            'lost': len(self.sent) - len(latencies),
+            'replies_per_sec': len(latencies) / elapsed if elapsed else 0,
+            'p50_ms': percentile(latencies, 0.50) * 1e3 if latencies else None,
+            'p90_ms': percentile(latencies, 0.90) * 1e3 if latencies else None,
+            'p99_ms': percentile(latencies, 0.99) * 1e3 if latencies else None,
+            'max_ms': max(latencies) * 1e3 if latencies else None,
+        }
+
+
+def main(argv=None):
+    global REPLY_WITH_WEBAPI
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rate', type=float, default=100,
+                        help='messages per second')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to send messages for')
+    parser.add_argument('--drain', type=float, default=30,
+                        help='seconds to wait for the last replies')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Web API latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Web API latency jitter, in seconds')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="enforce Slack's Web API rate limits")
+    parser.add_argument('--webapi', action='store_true',
+                        help='reply with chat.postMessage rather than RTM')
+    parser.add_argument('--event-loop', default='select',
+                        choices=('poll', 'select', 'asyncio'))
+    parser.add_argument('--worker-pool', default='shared',
+                        choices=('shared', 'sharded'))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='WORKER_MAX (default: the setting)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as JSON')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    REPLY_WITH_WEBAPI = args.webapi
+
+    slack = fakeslack.FakeSlack(
+        users=args.users, channels=args.channels, latency=args.latency,
+        jitter=args.jitter,
+        rate_limits=fakeslack.SLACK_RATE_LIMITS if args.rate_limits else None)
+    slack.start()
+
+    settings.API_TOKEN = fakeslack.TOKEN
+    settings.SLACK_API_URL = slack.api_url
+    settings.PLUGINS = []
+    settings.EVENT_LOOP = args.event_loop
+    settings.WORKER_POOL = args.worker_pool
+    if args.workers:
+        settings.WORKER_MAX = args.workers
+    bot = Bot()
+    threading.Thread(target=bot.run, name='bot', daemon=True).start()
+    slack.wait_connected()
+
+    results = LoadGenerator(slack, args.rate, args.duration).run(args.drain)
+    results['config'] = dict(vars(args))
+    results['rate_limited'] = dict(slack.rate_limited)
+    for key in ('sent', 'replied', 'lost', 'replies_per_sec', 'p50_ms',
+                'p90_ms', 'p99_ms', 'max_ms', 'rate_limited'):
+        value = results[key]
+        print('{:<16} {}'.format(
+            key, '{:,.1f}'.format(value) if isinstance(value, float) else value))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
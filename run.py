@@ -4,7 +4,7 @@ import sys
 import logging
 import logging.config
 from slackbot import settings
-from slackbot.bot import Bot
+from slackbot.bot import Bot, MultiBot
 
 
 def main():
@@ -16,7 +16,10 @@ def main():
     }
     logging.basicConfig(**kw)
     logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
-    bot = Bot()
+    if getattr(settings, 'WORKSPACES', None):
+        bot = MultiBot(settings.WORKSPACES)
+    else:
+        bot = Bot()
     bot.run()
 
 if __name__ == '__main__':
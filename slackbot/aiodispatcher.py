@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import asyncio
+import functools
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slackbot.dispatcher import (
+    MessageDispatcher, Message, AsyncMessage, PLUGIN_TIME, PLUGIN_ERRORS
+)
+from slackbot.limits import PluginBusy, plugin_name
+from slackbot.slackclient import SlackConnectionError
+from slackbot import procpool
+from slackbot import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTaskPool(object):
+    """
+    Drop-in replacement of :class:`~slackbot.utils.WorkerPool` running every
+    task as an asyncio task on the dispatcher's event loop.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.loop = None
+        self._tasks = set()
+
+    def start(self):
+        pass
+
+    def add_task(self, msg):
+        if self.loop is None:
+            raise RuntimeError('the event loop is not running')
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._spawn(msg)
+        else:
+            self.loop.call_soon_threadsafe(self._spawn, msg)
+
+    def _spawn(self, msg):
+        task = self.loop.create_task(self.func(msg))
+        # keep a reference, the loop only holds weak ones
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @property
+    def size(self):
+        return 0
+
+    def qsize(self):
+        return len(self._tasks)
+
+    def queue_depths(self):
+        return {'tasks': len(self._tasks)}
+
+    def shed_counts(self):
+        return {}
+
+
+class AsyncMessageDispatcher(MessageDispatcher):
+    """
+    Dispatcher running on an asyncio event loop. Incoming RTM frames are read
+    when the websocket becomes readable, ``async def`` plugins run as tasks on
+    the loop, and regular plugins run on a bounded thread pool executor.
+    """
+
+    def __init__(self, slackclient, plugins, errors_to, nworker=None):
+        super(AsyncMessageDispatcher, self).__init__(slackclient, plugins,
+                                                     errors_to)
+        self._pool = AsyncTaskPool(self.async_dispatch_msg)
+        self._nworker = nworker or int(getattr(settings, 'WORKER_MAX', None) or 20)
+        self._executor = None
+        self._loop = None
+        self._sock = None
+        self._reconnecting = None
+
+    def loop(self):
+        asyncio.run(self.run())
+
+    def transport_loop(self, transport):
+        asyncio.run(self.run(transport=transport))
+
+    async def run(self, keepalive=30 * 60, transport=None):
+        self._loop = asyncio.get_running_loop()
+        self._pool.loop = self._loop
+        self._executor = ThreadPoolExecutor(max_workers=self._nworker)
+        if transport is None:
+            self._watch_websocket()
+        else:
+            transport.start(lambda event: self._loop.call_soon_threadsafe(
+                self._handle_event, event))
+        self._start_scheduler()
+        try:
+            await self._keepalive_loop(keepalive)
+        finally:
+            if self._sock is not None:
+                self._loop.remove_reader(self._sock)
+            if transport is not None:
+                transport.stop()
+            self._executor.shutdown(wait=False)
+
+    def _watch_websocket(self):
+        # the websocket is replaced whenever the client reconnects
+        sock = self._client.websocket.sock
+        if sock is self._sock:
+            return
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock)
+        self._sock = sock
+        self._loop.add_reader(sock, self._on_readable)
+
+    def start(self):
+        # the scheduler starts with the event loop, see run()
+        self._pool.start()
+
+    def _on_readable(self):
+        try:
+            for event in self._client.rtm_read(reconnect=False):
+                self._handle_event(event)
+        except SlackConnectionError:
+            # reconnecting sleeps through the backoff and the circuit
+            # breaker, off the loop; the socket is watched again once done
+            self._loop.remove_reader(self._sock)
+            self._sock = None
+            self._reconnecting = self._loop.create_task(self._reconnect())
+            return
+        self._watch_websocket()
+        # the read is capped, and the frames decrypted already in the ssl
+        # layer don't make the socket readable again
+        pending = getattr(self._sock, 'pending', None)
+        if pending is not None and pending():
+            self._loop.call_soon(self._on_readable)
+
+    async def _reconnect(self):
+        await self._in_executor(self._client.reconnect)
+        self._watch_websocket()
+
+    async def _keepalive_loop(self, keepalive):
+        while True:
+            await asyncio.sleep(keepalive)
+            self._client.ping()
+
+    async def _in_executor(self, func, *args):
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(func, *args))
+
+    async def async_dispatch_msg(self, msg):
+        category = msg[0]
+
+        if category == 'call_func':
+            func = msg[1]
+            on_done = functools.partial(self._scheduler.job_done, func)
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await self._limits.async_run(
+                        func, lambda: func(self._client), on_done=on_done)
+                else:
+                    await self._limits.async_run(
+                        func, lambda: self._in_executor(func, self._client),
+                        cancel=False, on_done=on_done)
+            except PluginBusy as exp:
+                logger.warning('skipped run at times handler: %s', exp)
+            except Exception as exp:
+                logger.exception(
+                    'Run at times handler failed when trying to run {0} with exception {1}'.format(
+                        func.__name__, exp
+                    )
+                )
+        else:
+            msg = msg[1]
+            if not await self._async_dispatch_msg_handler(category, msg):
+                if category == 'respond_to':
+                    if not await self._async_dispatch_msg_handler('default_reply', msg):
+                        # sending may wait for the rate limit
+                        await self._in_executor(self._default_reply, msg)
+
+    async def _async_dispatch_msg_handler(self, category, msg):
+        responded = False
+        for func, args in self._match_plugins(category, msg):
+            if func:
+                responded = True
+                started = time.perf_counter()
+                try:
+                    await self._limits.async_run(
+                        func, lambda: self._async_call_plugin(func, msg, args),
+                        cancel=self._cancellable(func))
+                except PluginBusy as e:
+                    logger.warning('dropped message %s: %s', msg['text'], e)
+                except Exception:
+                    PLUGIN_ERRORS.inc(plugin_name(func))
+                    await self._in_executor(self._report_plugin_error, func,
+                                            msg, sys.exc_info())
+                finally:
+                    PLUGIN_TIME.observe(time.perf_counter() - started,
+                                        plugin_name(func))
+        return responded
+
+    @staticmethod
+    def _cancellable(func):
+        """Whether a timed out call of ``func`` can be stopped, rather than
+        left running in its thread or process."""
+        return (asyncio.iscoroutinefunction(func) and
+                getattr(func, 'executor', None) != 'process')
+
+    async def _async_call_plugin(self, func, msg, args):
+        if getattr(func, 'executor', None) == 'process':
+            result = await asyncio.wrap_future(
+                procpool.submit(func, self._client, msg, args))
+            await self._in_executor(procpool.replay, self._client, result)
+        elif asyncio.iscoroutinefunction(func):
+            await func(AsyncMessage(self._client, msg), *args)
+        else:
+            await self._in_executor(func, Message(self._client, msg), *args)
@@ -6,39 +6,145 @@ import logging
 import re
 import time
 from glob import glob
+import functools
+import threading
 import _thread
+from slackbot import metrics
 from slackbot import settings
+from slackbot.limits import PluginLimits
 from slackbot.manager import PluginsManager
 from slackbot.slackclient import SlackClient
 from slackbot.dispatcher import MessageDispatcher
+from slackbot.aiodispatcher import AsyncMessageDispatcher
+from slackbot.cluster import EventQueue, FileEventQueue, QueueTransport
+from slackbot.cluster import IngestDispatcher, WorkerDispatcher
+from slackbot.transports import EventsAPITransport, SocketModeTransport
+from slackbot.utils import FairWorkerPool
 
 logger = logging.getLogger(__name__)
 
 
 class Bot(object):
-    def __init__(self):
+    """
+    Bot serving one workspace. ``workspace`` overrides the settings for it
+    (see WORKSPACES), and ``pool`` and ``limits`` are passed on to its
+    dispatcher.
+    """
+
+    def __init__(self, workspace=None, pool=None, limits=None):
+        self._workspace = workspace or {}
+        self.name = self._workspace.get('name')
+        transport = self._setting('TRANSPORT') or 'rtm'
+        if transport not in ('rtm', 'socket_mode', 'events_api'):
+            raise ValueError('Unknown transport {!r}'.format(transport))
+        role = self._setting('NODE_ROLE')
+        if role not in (None, 'ingest', 'worker'):
+            raise ValueError('Unknown node role {!r}'.format(role))
+        event_loop = getattr(settings, 'EVENT_LOOP', 'poll')
+        if role and event_loop == 'asyncio':
+            raise ValueError('NODE_ROLE needs the poll or select event loop')
         self._client = SlackClient(
-            settings.API_TOKEN,
-            timeout=settings.TIMEOUT if hasattr(settings,
-                                                'TIMEOUT') else None,
-            bot_icon=settings.BOT_ICON if hasattr(settings,
-                                                  'BOT_ICON') else None,
-            bot_emoji=settings.BOT_EMOJI if hasattr(settings,
-                                                    'BOT_EMOJI') else None
+            self._setting('API_TOKEN'),
+            timeout=self._setting('TIMEOUT'),
+            bot_icon=self._setting('BOT_ICON'),
+            bot_emoji=self._setting('BOT_EMOJI'),
+            base_url=self._setting('SLACK_API_URL'),
+            user_fields=self._setting('USER_FIELDS') or (),
+            channel_fields=self._setting('CHANNEL_FIELDS') or (),
+            directory_cache=self._setting('DIRECTORY_CACHE'),
+            directory_ttl=float(self._setting('DIRECTORY_TTL') or 3600),
+            directory_mode=self._setting('DIRECTORY_MODE') or 'full',
+            directory_size=int(self._setting('DIRECTORY_SIZE') or 10000),
+            send_queue=self._setting('SEND_QUEUE', False),
+            send_rate=float(self._setting('SEND_RATE') or 1),
+            send_coalesce=self._setting('SEND_COALESCE', False),
+            rate_limit=self._setting('RATE_LIMIT', True),
+            workspace=self.name,
+            connect=transport == 'rtm' and role != 'worker'
         )
+        self._transport = None
+        if role == 'worker':
+            self._client.web_connect()
+            self._transport = QueueTransport(
+                self._create_event_queue(),
+                partitions=self._setting('WORKER_PARTITIONS'))
+        elif transport != 'rtm':
+            self._client.web_connect()
+            self._transport = self._create_transport(transport)
+        self.name = self.name or self._client.domain
         self._plugins = PluginsManager()
-        self._dispatcher = MessageDispatcher(self._client, self._plugins,
-                                             settings.ERRORS_TO)
+        if event_loop == 'asyncio':
+            self._dispatcher = AsyncMessageDispatcher(
+                self._client, self._plugins, self._setting('ERRORS_TO'))
+        elif role == 'ingest':
+            self._dispatcher = IngestDispatcher(
+                self._client, self._plugins, self._setting('ERRORS_TO'),
+                self._create_event_queue(), pool=pool, limits=limits)
+        elif role == 'worker':
+            self._dispatcher = WorkerDispatcher(
+                self._client, self._plugins, self._setting('ERRORS_TO'),
+                pool=pool, limits=limits)
+        else:
+            self._dispatcher = MessageDispatcher(
+                self._client, self._plugins, self._setting('ERRORS_TO'),
+                pool=pool, limits=limits)
+
+    def _setting(self, name, default=None):
+        if name in self._workspace:
+            return self._workspace[name]
+        return getattr(settings, name, default)
+
+    def _create_transport(self, transport):
+        if transport == 'socket_mode':
+            return SocketModeTransport(
+                self._setting('SLACK_APP_TOKEN'),
+                connections=int(self._setting('SOCKET_MODE_CONNECTIONS') or 2),
+                base_url=self._setting('SLACK_API_URL'))
+        return EventsAPITransport(
+            self._setting('SIGNING_SECRET'),
+            port=int(self._setting('EVENTS_API_PORT') or 3000),
+            addr=self._setting('EVENTS_API_ADDR') or '127.0.0.1',
+            path=self._setting('EVENTS_API_PATH') or '/slack/events',
+            insecure=bool(self._setting('EVENTS_API_INSECURE')))
+
+    def _create_event_queue(self):
+        event_queue = self._setting('EVENT_QUEUE') or 'file'
+        if isinstance(event_queue, EventQueue):
+            return event_queue
+        if event_queue != 'file':
+            raise ValueError('Unknown event queue {!r}'.format(event_queue))
+        return FileEventQueue(
+            self._setting('EVENT_QUEUE_PATH'),
+            partitions=int(self._setting('EVENT_QUEUE_PARTITIONS') or 8))
 
     def run(self):
+        if getattr(settings, 'METRICS_PORT', None):
+            metrics.start_http_server(
+                settings.METRICS_PORT,
+                getattr(settings, 'METRICS_ADDR', None) or '127.0.0.1')
         self._plugins.init_plugins()
+        self.serve()
+
+    def serve(self):
+        """Handle the workspace's events, with the plugins loaded already."""
         self._dispatcher.start()
+        if self._transport is not None:
+            logger.info('receiving events with %s', self._transport.name)
+            self._dispatcher.transport_loop(self._transport)
+            return
         if not self._client.connected: 
             self._client.rtm_connect()
             
-        _thread.start_new_thread(self._keepactive, tuple())
         logger.info('connected to slack RTM api')
-        self._dispatcher.loop()
+        event_loop = getattr(settings, 'EVENT_LOOP', 'poll')
+        if event_loop == 'asyncio':
+            self._dispatcher.loop()
+        elif event_loop == 'select':
+            # keepalive pings are scheduled by the event loop itself
+            self._dispatcher.select_loop()
+        else:
+            _thread.start_new_thread(self._keepactive, tuple())
+            self._dispatcher.loop()
 
     def _keepactive(self):
         logger.info('keep active thread started')
@@ -47,8 +153,118 @@ class Bot(object):
             self._client.ping()
 
 
-def respond_to(matchstr, flags=0):
+class MultiBot(object):
+    """
+    Serves all the ``workspaces`` (see the WORKSPACES setting) from this
+    process. The plugins are loaded once, and the workspaces share one pool
+    of worker threads, which serves their queued messages in turn, and the
+    plugins' concurrency caps. Each workspace has a thread receiving its
+    events.
+    """
+
+    # the directories' bytes are estimated from a sample of their records,
+    # every USAGE_TTL seconds
+    USAGE_SAMPLE = 1000
+    USAGE_TTL = 300
+
+    def __init__(self, workspaces):
+        if getattr(settings, 'EVENT_LOOP', 'poll') == 'asyncio':
+            raise ValueError('WORKSPACES needs the poll or select event loop')
+        self._plugins = PluginsManager()
+        self._pool = FairWorkerPool(
+            nworker=int(getattr(settings, 'WORKER_MIN', None) or 10),
+            max_worker=int(getattr(settings, 'WORKER_MAX', None) or 20),
+            idle_timeout=float(getattr(settings, 'WORKER_IDLE_TIMEOUT', None) or 60),
+            scale_wait=float(getattr(settings, 'WORKER_SCALE_WAIT', None) or 0.5),
+            lanes=MessageDispatcher.LANES)
+        self._limits = PluginLimits()
+        self.bots = []
+        for i, workspace in enumerate(workspaces):
+            workspace = dict(workspace)
+            workspace.setdefault('name', 'workspace{}'.format(i))
+            self.bots.append(Bot(
+                workspace, limits=self._limits,
+                pool=functools.partial(self._pool.client, workspace['name'])))
+        # (workspace, kind) -> when the bytes were estimated, and how many
+        self._directory_bytes = {}
+        metrics.Callback('slackbot_directory_bytes',
+                         'Estimated memory held by the user and channel '
+                         'directories',
+                         lambda: dict(
+                             ((workspace, kind),
+                              self._memory_usage(workspace, kind, directory))
+                             for workspace, kind, directory
+                             in self._directories()),
+                         labelnames=['workspace', 'kind'])
+        metrics.Callback('slackbot_directory_records',
+                         'Users and channels in the directories',
+                         lambda: dict(
+                             ((workspace, kind), len(directory))
+                             for workspace, kind, directory
+                             in self._directories()),
+                         labelnames=['workspace', 'kind'])
+
+    def _directories(self):
+        for bot in self.bots:
+            yield bot.name, 'users', bot._client.users
+            yield bot.name, 'channels', bot._client.channels
+
+    def _memory_usage(self, workspace, kind, directory):
+        now = time.time()
+        estimated = self._directory_bytes.get((workspace, kind))
+        if estimated is None or now - estimated[0] > self.USAGE_TTL:
+            estimated = self._directory_bytes[(workspace, kind)] = (
+                now, directory.memory_usage(sample=self.USAGE_SAMPLE))
+        return estimated[1]
+
+    def directory_usage(self):
+        """Records and estimated bytes of the directories, per workspace."""
+        usage = {}
+        for workspace, kind, directory in self._directories():
+            usage.setdefault(workspace, {})[kind] = {
+                'records': len(directory),
+                'bytes': self._memory_usage(workspace, kind, directory)}
+        return usage
+
+    def run(self):
+        if getattr(settings, 'METRICS_PORT', None):
+            metrics.start_http_server(
+                settings.METRICS_PORT,
+                getattr(settings, 'METRICS_ADDR', None) or '127.0.0.1')
+        self._plugins.init_plugins()
+        threads = []
+        for bot in self.bots:
+            thread = threading.Thread(target=bot.serve, daemon=True,
+                                      name='workspace-{}'.format(bot.name))
+            thread.start()
+            threads.append(thread)
+        logger.info('serving %d workspaces', len(self.bots))
+        for thread in threads:
+            thread.join()
+
+
+def _set_limits(func, timeout, max_concurrency, on_busy):
+    if timeout:
+        func.timeout = timeout
+    if max_concurrency:
+        func.max_concurrency = max_concurrency
+        func.on_busy = on_busy
+
+
+def respond_to(matchstr, flags=0, executor=None, timeout=None,
+             max_concurrency=None, on_busy='queue'):
+    """
+    Pass executor='process' to run the decorated function in a process pool,
+    e.g. for CPU bound work which would otherwise hold the GIL.
+
+    A call lasting more than ``timeout`` seconds is reported as failed and
+    frees its worker. At most ``max_concurrency`` calls run at once, the
+    others wait for their turn or, with on_busy='reject', are dropped.
+    """
     def wrapper(func):
+        if executor:
+            func.executor = executor
+        _set_limits(func, timeout, max_concurrency, on_busy)
         PluginsManager.commands['respond_to'][
             re.compile(matchstr, flags)] = func
         logger.info('registered respond_to plugin "%s" to "%s"', func.__name__,
@@ -58,8 +274,20 @@ def respond_to(matchstr, flags=0):
     return wrapper
 
 
-def listen_to(matchstr, flags=0):
+def listen_to(matchstr, flags=0, executor=None, timeout=None,
+             max_concurrency=None, on_busy='queue'):
+    """
+    Pass executor='process' to run the decorated function in a process pool,
+    e.g. for CPU bound work which would otherwise hold the GIL.
+
+    A call lasting more than ``timeout`` seconds is reported as failed and
+    frees its worker. At most ``max_concurrency`` calls run at once, the
+    others wait for their turn or, with on_busy='reject', are dropped.
+    """
     def wrapper(func):
+        if executor:
+            func.executor = executor
+        _set_limits(func, timeout, max_concurrency, on_busy)
         PluginsManager.commands['listen_to'][
             re.compile(matchstr, flags)] = func
         logger.info('registered listen_to plugin "%s" to "%s"', func.__name__,
@@ -72,19 +300,25 @@ def listen_to(matchstr, flags=0):
 def run_at_times(**kwargs):
     """
     Decorator to run a function once a given number of seconds.
-    Takes run_once_at int parameter in seconds.
+    Takes run_once_at int parameter in seconds, or a cron parameter with a
+    crontab expression (e.g. cron='*/5 9-17 * * 1-5'). Runs may be delayed
+    by up to jitter seconds, and missed runs (e.g. while the previous one was
+    still running) are handled according to the missed parameter:
+    'run_once' (default), 'skip' or 'catch_up'. Also takes the timeout,
+    max_concurrency and on_busy parameters of respond_to.
     The decorated function must take one parameter, a SlackClient instance.
     """
-    if kwargs:
-        if 'run_once_at' in kwargs:
-            run_once_at = kwargs['run_once_at']
-        else:
-            # default to 60s if no run_on_once is given
-            run_once_at = 60
+    # default to 60s if no run_on_once is given
+    run_once_at = kwargs.get('run_once_at', 60)
 
     def wrapper(func):
         func.last_run = None
         func.run_once_at = run_once_at
+        func.cron = kwargs.get('cron')
+        func.jitter = kwargs.get('jitter', 0)
+        func.missed = kwargs.get('missed', 'run_once')
+        _set_limits(func, kwargs.get('timeout'), kwargs.get('max_concurrency'),
+                    kwargs.get('on_busy', 'queue'))
         PluginsManager.run_at_times_commands.append(func)
         logger.info('registered run at given times plugin "%s"', func.__name__)
         return func
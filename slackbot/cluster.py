@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Split deployment (see the NODE_ROLE setting), for when one process can't
+keep up with the workspace:
+
+* the ingest node receives the events, over RTM or any transport, and
+  publishes them to an :class:`EventQueue`, with :class:`IngestDispatcher`;
+* worker nodes, which keep no connection to Slack, consume the events with a
+  :class:`QueueTransport`, run the plugins and send the replies with the
+  Web API, with :class:`WorkerDispatcher`.
+
+The queue is split into partitions, each consumed by one worker node. The
+messages of a channel all go to the same partition, in the order they were
+received, and the events updating the user and channel directories to every
+partition, so that each worker keeps its directories up to date.
+"""
+
+from __future__ import absolute_import
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+from slackbot import metrics
+from slackbot.dispatcher import CHANNEL_EVENTS, USER_EVENTS, EVENTS
+from slackbot.dispatcher import MessageDispatcher
+from slackbot.transports import Transport
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PUBLISHED = metrics.Counter('slackbot_events_published_total',
+                                   'Events published to the event queue',
+                                   ['partition'])
+EVENTS_CONSUMED = metrics.Counter('slackbot_events_consumed_total',
+                                  'Events consumed from the event queue',
+                                  ['partition'])
+
+
+class EventQueue(object):
+    """
+    Queue of events split into ``partitions``. Backends implement
+    :meth:`put` and :meth:`get`; each partition has a single consumer.
+    """
+
+    def __init__(self, partitions=8):
+        self.partitions = partitions
+
+    def partition_of(self, channel):
+        return zlib.crc32(channel.encode('utf-8')) % self.partitions
+
+    def publish(self, event):
+        """Queue the event for the workers: a message to the partition of its
+        channel, a directory update to all of them. Returns the partitions."""
+        event_type = event.get('type')
+        if event_type == 'message' and event.get('channel'):
+            partitions = [self.partition_of(event['channel'])]
+        elif event_type in CHANNEL_EVENTS or event_type in USER_EVENTS:
+            partitions = range(self.partitions)
+        else:
+            return []
+        for partition in partitions:
+            self.put(partition, event)
+            EVENTS_PUBLISHED.inc(str(partition))
+        return list(partitions)
+
+    def put(self, partition, event):
+        raise NotImplementedError
+
+    def get(self, partition, timeout=None):
+        """The next event of the partition, or None after ``timeout``
+        seconds without one."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryEventQueue(EventQueue):
+    """Event queue within the process, e.g. for tests."""
+
+    def __init__(self, partitions=8):
+        super(MemoryEventQueue, self).__init__(partitions)
+        self._queues = [queue.Queue() for __ in range(partitions)]
+
+    def put(self, partition, event):
+        self._queues[partition].put(event)
+
+    def get(self, partition, timeout=None):
+        try:
+            return self._queues[partition].get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class FileEventQueue(EventQueue):
+    """
+    Event queue kept in the ``path`` directory, shared by the nodes of a
+    machine or over a network file system: each partition is a log of JSON
+    lines, which the ingest node appends to, and its consumer reads, every
+    ``poll_interval`` seconds while waiting. The consumer's offset is saved
+    next to the log as each event is read, so that a restarted worker
+    carries on where it stopped: it doesn't handle an event twice, but loses
+    the ones it was handling. The logs aren't trimmed.
+    """
+
+    def __init__(self, path, partitions=8, poll_interval=0.1):
+        super(FileEventQueue, self).__init__(partitions)
+        if not path:
+            raise ValueError('The file event queue needs a path '
+                             '(EVENT_QUEUE_PATH)')
+        self.path = path
+        self.poll_interval = poll_interval
+        os.makedirs(path, exist_ok=True)
+        self._writers = {}
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    def _file(self, partition, suffix):
+        return os.path.join(self.path, '{}.{}'.format(partition, suffix))
+
+    def put(self, partition, event):
+        line = (json.dumps(event) + '\n').encode('utf-8')
+        with self._lock:
+            fd = self._writers.get(partition)
+            if fd is None:
+                fd = self._writers[partition] = os.open(
+                    self._file(partition, 'log'),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # one write per line, so that lines from several writers don't mix
+            os.write(fd, line)
+
+    def get(self, partition, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            event = self._read(partition)
+            if event is not None:
+                return event
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _reader(self, partition):
+        reader = self._readers.get(partition)
+        if reader is None:
+            try:
+                f = open(self._file(partition, 'log'), 'rb')
+            except FileNotFoundError:
+                return None
+            try:
+                with open(self._file(partition, 'offset')) as offset:
+                    f.seek(int(offset.read() or 0))
+            except FileNotFoundError:
+                pass
+            reader = self._readers[partition] = f
+        return reader
+
+    def _read(self, partition):
+        reader = self._reader(partition)
+        if reader is None:
+            return None
+        offset = reader.tell()
+        line = reader.readline()
+        if not line.endswith(b'\n'):
+            # nothing new, or a line being written
+            reader.seek(offset)
+            return None
+        self._save_offset(partition, reader.tell())
+        return json.loads(line.decode('utf-8'))
+
+    def _save_offset(self, partition, offset):
+        path = self._file(partition, 'offset')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        with self._lock:
+            for fd in self._writers.values():
+                os.close(fd)
+            self._writers = {}
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+
+
+class QueueTransport(Transport):
+    """
+    Receives the events of the ``partitions`` of ``event_queue`` (all of them
+    by default), a thread per partition, in the order they were published.
+    """
+
+    name = 'event_queue'
+
+    def __init__(self, event_queue, partitions=None, **kwargs):
+        super(QueueTransport, self).__init__(**kwargs)
+        self.event_queue = event_queue
+        if partitions is None:
+            partitions = range(event_queue.partitions)
+        self.partitions = list(partitions)
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self, handler):
+        super(QueueTransport, self).start(handler)
+        self._stopped.clear()
+        for partition in self.partitions:
+            thread = threading.Thread(target=self._run, args=(partition,),
+                                      daemon=True,
+                                      name='partition-{}'.format(partition))
+            thread.start()
+            self._threads.append(thread)
+        logger.info('consuming the event queue partitions %s',
+                    ', '.join(map(str, self.partitions)))
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+
+    def _run(self, partition):
+        while not self._stopped.is_set():
+            try:
+                event = self.event_queue.get(partition, timeout=0.5)
+            except Exception as e:
+                logger.exception('failed to read the event queue: %s', e)
+                self._stopped.wait(1)
+                continue
+            if event is not None:
+                EVENTS_CONSUMED.inc(str(partition))
+                # the ingest node dropped the duplicates already
+                self._deliver(None, event)
+
+
+class IngestDispatcher(MessageDispatcher):
+    """
+    Publishes the events to ``event_queue`` for the workers instead of
+    handling the messages. The ingest node keeps its directories up to date,
+    and runs the run_at_times plugins, so that they run once.
+    """
+
+    def __init__(self, slackclient, plugins, errors_to, event_queue,
+                 **kwargs):
+        super(IngestDispatcher, self).__init__(slackclient, plugins,
+                                               errors_to, **kwargs)
+        self._event_queue = event_queue
+
+    def _handle_event(self, event):
+        self._event_queue.publish(event)
+        if event.get('type') == 'message':
+            EVENTS.inc('message')
+        else:
+            super(IngestDispatcher, self)._handle_event(event)
+
+
+class WorkerDispatcher(MessageDispatcher):
+    """Handles the messages the ingest node published, leaving the
+    run_at_times plugins to it. The messages of a channel are handled in the
+    order they were published, on a sharded pool, unless WORKER_POOL is
+    set."""
+
+    DEFAULT_POOL = 'sharded'
+
+    def _start_scheduler(self):
+        pass
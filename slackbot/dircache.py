@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk snapshot of the users and channels of a workspace, in SQLite, which
+the bot boots from instead of paging through users.list and
+conversations.list (see the DIRECTORY_CACHE setting).
+"""
+
+from __future__ import absolute_import
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = '1'
+KINDS = ('users', 'channels')
+
+
+class DirectoryCache(object):
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # written from the event loop and the background refresh
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(key TEXT PRIMARY KEY, value TEXT)')
+            for kind in KINDS:
+                self._db.execute('CREATE TABLE IF NOT EXISTS {} '
+                                 '(id TEXT PRIMARY KEY, record TEXT)'.format(kind))
+
+    def _meta(self):
+        return dict(self._db.execute('SELECT key, value FROM meta'))
+
+    def load(self, team_id, fields):
+        """
+        Returns the snapshot of ``team_id`` as (saved_at, users, channels),
+        or None if there is none with all of ``fields`` (a dict of the fields
+        kept per kind, None for all fields).
+        """
+        with self._lock:
+            meta = self._meta()
+            if (meta.get('version') != SCHEMA_VERSION or
+                    meta.get('team_id') != team_id or 'saved_at' not in meta):
+                return None
+            for kind in KINDS:
+                cached = json.loads(meta.get(kind + '_fields', 'null'))
+                wanted = fields.get(kind)
+                # a snapshot without the fields we need is useless
+                if cached is not None and (
+                        wanted is None or not set(wanted) <= set(cached)):
+                    logger.info('ignoring directory cache %s: it lacks %s fields',
+                                self.path, kind)
+                    return None
+            records = [[json.loads(r) for r, in self._db.execute(
+                'SELECT record FROM {}'.format(kind))] for kind in KINDS]
+        return (float(meta['saved_at']),) + tuple(records)
+
+    def update(self, kind, records):
+        """Store (or replace) ``records``."""
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO {} (id, record) VALUES (?, ?)'.format(kind),
+                [(r['id'], json.dumps(dict(r))) for r in records])
+
+    def saved(self, team_id, fields, ids):
+        """Mark the snapshot as complete and current, once every record of
+        the workspace (whose ids per kind are ``ids``) has been stored."""
+        with self._lock, self._db:
+            for kind in KINDS:
+                keep = set(ids[kind])
+                stale = [(id,) for id, in self._db.execute(
+                    'SELECT id FROM {}'.format(kind)) if id not in keep]
+                self._db.executemany(
+                    'DELETE FROM {} WHERE id = ?'.format(kind), stale)
+            meta = {'version': SCHEMA_VERSION, 'team_id': team_id,
+                    'saved_at': repr(time.time())}
+            for kind in KINDS:
+                meta[kind + '_fields'] = json.dumps(
+                    list(fields[kind]) if fields[kind] is not None else None)
+            self._db.executemany(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                meta.items())
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM meta')
+            for kind in KINDS:
+                self._db.execute('DELETE FROM {}'.format(kind))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
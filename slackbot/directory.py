@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import collections
+import itertools
+import logging
+import re
+import sys
+import threading
+import time
+from collections.abc import Mapping
+
+from slackbot.utils import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# the fields of Slack's user and conversation objects the framework uses
+USER_FIELDS = ('id', 'name', 'real_name', 'deleted', 'is_bot')
+CHANNEL_FIELDS = ('id', 'name', 'user', 'is_channel', 'is_group', 'is_im',
+                  'is_mpim', 'is_private', 'is_archived', 'is_member')
+# the first letter of the user (also enterprise and bot) and channel ids
+USER_ID_PREFIXES = ('U', 'W', 'B')
+CHANNEL_ID_PREFIXES = ('C', 'G', 'D')
+
+_MISSING = object()
+
+
+def _sizeof(value):
+    """Bytes held by ``value``, including the containers and records in it."""
+    if isinstance(value, Record):
+        return (sys.getsizeof(value) + sys.getsizeof(value._values) +
+                sum(_sizeof(v) for v in value._values if v is not _MISSING))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_sizeof(v) for v in value)
+    return size
+
+
+class Record(Mapping):
+    """
+    Read-only view of a user or channel, keeping the values of the fields
+    its directory was told to keep in a tuple. The other fields are looked
+    up in the full record, which the directory fetches from Slack when they
+    are first accessed.
+    """
+
+    __slots__ = ('_directory', '_id', '_values')
+
+    def __init__(self, directory, id, values):
+        self._directory = directory
+        self._id = id
+        self._values = values
+
+    def __getitem__(self, key):
+        i = self._directory._positions.get(key)
+        if i is None:
+            return self.full()[key]
+        value = self._values[i]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        i = self._directory._positions.get(key)
+        if i is None:
+            return key in self.full()
+        return self._values[i] is not _MISSING
+
+    def __iter__(self):
+        for field, value in zip(self._directory.fields, self._values):
+            if value is not _MISSING:
+                yield field
+
+    def __len__(self):
+        return sum(1 for value in self._values if value is not _MISSING)
+
+    def __repr__(self):
+        return 'Record({!r})'.format(dict(self))
+
+    def __reduce__(self):
+        # a copy of the kept fields, e.g. for the process pool
+        return dict, (dict(self),)
+
+    def full(self):
+        """The complete record, as returned by Slack."""
+        return self._directory.full_record(self._id)
+
+
+class Directory(dict):
+    """
+    Mapping of Slack ids to user or channel records, with an index from
+    the values of each of the ``keys`` fields (e.g. 'name') back to the ids.
+
+    The indexes follow every change made through the mapping, so lookups by
+    field stay in constant time; a record modified in place must be stored
+    again for its new values to be indexed.
+
+    When given the ``fields`` to keep, the records are stored as compact
+    :class:`Record` objects, and ``loader(id)`` fetches the full records on
+    demand (the last ``cache_size`` of them are cached).
+
+    :meth:`resolve` also fetches the records of the ids the directory
+    doesn't hold, e.g. created while the bot was disconnected. Only ids
+    starting with one of ``id_prefixes`` (any if None) are fetched, e.g. U,
+    W and B for users, and the ones which failed to resolve aren't tried
+    again for ``negative_ttl`` seconds.
+    """
+
+    ID_PATTERN = re.compile(r'^[A-Z][A-Z0-9]{6,}$')
+    # failed lookups remembered at most
+    NEGATIVE_CACHE_SIZE = 10000
+
+    def __init__(self, data=(), keys=('name',), fields=None, loader=None,
+                 cache_size=128, id_prefixes=None, negative_ttl=60):
+        super(Directory, self).__init__()
+        self.keys = tuple(keys)
+        self._indexes = dict((key, {}) for key in self.keys)
+        self.fields = None
+        if fields is not None:
+            self.fields = tuple(collections.OrderedDict.fromkeys(
+                ('id',) + self.keys + tuple(fields)))
+            self._positions = dict((f, i) for i, f in enumerate(self.fields))
+        self.loader = loader
+        self.cache_size = cache_size
+        self._full = collections.OrderedDict()
+        self.id_prefixes = tuple(id_prefixes) if id_prefixes else None
+        self.negative_ttl = negative_ttl
+        # id -> when it may be tried again
+        self._unknown = collections.OrderedDict()
+        self._unknown_lock = threading.Lock()
+        self._flights = SingleFlight()
+        self.update(data)
+
+    def _options(self):
+        return dict(keys=self.keys, fields=self.fields, loader=self.loader,
+                    cache_size=self.cache_size, id_prefixes=self.id_prefixes,
+                    negative_ttl=self.negative_ttl)
+
+    def _resolvable(self, id):
+        id = str(id)
+        if self.loader is None or not self.ID_PATTERN.match(id):
+            return False
+        if self.id_prefixes is not None and not id.startswith(self.id_prefixes):
+            return False
+        with self._unknown_lock:
+            retry_at = self._unknown.get(id)
+            if retry_at is None:
+                return True
+            if retry_at > time.time():
+                return False
+            del self._unknown[id]
+        return True
+
+    def _remember_unknown(self, id):
+        with self._unknown_lock:
+            self._unknown[id] = time.time() + self.negative_ttl
+            self._unknown.move_to_end(id)
+            while len(self._unknown) > self.NEGATIVE_CACHE_SIZE:
+                self._unknown.popitem(last=False)
+
+    def resolve(self, id):
+        """The record of ``id``, fetched with the loader if the directory
+        doesn't hold it, or None if there's none. Concurrent calls for an id
+        share one fetch."""
+        if dict.__contains__(self, id):
+            return dict.__getitem__(self, id)
+        if not self._resolvable(id):
+            return None
+        try:
+            record = self._flights.do(id, lambda: self.loader(id))
+        except Exception as e:
+            logger.debug('failed to resolve %s: %s', id, e)
+            self._remember_unknown(id)
+            return None
+        if not dict.__contains__(self, id):
+            self[id] = record
+            self._full[id] = record
+        return dict.get(self, id)
+
+    def replaced(self, data):
+        """A directory like this one, holding ``data`` instead."""
+        return type(self)(data, **self._options())
+
+    def compact(self, id, record):
+        if self.fields is None or not isinstance(record, dict):
+            return record
+        return Record(self, id, tuple(record.get(f, _MISSING)
+                                      for f in self.fields))
+
+    def full_record(self, id):
+        record = self._full.get(id)
+        if record is not None:
+            self._full.move_to_end(id)
+            return record
+        record = dict.get(self, id)
+        if not isinstance(record, Record):
+            return record or {}
+        if self.loader is None:
+            return dict(record)
+        try:
+            record = self.loader(id)
+        except Exception:
+            logger.exception('failed to fetch the full record of %s', id)
+            return dict(self[id])
+        self._full[id] = record
+        while len(self._full) > self.cache_size:
+            self._full.popitem(last=False)
+        return record
+
+    def memory_usage(self, sample=None):
+        """Estimate of the bytes held by the directory: its records, the
+        indexes and the full records cached. With ``sample``, only that many
+        records are measured, and the others taken to be alike."""
+        size = sys.getsizeof(self) + sum(
+            sys.getsizeof(index) for index in self._indexes.values())
+        count = len(self)
+        records = list(itertools.islice(dict.items(self), sample))
+        measured = sum(sys.getsizeof(id) + _sizeof(record)
+                       for id, record in records)
+        if records:
+            size += measured * count // len(records)
+        return size + sum(_sizeof(record) for record in list(self._full.values()))
+
+    def lookup(self, key, value):
+        """Id of the record whose ``key`` field is ``value``, or None."""
+        if value is None:
+            return None
+        return self._indexes[key].get(value)
+
+    def _index(self, id, record):
+        if record is None:
+            return
+        for key in self.keys:
+            value = record.get(key)
+            if value is not None:
+                self._indexes[key][value] = id
+
+    def _unindex(self, id, record):
+        if record is None:
+            return
+        for key in self.keys:
+            index = self._indexes[key]
+            value = record.get(key)
+            # the value may have been taken over by another record since
+            if value is not None and index.get(value) == id:
+                del index[value]
+
+    def __setitem__(self, id, record):
+        old = dict.get(self, id)
+        if old is not None:
+            self._unindex(id, old)
+        self._full.pop(id, None)
+        record = self.compact(id, record)
+        super(Directory, self).__setitem__(id, record)
+        self._index(id, record)
+        if self._unknown:
+            with self._unknown_lock:
+                self._unknown.pop(id, None)
+
+    def __delitem__(self, id):
+        if not dict.__contains__(self, id):
+            raise KeyError(id)
+        self._unindex(id, dict.__getitem__(self, id))
+        self._full.pop(id, None)
+        super(Directory, self).__delitem__(id)
+
+    def clear(self):
+        super(Directory, self).clear()
+        self._full.clear()
+        for index in self._indexes.values():
+            index.clear()
+        with self._unknown_lock:
+            self._unknown.clear()
+
+    def pop(self, id, *default):
+        if dict.__contains__(self, id):
+            record = dict.__getitem__(self, id)
+            del self[id]
+            return record
+        return super(Directory, self).pop(id, *default)
+
+    def popitem(self):
+        id, record = super(Directory, self).popitem()
+        self._unindex(id, record)
+        return id, record
+
+    def setdefault(self, id, default=None):
+        if not dict.__contains__(self, id):
+            self[id] = default
+        return dict.__getitem__(self, id)
+
+    def update(self, *args, **kwargs):
+        for id, record in dict(*args, **kwargs).items():
+            self[id] = record
+
+
+class LazyDirectory(Directory):
+    """
+    Directory which resolves (see :meth:`~Directory.resolve`) the ids it
+    doesn't hold when they are first looked up, keeping the ``capacity``
+    most recently used records. Looking a channel id up in the users, or an
+    id which failed to resolve lately, costs nothing.
+
+    Only the records already resolved can be looked up by name.
+    """
+
+    def __init__(self, data=(), capacity=10000, **kwargs):
+        self.capacity = capacity
+        self._recent = collections.OrderedDict()
+        self._recent_lock = threading.Lock()
+        super(LazyDirectory, self).__init__(data, **kwargs)
+
+    def _options(self):
+        options = super(LazyDirectory, self)._options()
+        options['capacity'] = self.capacity
+        return options
+
+    def _touch(self, id):
+        with self._recent_lock:
+            self._recent[id] = True
+            self._recent.move_to_end(id)
+
+    def __missing__(self, id):
+        record = self.resolve(id)
+        if record is None:
+            raise KeyError(id)
+        return record
+
+    def __getitem__(self, id):
+        record = super(LazyDirectory, self).__getitem__(id)
+        self._touch(id)
+        return record
+
+    def get(self, id, default=None):
+        try:
+            return self[id]
+        except KeyError:
+            return default
+
+    def __contains__(self, id):
+        return dict.__contains__(self, id) or self.resolve(id) is not None
+
+    def __setitem__(self, id, record):
+        super(LazyDirectory, self).__setitem__(id, record)
+        self._touch(id)
+        while len(self) > self.capacity:
+            with self._recent_lock:
+                if not self._recent:
+                    break
+                oldest, __ = self._recent.popitem(last=False)
+            if dict.__contains__(self, oldest):
+                super(LazyDirectory, self).__delitem__(oldest)
+                self._full.pop(oldest, None)
+
+    def __delitem__(self, id):
+        super(LazyDirectory, self).__delitem__(id)
+        with self._recent_lock:
+            self._recent.pop(id, None)
+
+    def clear(self):
+        super(LazyDirectory, self).clear()
+        with self._recent_lock:
+            self._recent.clear()
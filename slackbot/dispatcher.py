@@ -1,27 +1,85 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+import asyncio
+import concurrent.futures
 import logging
+import queue
 import re
+import selectors
+import sys
 import time
 import traceback
 from functools import wraps
 
 from slackbot.manager import PluginsManager
-from slackbot.utils import WorkerPool
+from slackbot.utils import WorkerPool, ShardedWorkerPool
+from slackbot import procpool
+from slackbot.limits import PluginLimits, PluginBusy, plugin_name
+from slackbot.scheduler import Scheduler, Job
+from slackbot import metrics
 from slackbot import settings
 
 logger = logging.getLogger(__name__)
 
+EVENTS = metrics.Counter('slackbot_events_received_total',
+                         'RTM events received', ['type'])
+MATCH_TIME = metrics.Histogram('slackbot_match_seconds',
+                               'Time spent matching messages to plugins',
+                               ['category'])
+PLUGIN_TIME = metrics.Histogram('slackbot_plugin_seconds',
+                                'Plugin handler latency', ['plugin'])
+PLUGIN_ERRORS = metrics.Counter('slackbot_plugin_errors_total',
+                                'Plugin handler failures', ['plugin'])
+
+# events updating the user and channel directories
+CHANNEL_EVENTS = ('channel_created', 'channel_rename', 'group_joined',
+                  'group_rename', 'im_created')
+USER_EVENTS = ('team_join', 'user_change')
+
 
 class MessageDispatcher(object):
-    def __init__(self, slackclient, plugins, errors_to):
+    """
+    Dispatches the events of a workspace to the plugins, on a worker pool of
+    its own, or on the one ``pool(func, lane_of)`` returns, e.g. a client of
+    a :class:`~slackbot.utils.FairWorkerPool` shared by several workspaces
+    (along with their PluginLimits, ``limits``).
+    """
+
+    # task queue lanes, by priority
+    LANES = ('respond_to', 'direct', 'call_func', 'listen_to')
+    # the worker pool unless WORKER_POOL says otherwise
+    DEFAULT_POOL = 'shared'
+
+    def __init__(self, slackclient, plugins, errors_to, pool=None, limits=None):
         self._client = slackclient
-        self._pool = WorkerPool(self.dispatch_msg)
+        worker_min = int(getattr(settings, 'WORKER_MIN', None) or 10)
+        worker_max = int(getattr(settings, 'WORKER_MAX', None) or 20)
+        if pool is not None:
+            self._pool = pool(self.dispatch_msg, self._task_lane)
+        elif (getattr(settings, 'WORKER_POOL', None) or
+              self.DEFAULT_POOL) == 'sharded':
+            self._pool = ShardedWorkerPool(self.dispatch_msg, nworker=worker_max,
+                                           key=self._task_key)
+        else:
+            self._pool = WorkerPool(
+                self.dispatch_msg,
+                nworker=worker_min,
+                max_worker=worker_max,
+                idle_timeout=float(getattr(settings, 'WORKER_IDLE_TIMEOUT', None) or 60),
+                scale_wait=float(getattr(settings, 'WORKER_SCALE_WAIT', None) or 0.5),
+                lanes=self.LANES,
+                lane_of=self._task_lane,
+                maxsize=int(getattr(settings, 'QUEUE_MAXSIZE', None) or 0),
+                overflow=getattr(settings, 'QUEUE_OVERFLOW', None) or 'block',
+                on_drop=self._task_dropped)
         self._plugins = plugins
+        self._limits = limits or PluginLimits()
+        self._scheduler = Scheduler(
+            lambda func: self._pool.add_task(('call_func', func)))
         self._errors_to = None
         if errors_to:
-            self._errors_to = self._client.find_channel_by_name(errors_to)
+            self._errors_to = self._client.find_channel(errors_to)
             if not self._errors_to:
                 raise ValueError(
                     'Could not find errors_to recipient {!r}'.format(
@@ -33,9 +91,68 @@ class MessageDispatcher(object):
             alias_regex = '|(?P<alias>{})'.format('|'.join([re.escape(s) for s in settings.ALIASES.split(',')]))
 
         self.AT_MESSAGE_MATCHER = re.compile(r'^(?:\<@(?P<atuser>\w+)\>:?|(?P<username>\w+):{}) ?(?P<text>[\s\S]*)$'.format(alias_regex))
+        self._register_metrics()
+
+    def _register_metrics(self):
+        metrics.Callback('slackbot_workers', 'Worker threads',
+                         lambda: self._pool.size)
+        metrics.Callback('slackbot_queue_depth', 'Queued tasks',
+                         lambda: dict(((k,), v) for k, v in
+                                      self._pool.queue_depths().items()),
+                         labelnames=['queue'])
+        metrics.Callback('slackbot_tasks_shed_total',
+                         'Tasks dropped because the queue was full',
+                         lambda: dict(((k,), v) for k, v in
+                                      self._pool.shed_counts().items()),
+                         type='counter', labelnames=['lane'])
+        for counter, help in [
+                ('running', 'Plugin calls in progress'),
+                ('queued', 'Plugin calls which waited for a concurrency slot'),
+                ('rejected', 'Plugin calls rejected by their concurrency cap'),
+                ('timeouts', 'Plugin calls abandoned after their timeout')]:
+            metrics.Callback(
+                'slackbot_plugin_{}{}'.format(
+                    counter, '' if counter == 'running' else '_total'),
+                help,
+                lambda counter=counter: dict(
+                    ((name,), stats[counter])
+                    for name, stats in self._limits.stats().items()),
+                type='gauge' if counter == 'running' else 'counter',
+                labelnames=['plugin'])
 
     def start(self):
         self._pool.start()
+        self._start_scheduler()
+
+    def _start_scheduler(self):
+        for func in self._plugins.get_run_at_times_plugins():
+            self._scheduler.add(Job.from_plugin(func))
+        self._scheduler.start()
+
+    def plugin_stats(self):
+        """Per plugin call, timeout and saturation counters."""
+        return self._limits.stats()
+
+    def _task_lane(self, msg):
+        category, body = msg
+        if category == 'respond_to' and body['channel'].startswith('D'):
+            return 'direct'
+        return category
+
+    def _task_dropped(self, msg):
+        # the scheduler waits for the runs it submitted to be over
+        category, body = msg
+        if category == 'call_func':
+            self._scheduler.job_done(body)
+
+    def _task_key(self, msg):
+        """Tasks sharing a key are handled one at a time, in order."""
+        category, body = msg
+        if category == 'call_func':
+            return body
+        if getattr(settings, 'WORKER_SHARD_KEY', None) == 'thread':
+            return body.get('channel'), body.get('thread_ts')
+        return body.get('channel')
 
     def dispatch_msg(self, msg):
         category = msg[0]
@@ -43,7 +160,12 @@ class MessageDispatcher(object):
         if category == 'call_func':
             func = msg[1]
             try:
-                func(self._client)
+                # a run abandoned after its timeout is still going, the next
+                # one may only start once it's over
+                self._limits.run(func, lambda: func(self._client),
+                                 on_done=lambda: self._scheduler.job_done(func))
+            except PluginBusy as exp:
+                logger.warning('skipped run at times handler: %s', exp)
             except Exception as exp:
                 logger.exception(
                     'Run at times handler failed when trying to run {0} with exception {1}'.format(
@@ -59,29 +181,58 @@ class MessageDispatcher(object):
 
     def _dispatch_msg_handler(self, category, msg):
         responded = False
-        for func, args in self._plugins.get_plugins(category, msg.get('text', None)):
+        for func, args in self._match_plugins(category, msg):
             if func:
                 responded = True
+                started = time.perf_counter()
                 try:
-                    func(Message(self._client, msg), *args)
+                    self._limits.run(
+                        func, lambda: self._call_plugin(func, msg, args))
+                except PluginBusy as e:
+                    logger.warning('dropped message %s: %s', msg['text'], e)
                 except Exception:
-                    logger.exception(
-                        'failed to handle message %s with plugin "%s"',
-                        msg['text'], func.__name__)
-                    reply = '[{}] I had a problem handling "{}"\n'.format(
-                        func.__name__, msg['text'])
-                    tb = '```\n{}\n```'.format(traceback.format_exc())
-                    if self._errors_to:
-                        self._client.rtm_send_message(msg['channel'], reply)
-                        self._client.rtm_send_message(self._errors_to,
-                                                      '{}\n{}'.format(reply,
-                                                                      tb))
-                    else:
-                        self._client.rtm_send_message(msg['channel'],
-                                                      '{}\n{}'.format(reply,
-                                                                      tb))
+                    PLUGIN_ERRORS.inc(plugin_name(func))
+                    self._report_plugin_error(func, msg)
+                finally:
+                    PLUGIN_TIME.observe(time.perf_counter() - started,
+                                        plugin_name(func))
         return responded
 
+    def _match_plugins(self, category, msg):
+        started = time.perf_counter()
+        plugins = list(self._plugins.get_plugins(category, msg.get('text', None)))
+        MATCH_TIME.observe(time.perf_counter() - started, category)
+        return plugins
+
+    def _call_plugin(self, func, msg, args):
+        if getattr(func, 'executor', None) == 'process':
+            result = procpool.submit(func, self._client, msg, args).result()
+            procpool.replay(self._client, result)
+        elif asyncio.iscoroutinefunction(func):
+            # coroutine plugins get their own event loop on worker threads
+            asyncio.run(func(AsyncMessage(self._client, msg), *args))
+        else:
+            func(Message(self._client, msg), *args)
+
+    def _report_plugin_error(self, func, msg, exc_info=None):
+        """Report the exception being handled, or ``exc_info``, to the
+        channel of ``msg`` (or to errors_to)."""
+        exc_info = exc_info or sys.exc_info()
+        logger.error(
+            'failed to handle message %s with plugin "%s"',
+            msg['text'], func.__name__, exc_info=exc_info)
+        reply = '[{}] I had a problem handling "{}"\n'.format(
+            func.__name__, msg['text'])
+        tb = '```\n{}\n```'.format(
+            ''.join(traceback.format_exception(*exc_info)))
+        if self._errors_to:
+            self._client.rtm_send_message(msg['channel'], reply)
+            self._client.rtm_send_message(self._errors_to,
+                                          '{}\n{}'.format(reply, tb))
+        else:
+            self._client.rtm_send_message(msg['channel'],
+                                          '{}\n{}'.format(reply, tb))
+
     def _on_new_message(self, msg):
         # ignore edits
         subtype = msg.get('subtype', '')
@@ -90,7 +241,8 @@ class MessageDispatcher(object):
 
         botname = self._get_bot_name()
         try:
-            msguser = self._client.users.get(msg['user'])
+            # resolves the users who joined while the bot was disconnected
+            msguser = self._client.get_user(msg['user'])
             username = msguser['name']
         except (KeyError, TypeError):
             if 'username' in msg:
@@ -149,32 +301,71 @@ class MessageDispatcher(object):
 
     def loop(self):
         while True:
-            events = self._client.rtm_read()
-            for event in events:
-                event_type = event.get('type')
-                if event_type == 'message':
-                    self._on_new_message(event)
-                elif event_type in ['channel_created', 'channel_rename',
-                                     'group_joined', 'group_rename',
-                                     'im_created']:
-                    channel = [event['channel']]
-                    self._client.parse_channel_data(channel)
-                elif event_type in ['team_join', 'user_change']:
-                    user = [event['user']]
-                    self._client.parse_user_data(user)
-
-            # check to see if there are any run_at_times handlers to be run
-            for func in self._plugins.get_run_at_times_plugins():
-                if not func:
-                    continue
-                if not func.last_run:
-                    func.last_run = time.time()
-                else:
-                    if int(time.time()  - func.last_run) >= func.run_once_at:
-                        func.last_run = time.time()
-                        self._pool.add_task(('call_func', func))
-
-            time.sleep(1.0)
+            idle = True
+            for event in self._client.rtm_read():
+                idle = False
+                self._handle_event(event)
+            # more events may be waiting if the read was capped
+            if idle:
+                time.sleep(1.0)
+
+    def select_loop(self, keepalive=30 * 60):
+        """
+        Event loop blocking on the readiness of the RTM websocket instead of
+        polling it every second. Frames are dispatched as soon as they
+        arrive, and the loop only wakes up otherwise for the keepalive ping.
+        """
+        selector = selectors.DefaultSelector()
+        sock = None
+        next_ping = time.time() + keepalive
+        while True:
+            # the websocket is replaced whenever the client reconnects
+            if self._client.websocket.sock is not sock:
+                if sock is not None:
+                    try:
+                        selector.unregister(sock)
+                    except (KeyError, ValueError, OSError):
+                        pass
+                sock = self._client.websocket.sock
+                selector.register(sock, selectors.EVENT_READ)
+
+            timeout = next_ping - time.time()
+            if getattr(sock, 'pending', None) and sock.pending():
+                # decrypted bytes already buffered in the ssl layer
+                timeout = 0
+            if selector.select(max(timeout, 0)):
+                for event in self._client.rtm_read():
+                    self._handle_event(event)
+
+            if time.time() >= next_ping:
+                self._client.ping()
+                next_ping = time.time() + keepalive
+
+    def transport_loop(self, transport):
+        """
+        Event loop handling the events received by ``transport`` (see
+        slackbot.transports) instead of the RTM ones. The transport's threads
+        queue them, and they are handled one at a time, in order.
+        """
+        events = queue.Queue()
+        transport.start(events.put)
+        try:
+            while True:
+                self._handle_event(events.get())
+        finally:
+            transport.stop()
+
+    def _handle_event(self, event):
+        event_type = event.get('type')
+        EVENTS.inc(event_type)
+        if event_type == 'message':
+            self._on_new_message(event)
+        elif event_type in CHANNEL_EVENTS:
+            channel = [event['channel']]
+            self._client.parse_channel_data(channel)
+        elif event_type in USER_EVENTS:
+            user = [event['user']]
+            self._client.parse_user_data(user)
 
     def _default_reply(self, msg):
         default_reply = settings.DEFAULT_REPLY
@@ -249,10 +440,10 @@ class Message(object):
             in_thread = 'thread_ts' in self.body
 
         if in_thread:
-            self.send_webapi(text, attachments=attachments, as_user=as_user, thread_ts=self.thread_ts)
+            return self.send_webapi(text, attachments=attachments, as_user=as_user, thread_ts=self.thread_ts)
         else:
             text = self.gen_reply(text)
-            self.send_webapi(text, attachments=attachments, as_user=as_user)
+            return self.send_webapi(text, attachments=attachments, as_user=as_user)
 
     @unicode_compact
     def send_webapi(self, text, attachments=None, as_user=True, thread_ts=None):
@@ -262,7 +453,7 @@ class Message(object):
             (This function supports formatted message
             when using a bot integration)
         """
-        self._client.send_message(
+        return self._client.send_message(
             self._body['channel'],
             text,
             attachments=attachments,
@@ -283,10 +474,10 @@ class Message(object):
             in_thread = 'thread_ts' in self.body
 
         if in_thread:
-            self.send(text, thread_ts=self.thread_ts)
+            return self.send(text, thread_ts=self.thread_ts)
         else:
             text = self.gen_reply(text)
-            self.send(text)
+            return self.send(text)
 
     @unicode_compact
     def direct_reply(self, text):
@@ -295,7 +486,7 @@ class Message(object):
 
         """
         channel_id = self._client.open_dm_channel(self._get_user_id())
-        self._client.rtm_send_message(channel_id, text)
+        return self._client.rtm_send_message(channel_id, text)
 
 
     @unicode_compact
@@ -306,7 +497,7 @@ class Message(object):
             (This function doesn't supports formatted message
             when using a bot integration)
         """
-        self._client.rtm_send_message(self._body['channel'], text, thread_ts=thread_ts)
+        return self._client.rtm_send_message(self._body['channel'], text, thread_ts=thread_ts)
 
     def react(self, emojiname):
         """
@@ -364,3 +555,89 @@ class Message(object):
                  for _, v in
                  self._plugins.commands['respond_to'].items()]
         return '\n'.join(reply)
+
+
+class AsyncMessage(Message):
+    """
+    Message handed to coroutine (``async def``) plugins. Every method talking
+    to Slack is a coroutine: RTM messages are written to the non-blocking
+    websocket and Web API calls go through the client's async transport.
+    """
+
+    @unicode_compact
+    async def reply_webapi(self, text, attachments=None, as_user=True, in_thread=None):
+        if in_thread is None:
+            in_thread = 'thread_ts' in self.body
+
+        if in_thread:
+            return await self.send_webapi(text, attachments=attachments, as_user=as_user,
+                                          thread_ts=self.thread_ts)
+        else:
+            text = self.gen_reply(text)
+            return await self.send_webapi(text, attachments=attachments, as_user=as_user)
+
+    @unicode_compact
+    async def send_webapi(self, text, attachments=None, as_user=True, thread_ts=None):
+        return await self._client.async_send_message(
+            self._body['channel'],
+            text,
+            attachments=attachments,
+            as_user=as_user,
+            thread_ts=thread_ts)
+
+    @unicode_compact
+    async def reply(self, text, in_thread=None):
+        if in_thread is None:
+            in_thread = 'thread_ts' in self.body
+
+        if in_thread:
+            return await self.send(text, thread_ts=self.thread_ts)
+        else:
+            text = self.gen_reply(text)
+            return await self.send(text)
+
+    @unicode_compact
+    async def direct_reply(self, text):
+        channel_id = await self._client.async_open_dm_channel(self._get_user_id())
+        return await self._rtm_send(channel_id, text)
+
+    @unicode_compact
+    async def send(self, text, thread_ts=None):
+        return await self._rtm_send(self._body['channel'], text,
+                                    thread_ts=thread_ts)
+
+    async def _rtm_send(self, channel, text, thread_ts=None):
+        if self._client.webapi_only:
+            # no websocket, post it without holding the event loop
+            return await self._client.async_send_message(
+                channel, text, thread_ts=thread_ts)
+        result = self._client.rtm_send_message(channel, text,
+                                               thread_ts=thread_ts)
+        # wait for the outbox to send it, without holding the event loop
+        if isinstance(result, concurrent.futures.Future):
+            return await asyncio.wrap_future(result)
+        return result
+
+    async def react(self, emojiname):
+        await self._client.async_api_call(
+            'reactions_add',
+            name=emojiname,
+            channel=self._body['channel'],
+            timestamp=self._body['ts'])
+
+    @unicode_compact
+    async def reply_upload_file(self, fname, fpath, initial_comment='', in_thread=None):
+        if in_thread is None:
+            in_thread = 'thread_ts' in self.body
+
+        if in_thread:
+            thread_ts = self.thread_ts
+        else:
+            thread_ts = None
+        await self._client.async_upload_file(
+            self._body['channel'],
+            fname,
+            fpath,
+            initial_comment,
+            thread_ts=thread_ts
+        )
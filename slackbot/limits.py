@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import asyncio
+import logging
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def plugin_name(func):
+    return '{}.{}'.format(func.__module__, func.__name__)
+
+
+class PluginTimeout(Exception):
+    pass
+
+
+class PluginBusy(Exception):
+    pass
+
+
+class PluginLimits(object):
+    """
+    Enforces the ``timeout`` and ``max_concurrency`` plugins are registered
+    with, and counts per plugin how often they are hit.
+
+    A plugin call running longer than its timeout is abandoned: the caller
+    gets a PluginTimeout and its worker is free again, while the call keeps
+    its concurrency slot until it eventually returns. Calls above the
+    concurrency cap wait for a slot, for at most the timeout (after which
+    they raise PluginTimeout too), or raise PluginBusy when the plugin was
+    registered with ``on_busy='reject'``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._async_semaphores = {}
+        self._stats = {}
+
+    def _count(self, func, counter, n=1):
+        with self._lock:
+            stats = self._stats.get(func)
+            if stats is None:
+                stats = self._stats[func] = dict.fromkeys(
+                    ('calls', 'running', 'queued', 'rejected', 'timeouts'), 0)
+            stats[counter] += n
+
+    def stats(self):
+        """Saturation counters, by plugin name."""
+        with self._lock:
+            return dict((plugin_name(f), dict(s))
+                        for f, s in self._stats.items())
+
+    def _saturated(self, func):
+        if getattr(func, 'on_busy', 'queue') == 'reject':
+            self._count(func, 'rejected')
+            raise PluginBusy('plugin "{}" is already running {} times'.format(
+                func.__name__, func.max_concurrency))
+        self._count(func, 'queued')
+
+    def _timed_out(self, func, what='timed out'):
+        self._count(func, 'timeouts')
+        return PluginTimeout('plugin "{}" {} after {}s'.format(
+            func.__name__, what, func.timeout))
+
+    def _acquire(self, func, timeout, on_done):
+        """Take a concurrency slot of ``func``, if it has a cap; returns its
+        semaphore."""
+        max_concurrency = getattr(func, 'max_concurrency', None)
+        if not max_concurrency:
+            return None
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                func, threading.BoundedSemaphore(max_concurrency))
+        if not semaphore.acquire(False):
+            try:
+                self._saturated(func)
+                if not semaphore.acquire(timeout=timeout or None):
+                    raise self._timed_out(func, 'found no free slot')
+            except Exception:
+                # the call won't run
+                if on_done is not None:
+                    on_done()
+                raise
+        return semaphore
+
+    def run(self, func, call, on_done=None):
+        """Run ``call()``, the invocation of plugin ``func``, within its
+        limits. ``on_done()`` is called once the call is over, even when
+        the caller gave up waiting for it, or if it didn't run."""
+        timeout = getattr(func, 'timeout', None)
+        semaphore = self._acquire(func, timeout, on_done)
+
+        self._count(func, 'calls')
+        self._count(func, 'running')
+        result = {}
+        done = threading.Event()
+
+        def target():
+            try:
+                call()
+            except BaseException:
+                result['exc_info'] = sys.exc_info()
+            finally:
+                self._count(func, 'running', -1)
+                if semaphore is not None:
+                    semaphore.release()
+                if on_done is not None:
+                    on_done()
+                done.set()
+
+        if not timeout:
+            target()
+        else:
+            thread = threading.Thread(target=target, daemon=True,
+                                      name='plugin-{}'.format(func.__name__))
+            thread.start()
+            if not done.wait(timeout):
+                raise self._timed_out(func)
+        if 'exc_info' in result:
+            __, exc, tb = result.pop('exc_info')
+            raise exc.with_traceback(tb)
+
+    async def async_run(self, func, make_awaitable, cancel=True,
+                        on_done=None):
+        """Await ``make_awaitable()``, the invocation of plugin ``func``,
+        within its limits. Coroutines are cancelled on timeout; with
+        ``cancel=False``, e.g. for a call running in a thread, which can't
+        be, the call keeps its slot until it returns. ``on_done`` is as in
+        :meth:`run`."""
+        semaphore = None
+        timeout = getattr(func, 'timeout', None)
+        max_concurrency = getattr(func, 'max_concurrency', None)
+        if max_concurrency:
+            semaphore = self._async_semaphores.setdefault(
+                func, asyncio.Semaphore(max_concurrency))
+            try:
+                if semaphore.locked():
+                    self._saturated(func)
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), timeout)
+                except asyncio.TimeoutError:
+                    raise self._timed_out(func, 'found no free slot')
+            except BaseException:
+                if on_done is not None:
+                    on_done()
+                raise
+
+        self._count(func, 'calls')
+        self._count(func, 'running')
+        task = asyncio.ensure_future(make_awaitable())
+
+        def release(task):
+            self._count(func, 'running', -1)
+            if semaphore is not None:
+                semaphore.release()
+            if on_done is not None:
+                on_done()
+            if not task.cancelled():
+                # retrieved, even when nobody waits for it anymore
+                task.exception()
+        task.add_done_callback(release)
+        try:
+            done, __ = await asyncio.wait([task], timeout=timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not done:
+            if cancel:
+                task.cancel()
+                await asyncio.wait([task])
+            raise self._timed_out(func)
+        return task.result()
@@ -2,21 +2,103 @@
 
 import os
 import logging
+import threading
 from glob import glob
 from importlib import import_module
 from slackbot import settings
+from slackbot.matcher import PatternIndex
 
 logger = logging.getLogger(__name__)
 
 
+class CommandRegistry(dict):
+    """
+    Mapping of compiled regexes to plugin functions, in registration order.
+
+    A :class:`~slackbot.matcher.PatternIndex` over the registered patterns is
+    compiled on first use and dropped whenever the registry is modified.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CommandRegistry, self).__init__(*args, **kwargs)
+        self._index = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def _invalidate(self):
+        self._version += 1
+        self._index = None
+
+    def __setitem__(self, key, value):
+        super(CommandRegistry, self).__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        super(CommandRegistry, self).__delitem__(key)
+        self._invalidate()
+
+    def clear(self):
+        super(CommandRegistry, self).clear()
+        self._invalidate()
+
+    def pop(self, *args):
+        value = super(CommandRegistry, self).pop(*args)
+        self._invalidate()
+        return value
+
+    def popitem(self):
+        item = super(CommandRegistry, self).popitem()
+        self._invalidate()
+        return item
+
+    def setdefault(self, key, default=None):
+        value = super(CommandRegistry, self).setdefault(key, default)
+        self._invalidate()
+        return value
+
+    def update(self, *args, **kwargs):
+        super(CommandRegistry, self).update(*args, **kwargs)
+        self._invalidate()
+
+    @property
+    def index(self):
+        index = self._index
+        if index is None:
+            with self._lock:
+                version = self._version
+                index = PatternIndex(list(self))
+                if version == self._version:
+                    self._index = index
+        return index
+
+    def search(self, text):
+        """Yield ``(matcher, match)`` for every registered regex found in
+        ``text``, in registration order."""
+        return self.index.search(text)
+
+
+def _search(commands, text):
+    """Yield ``(matcher, match)`` for the regexes of ``commands`` found in
+    ``text``, trying them one by one when it's a plain dict."""
+    search = getattr(commands, 'search', None)
+    if search is not None:
+        for found in search(text):
+            yield found
+        return
+    for matcher in list(commands):
+        m = matcher.search(text)
+        if m:
+            yield matcher, m
+
+
 class PluginsManager(object):
     def __init__(self):
         pass
 
     commands = {
-        'respond_to': {},
-        'listen_to': {},
-        'default_reply': {},
+        'respond_to': CommandRegistry(),
+        'listen_to': CommandRegistry(),
+        'default_reply': CommandRegistry(),
     }
     run_at_times_commands = []
 
@@ -29,6 +111,11 @@ class PluginsManager(object):
         for plugin in plugins:
             self._load_plugins(plugin)
 
+        # compile the matching engines now rather than on the first message
+        for commands in self.commands.values():
+            if isinstance(commands, CommandRegistry):
+                commands.index
+
     def _load_plugins(self, plugin):
         logger.info('loading plugin "%s"', plugin)
         path_name = None
@@ -57,11 +144,10 @@ class PluginsManager(object):
         has_matching_plugin = False
         if text is None:
             text = ''
-        for matcher in self.commands[category]:
-            m = matcher.search(text)
-            if m:
-                has_matching_plugin = True
-                yield self.commands[category][matcher], m.groups()
+        commands = self.commands[category]
+        for matcher, m in _search(commands, text):
+            has_matching_plugin = True
+            yield commands[matcher], m.groups()
 
         if not has_matching_plugin:
             yield None, None
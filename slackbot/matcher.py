@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+_REPEATS = tuple(getattr(sre_parse, name) for name in
+                 ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(sre_parse, name))
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+def required_literals(pattern):
+    """
+    Return a set of literal strings such that any text matched by the
+    compiled ``pattern`` must contain at least one of them, or None if no
+    such set could be derived (the pattern then has to be tried on every
+    text).
+
+    For case insensitive patterns the literals are lowercased and limited to
+    ASCII, so they can be looked up in ``text.lower()`` of ASCII texts.
+    """
+    if not isinstance(pattern.pattern, str):
+        return None
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    literals = _required(parsed, ignorecase)
+    if literals and ignorecase:
+        literals = set(s.lower() for s in literals)
+    return literals
+
+
+def _best(current, candidate):
+    if not candidate:
+        return current
+    if current is None or min(map(len, candidate)) > min(map(len, current)):
+        return candidate
+    return current
+
+
+def _required(subpattern, ignorecase):
+    best = None
+    run = []
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL:
+            ch = chr(av)
+            if not ignorecase or ch.isascii():
+                run.append(ch)
+                continue
+        if run:
+            best = _best(best, {''.join(run)})
+            run = []
+
+        candidate = None
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, del_flags, p = av
+            # scoped flags may change the case rules inside the group
+            if not add_flags and not del_flags:
+                candidate = _required(p, ignorecase)
+        elif op is sre_parse.BRANCH:
+            candidate = set()
+            for branch in av[1]:
+                literals = _required(branch, ignorecase)
+                if not literals:
+                    candidate = None
+                    break
+                candidate |= literals
+        elif op in _REPEATS:
+            min_repeat, _, p = av
+            if min_repeat >= 1:
+                candidate = _required(p, ignorecase)
+        elif op is _ATOMIC_GROUP:
+            candidate = _required(av, ignorecase)
+        best = _best(best, candidate)
+
+    if run:
+        best = _best(best, {''.join(run)})
+    return best
+
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton reporting which of ``words`` occur in a text."""
+
+    def __init__(self, words):
+        self.words = list(words)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [frozenset()]
+
+        outputs = [set()]
+        for i, word in enumerate(self.words):
+            state = 0
+            for ch in word:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append(set())
+                state = nxt
+            outputs[state].add(i)
+
+        # breadth first over the trie to compute failure links
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = fail if fail != nxt else 0
+                outputs[nxt] |= outputs[self._fail[nxt]]
+        self._out = [frozenset(o) for o in outputs]
+
+    def search(self, text):
+        """Return the set of indexes of the words contained in ``text``."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+def _trie_regex(node):
+    """Regex matching the words of the trie ``node``, preferring the longest
+    one (the trie's prefixes are factored out, so that the regex engine
+    doesn't try every word at every position)."""
+    branches = [re.escape(ch) + _trie_regex(child)
+                for ch, child in sorted(node.items()) if ch]
+    if not branches:
+        return ''
+    regex = branches[0] if len(branches) == 1 else '(?:{})'.format(
+        '|'.join(branches))
+    if '' in node:
+        # the greedy ? tries the longer words first
+        return '(?:{})?'.format(regex)
+    return regex
+
+
+class LiteralScanner(object):
+    """
+    Reports which of ``words`` occur in a text, like :class:`AhoCorasick`,
+    but scanning with one compiled regex, so that the loop over the text
+    runs in C.
+    """
+
+    def __init__(self, words):
+        self.words = list(words)
+        # at each position the regex reports the longest word starting
+        # there, and with it the words it contains
+        trie = {}
+        for word in self.words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[''] = True
+        self._regex = re.compile(_trie_regex(trie))
+        contained = AhoCorasick(self.words)
+        self._contains = dict((word, frozenset(contained.search(word)))
+                              for word in self.words)
+
+    def search(self, text):
+        """Return the set of indexes of the words contained in ``text``."""
+        found = set()
+        search = self._regex.search
+        m = search(text)
+        while m is not None:
+            found |= self._contains[m.group()]
+            # words may overlap: look again from the next character
+            m = search(text, m.start() + 1)
+        return found
+
+
+class PatternIndex(object):
+    """
+    Matches a text against an ordered list of compiled regexes in one pass.
+
+    Every pattern is reduced to a set of required literals; a scan of the
+    text for all of them selects the patterns that can possibly match, and
+    only those are run, in their original order. Patterns without usable
+    literals are always run.
+
+    The scan only pays off with many patterns: with fewer than
+    ``min_patterns`` of them, they are all run on every text.
+    """
+
+    def __init__(self, patterns, min_patterns=16):
+        self.patterns = list(patterns)
+        self._indexed = len(self.patterns) >= min_patterns
+        if not self._indexed:
+            return
+        self._always = []
+        self._ignorecase = set()
+        case_owners, nocase_owners = {}, {}
+        for i, pattern in enumerate(self.patterns):
+            literals = required_literals(pattern)
+            if not literals:
+                self._always.append(i)
+                continue
+            if pattern.flags & re.IGNORECASE:
+                self._ignorecase.add(i)
+                owners = nocase_owners
+            else:
+                owners = case_owners
+            for literal in literals:
+                owners.setdefault(literal, []).append(i)
+
+        self._case_owners = list(case_owners.values())
+        self._case = LiteralScanner(case_owners) if case_owners else None
+        self._nocase_owners = list(nocase_owners.values())
+        self._nocase = (LiteralScanner(nocase_owners) if nocase_owners
+                        else None)
+
+    def candidates(self, text):
+        """Indexes of the patterns worth running against ``text``, in order."""
+        if not self._indexed:
+            return range(len(self.patterns))
+        selected = set(self._always)
+        if self._case is not None:
+            for w in self._case.search(text):
+                selected.update(self._case_owners[w])
+        if self._nocase is not None:
+            if text.isascii():
+                for w in self._nocase.search(text.lower()):
+                    selected.update(self._nocase_owners[w])
+            else:
+                # unicode case folding can map non-ascii characters onto
+                # ascii literals (e.g. KELVIN SIGN), don't filter those
+                selected.update(self._ignorecase)
+        return sorted(selected)
+
+    def search(self, text):
+        """Yield ``(pattern, match)`` for every pattern found in ``text``."""
+        for i in self.candidates(text):
+            pattern = self.patterns[i]
+            m = pattern.search(text)
+            if m:
+                yield pattern, m
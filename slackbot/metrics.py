@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal in-process metrics, exposed in the Prometheus text format.
+
+Recording a sample costs a lock and a few arithmetic operations, so the
+metrics are always collected; they are only served over HTTP when
+``METRICS_PORT`` is set (see :func:`start_http_server`).
+"""
+
+from __future__ import absolute_import
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                   2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add ``metric``, replacing any metric of the same name."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def exposition(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name,
+                                 _format_labels(self.labelnames, labels),
+                                 _format_value(value))
+                for labels, value in values]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket..., count above the last one, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def count(self, *labels):
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.labelnames, labels,
+                                   [('le', _format_value(float(bound)))]),
+                    cumulative))
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str,
+                                              _format_value(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, label_str,
+                                                cumulative))
+        return lines
+
+
+class Callback(object):
+    """
+    Metric whose samples are read from ``func()`` at exposition time, as a
+    number or a mapping of label value tuples to numbers.
+    """
+
+    def __init__(self, name, help, func, type='gauge', labelnames=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception:
+            logger.exception('failed to collect metric %s', self.name)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return ['{}{} {}'.format(self.name,
+                                 _format_labels(self.labelnames, labels),
+                                 _format_value(value))
+                for labels, value in sorted(values.items())]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_http_server(port, addr='127.0.0.1', registry=REGISTRY):
+    """Serve ``registry`` on http://addr:port/metrics from a daemon thread."""
+    handler = type('MetricsHandler', (_MetricsHandler,),
+                   {'registry': registry})
+    server = ThreadingHTTPServer((addr, int(port)), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics',
+                              daemon=True)
+    thread.start()
+    logger.info('serving metrics on http://%s:%d/metrics',
+                addr, server.server_address[1])
+    return server
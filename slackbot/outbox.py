@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of the messages the bot sends, drained by a few sender threads at the
+rate Slack allows per channel (about one message per second), so that a
+plugin posting many lines doesn't hold its worker while Slack rate limits it.
+"""
+
+from __future__ import absolute_import
+import collections
+import logging
+import threading
+from concurrent.futures import Future
+
+from slackbot import metrics
+from slackbot.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DEPTH = metrics.Gauge('slackbot_outbox_depth',
+                             'Messages waiting to be sent')
+OUTBOX_COALESCED = metrics.Counter(
+    'slackbot_outbox_coalesced_total',
+    'Messages merged into the previous one to the same channel')
+
+# Slack truncates longer message texts
+MAX_MESSAGE_LENGTH = 4000
+
+# the Web API method whose per channel budget the messages draw on
+SEND_METHOD = 'chat.postMessage'
+
+_Item = collections.namedtuple('_Item', 'send text group future')
+
+
+class Outbox(object):
+    """
+    Sends the messages of each channel in order, at most ``rate`` per second
+    on average (``burst`` at once), serving the channels in turn. The
+    ``senders`` threads send to different channels at once, one message at
+    a time per channel, so that a slow channel doesn't hold up the others.
+
+    Given the client's :class:`~slackbot.ratelimit.RateLimiter`, the
+    messages draw on its per channel budget instead of one of their own,
+    which the messages sent without the outbox share, and the limiter
+    doesn't pace them a second time.
+
+    With ``coalesce``, consecutive messages of the same group (e.g. the same
+    channel and thread) which queued up behind the rate limit are sent as one,
+    their texts joined by newlines, as long as the result stays under
+    ``max_length`` characters.
+    """
+
+    def __init__(self, rate=1.0, burst=1, coalesce=False,
+                 max_length=MAX_MESSAGE_LENGTH, senders=4, limiter=None):
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+        self.max_length = max_length
+        self.senders = senders
+        self.limiter = limiter
+        # channel -> the messages waiting, in the order the channels are served
+        self._queues = collections.OrderedDict()
+        self._buckets = {}
+        # the channels a message is being sent to
+        self._sending = set()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        for i in range(self.senders):
+            thread = threading.Thread(target=self.run,
+                                      name='outbox-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        """Stop once the messages queued so far are sent."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def pending(self):
+        return self._pending
+
+    def put(self, channel, send, text, group=None):
+        """
+        Queue ``send(text)``, which posts ``text`` to ``channel``. Messages
+        with the same ``group`` (None for none) may be merged. Returns a
+        :class:`concurrent.futures.Future` of what ``send`` returns.
+        """
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('the outbox is stopped')
+            queue = self._queues.get(channel)
+            if queue is None:
+                queue = self._queues[channel] = collections.deque()
+            queue.append(_Item(send, text, group, future))
+            self._pending += 1
+            OUTBOX_DEPTH.set(self._pending)
+            self._cond.notify()
+        return future
+
+    def _bucket(self, channel):
+        if self.limiter is not None:
+            bucket = self.limiter.bucket(SEND_METHOD, channel)
+            if bucket is not None:
+                return bucket
+        bucket = self._buckets.get(channel)
+        if bucket is None:
+            bucket = self._buckets[channel] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _next(self):
+        """The first channel which may send now, else None and the seconds
+        before one can (None until a send is over if all are busy)."""
+        wait = None
+        for channel in self._queues:
+            if channel in self._sending:
+                continue
+            bucket = self._bucket(channel)
+            tokens = bucket.tokens
+            if tokens >= 1:
+                return channel, 0
+            delay = (1 - tokens) / bucket.rate
+            if wait is None or delay < wait:
+                wait = delay
+        return None, wait
+
+    def _take(self, channel):
+        queue = self._queues[channel]
+        batch = [queue.popleft()]
+        if self.coalesce and batch[0].group is not None:
+            length = len(batch[0].text or '')
+            while queue and queue[0].group == batch[0].group:
+                length += 1 + len(queue[0].text or '')
+                if length > self.max_length:
+                    break
+                batch.append(queue.popleft())
+        if queue:
+            # let the other channels go first
+            self._queues.move_to_end(channel)
+        else:
+            del self._queues[channel]
+        self._bucket(channel).delay()
+        self._sending.add(channel)
+        self._pending -= len(batch)
+        OUTBOX_DEPTH.set(self._pending)
+        if len(batch) > 1:
+            OUTBOX_COALESCED.inc(amount=len(batch) - 1)
+        return batch
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped and not self._queues:
+                        return
+                    channel, wait = self._next()
+                    if channel is not None:
+                        break
+                    self._cond.wait(wait)
+                batch = self._take(channel)
+            try:
+                self._send(channel, batch)
+            finally:
+                with self._cond:
+                    self._sending.discard(channel)
+                    self._cond.notify_all()
+
+    def _send(self, channel, batch):
+        # the messages cancelled meanwhile are dropped
+        batch = [item for item in batch
+                 if item.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        text = '\n'.join(item.text or '' for item in batch)
+        try:
+            if self.limiter is not None:
+                # the token was taken already
+                with self.limiter.paid(SEND_METHOD, channel):
+                    result = batch[0].send(text)
+            else:
+                result = batch[0].send(text)
+        except Exception as e:
+            logger.exception('failed to send a message: %s', e)
+            for item in batch:
+                item.future.set_exception(e)
+        else:
+            for item in batch:
+                item.future.set_result(result)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Run CPU bound plugins (registered with ``executor='process'``) in a pool of
+processes, so they don't hold the GIL of the worker threads.
+
+The plugin gets a regular :class:`~slackbot.dispatcher.Message` bound to a
+:class:`RecordingClient`, a picklable snapshot of what the message needs from
+the SlackClient. Whatever the plugin sends to Slack is recorded and sent back
+to the parent process, which performs it over the real client.
+"""
+
+from __future__ import absolute_import
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from slackbot import settings
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ProcessPluginError(Exception):
+    """A plugin failed in a worker process; the message is its traceback."""
+
+
+class RecordingClient(object):
+    def __init__(self, login_data, users, channels):
+        self.login_data = login_data
+        self.users = users
+        self.channels = channels
+        self.actions = []
+
+    @classmethod
+    def snapshot(cls, client, body):
+        """Copy the parts of ``client`` a message handler may look at."""
+        users = {}
+        if body.get('user') in client.users:
+            users[body['user']] = client.users[body['user']]
+        elif 'username' in body:
+            user_id = client.find_user_by_name(body['username'])
+            if user_id:
+                users[user_id] = client.users[user_id]
+        channels = {}
+        if body.get('channel') in client.channels:
+            channels[body['channel']] = client.channels[body['channel']]
+        login_data = {'self': (client.login_data or {}).get('self')}
+        return cls(login_data, users, channels)
+
+    def _record(self, method, *args, **kwargs):
+        self.actions.append((method, args, kwargs))
+
+    def rtm_send_message(self, *args, **kwargs):
+        self._record('rtm_send_message', *args, **kwargs)
+
+    def send_message(self, *args, **kwargs):
+        self._record('send_message', *args, **kwargs)
+
+    def react_to_message(self, *args, **kwargs):
+        self._record('react_to_message', *args, **kwargs)
+
+    def upload_content(self, *args, **kwargs):
+        self._record('upload_content', *args, **kwargs)
+
+    def upload_file(self, channel, fname, fpath, comment, thread_ts=None):
+        # the file may be gone by the time the parent uploads it
+        with open(fpath, 'rb') as f:
+            content = f.read()
+        self._record('upload_file', channel, fname or os.path.basename(fpath),
+                     content, comment, thread_ts=thread_ts)
+
+    def open_dm_channel(self, user_id):
+        # the parent resolves user ids to their direct message channel
+        return user_id
+
+    def get_channel(self, channel_id):
+        from slackbot.slackclient import Channel
+        return Channel(self, self.channels[channel_id])
+
+    def get_user(self, user_id):
+        return self.users.get(user_id)
+
+    def find_user_by_name(self, username):
+        for userid, user in self.users.items():
+            if user['name'] == username:
+                return userid
+
+
+def run_plugin(func, client, body, args):
+    """Entry point in the worker process: returns the recorded actions and
+    the traceback of the plugin failure, if any."""
+    from slackbot.dispatcher import Message
+    try:
+        func(Message(client, body), *args)
+    except Exception:
+        return client.actions, traceback.format_exc()
+    return client.actions, None
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            nworker = getattr(settings, 'PROCESS_WORKERS', None)
+            # forking this process, with its worker, sender and websocket
+            # threads, could copy locks held by them into the children
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            _executor = ProcessPoolExecutor(
+                max_workers=int(nworker) if nworker else None,
+                mp_context=context)
+        return _executor
+
+
+def submit(func, client, body, args):
+    """Start ``func`` on ``body`` in the process pool; returns a future of
+    what :func:`run_plugin` returns."""
+    return get_executor().submit(
+        run_plugin, func, RecordingClient.snapshot(client, body), body, args)
+
+
+def replay(client, result):
+    """Perform the actions recorded by :func:`run_plugin` over ``client``."""
+    actions, error = result
+    for method, args, kwargs in actions:
+        getattr(client, method)(*args, **kwargs)
+    if error:
+        raise ProcessPluginError(error)
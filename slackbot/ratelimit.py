@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import contextlib
+import logging
+import threading
+import time
+
+from slackbot import metrics
+
+logger = logging.getLogger(__name__)
+
+# calls per minute of Slack's Web API rate limit tiers, which allow short
+# bursts above it (https://api.slack.com/docs/rate-limits)
+TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+METHOD_TIERS = {
+    'rtm.connect': 1,
+    'users.list': 2,
+    'conversations.list': 2,
+    'files.upload': 2,
+    'conversations.info': 3,
+    'conversations.open': 3,
+    'reactions.add': 3,
+    'users.info': 4,
+}
+
+# the methods RateLimiter paces by tier; reconnections have their own backoff
+PACED_TIERS = dict((method, tier) for method, tier in METHOD_TIERS.items()
+                   if method != 'rtm.connect')
+
+# methods limited per channel rather than by tier, in calls per second
+CHANNEL_RATES = {'chat.postMessage': 1.0}
+
+RATELIMIT_WAIT = metrics.Counter(
+    'slackbot_ratelimit_wait_seconds_total',
+    'Time Web API calls waited for the client side rate limit', ['method'])
+
+
+def method_rate(method):
+    """Calls per second allowed to Web API ``method``, None if unknown."""
+    tier = METHOD_TIERS.get(method)
+    return TIERS[tier] / 60.0 if tier else None
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` operations per second on average, and bursts of up to
+    ``capacity`` operations.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        """The operations which may start right away."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def delay(self, tokens=1):
+        """Take ``tokens`` now and return how many seconds the caller has to
+        wait before using them (0 if it can go ahead)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+        """Wait for ``tokens``; returns the seconds waited."""
+        delay = self.delay(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class RateLimiter(object):
+    """
+    Paces Web API calls before they are sent, rather than waiting for Slack
+    to answer 429: the methods of a tier at the tier's rate (bursting up to
+    ``window`` seconds worth of calls), and the methods limited per channel at
+    their rate in each channel. Every thread using the limiter draws on the
+    same budget.
+    """
+
+    def __init__(self, method_tiers=PACED_TIERS, channel_rates=CHANNEL_RATES,
+                 window=60):
+        self.method_tiers = method_tiers
+        self.channel_rates = channel_rates
+        self.window = window
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def bucket(self, method, channel=None):
+        """The bucket limiting ``method`` (in ``channel``), None if unlimited."""
+        if method in self.channel_rates:
+            if channel is None:
+                return None
+            key, rate, capacity = (method, channel), self.channel_rates[method], 1
+        else:
+            tier = self.method_tiers.get(method)
+            if tier is None:
+                return None
+            rate = TIERS[tier] / 60.0
+            key, capacity = method, max(1, rate * self.window)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    @contextlib.contextmanager
+    def paid(self, method, channel=None):
+        """Within the block, the current thread's next call to ``method`` (in
+        ``channel``) goes ahead without drawing on the budget, for a caller
+        which took it from :meth:`bucket` already."""
+        self._local.paid = (method, channel)
+        try:
+            yield
+        finally:
+            self._local.paid = None
+
+    def delay(self, method, channel=None):
+        """Take a call to ``method`` from the budget, and return the seconds
+        to wait before making it."""
+        if getattr(self._local, 'paid', None) == (method, channel):
+            self._local.paid = None
+            bucket = None
+        else:
+            bucket = self.bucket(method, channel)
+        delay = bucket.delay() if bucket is not None else 0
+        self._local.waited = delay
+        if delay:
+            RATELIMIT_WAIT.inc(method, amount=delay)
+            logger.debug('waiting %.2fs before calling %s', delay, method)
+        return delay
+
+    def acquire(self, method, channel=None):
+        """Wait until ``method`` may be called; returns the seconds waited."""
+        delay = self.delay(method, channel)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def last_wait(self):
+        """Seconds the last call of the current thread waited."""
+        return getattr(self._local, 'waited', 0)
+
+    def remaining(self, method, channel=None):
+        """Calls to ``method`` (in ``channel``) which can be made right away,
+        None if it isn't limited."""
+        bucket = self.bucket(method, channel)
+        return bucket.tokens if bucket is not None else None
+
+    def budget(self):
+        """The calls left per method, or (method, channel), called so far."""
+        with self._lock:
+            buckets = list(self._buckets.items())
+        return dict((key, bucket.tokens) for key, bucket in buckets)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# how late a run may start before it counts as missed
+MISFIRE_GRACE = 1.0
+
+
+class IntervalSchedule(object):
+    """Fires every ``seconds``, at a fixed rate (runs don't drift)."""
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Expected a positive interval, got {!r}'.format(
+                seconds))
+        self.seconds = seconds
+
+    def next_after(self, t):
+        return t + self.seconds
+
+
+class CronSchedule(object):
+    """
+    Fires on a crontab(5) expression, in local time: minute, hour, day of
+    month, month and day of week (0 or 7 is Sunday) fields, each being ``*``
+    or a list of values, ``a-b`` ranges and ``/step`` increments.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression {!r}'.format(expr))
+        self.expr = expr
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [self._parse(f, lo, hi) for f, (lo, hi)
+                      in zip(fields, self.FIELDS)]
+        self.weekdays = frozenset(d % 7 for d in weekdays)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            span, __, step = part.partition('/')
+            if span == '*':
+                start, end = lo, hi
+            elif '-' in span:
+                start, end = [int(v) for v in span.split('-', 1)]
+            else:
+                start = int(span)
+                end = hi if step else start
+            if not lo <= start <= end <= hi:
+                raise ValueError('Invalid cron field {!r}'.format(field))
+            values.update(range(start, end + 1, int(step or 1)))
+        return frozenset(values)
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return weekday
+        if self._any_weekday:
+            return day
+        # like cron, restricting both fields means either one
+        return day or weekday
+
+    def next_after(self, t):
+        start = datetime.fromtimestamp(t)
+        dt = start.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        while dt.year <= start.year + 4:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) +
+                      timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError('{!r} never fires'.format(self.expr))
+
+
+class Job(object):
+    MISSED_POLICIES = ('run_once', 'skip', 'catch_up')
+
+    def __init__(self, func, schedule, jitter=0, missed='run_once'):
+        if missed not in self.MISSED_POLICIES:
+            raise ValueError('Unknown missed run policy {!r}'.format(missed))
+        self.func = func
+        self.schedule = schedule
+        self.jitter = jitter
+        self.missed = missed
+        self.running = False
+        self.pending = 0
+
+    @classmethod
+    def from_plugin(cls, func):
+        """Job for a function decorated with ``run_at_times``."""
+        if getattr(func, 'cron', None):
+            schedule = CronSchedule(func.cron)
+        else:
+            schedule = IntervalSchedule(func.run_once_at)
+        return cls(func, schedule, jitter=getattr(func, 'jitter', 0),
+                   missed=getattr(func, 'missed', 'run_once'))
+
+
+class Scheduler(object):
+    """
+    Runs jobs on their own thread from a heap of next-fire deadlines, and
+    hands every due run to ``submit(func)``, which returns False if the run
+    was dropped (e.g. by a full task queue).
+
+    The runs of a job never overlap: a run falling due while the previous one
+    hasn't reported back with :meth:`job_done` is counted as missed. So is a
+    run the scheduler picks up more than MISFIRE_GRACE seconds after its
+    jittered time (e.g. after the machine was suspended). Missed runs are handled according to
+    the job's policy: 'run_once' runs once as soon as possible, 'skip' drops
+    them and 'catch_up' runs them all, one after the other.
+    """
+
+    def __init__(self, submit):
+        self.submit = submit
+        self._heap = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, job, now=None):
+        deadline = job.schedule.next_after(time.time() if now is None else now)
+        with self._cond:
+            self._jobs[job.func] = job
+            self._push(job, deadline)
+            self._cond.notify()
+
+    def _push(self, job, deadline):
+        fire_at = deadline + random.uniform(0, job.jitter)
+        heapq.heappush(self._heap, (fire_at, next(self._seq), deadline, job))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self):
+        logger.info('scheduler started with %d jobs', len(self._jobs))
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(timeout)
+            self.run_pending()
+
+    def run_pending(self, now=None):
+        """Account for the runs due at ``now`` and submit the ones that may
+        start."""
+        ready = []
+        with self._cond:
+            now = time.time() if now is None else now
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, __, deadline, job = heapq.heappop(self._heap)
+                # late compared to when the run was meant to fire, jitter
+                # included
+                due, missed = 1, now - fire_at > MISFIRE_GRACE
+                nxt = job.schedule.next_after(deadline)
+                # the next runs are missed once past their latest jittered
+                # time
+                while nxt + job.jitter < now:
+                    due, missed = due + 1, True
+                    nxt = job.schedule.next_after(nxt)
+                if job.running:
+                    missed = True
+                if missed:
+                    logger.warning('job "%s" missed %d runs', job.func.__name__,
+                                   due)
+                    if job.missed == 'skip':
+                        due = 0
+                    elif job.missed == 'run_once':
+                        due = 1 - job.pending
+                job.pending += max(due, 0)
+                self._push(job, nxt)
+                if self._start(job):
+                    ready.append(job)
+        for job in ready:
+            self._submit(job)
+
+    def _start(self, job):
+        if job.running or not job.pending:
+            return False
+        job.running = True
+        job.pending -= 1
+        return True
+
+    def _submit(self, job):
+        job.func.last_run = time.time()
+        try:
+            queued = self.submit(job.func)
+        except Exception:
+            logger.exception('failed to submit job "%s"', job.func.__name__)
+            self.job_done(job.func)
+            return
+        if queued is False:
+            logger.warning('job "%s" dropped by the full task queue',
+                           job.func.__name__)
+            self.job_done(job.func)
+
+    def job_done(self, func):
+        """Tell the scheduler the run of ``func`` it submitted is over."""
+        with self._cond:
+            job = self._jobs.get(func)
+            if job is None:
+                return
+            job.running = False
+            start = self._start(job)
+        if start:
+            self._submit(job)
@@ -15,6 +15,117 @@ Setup timeout for slacker API requests (e.g. uploading a file).
 '''
 TIMEOUT = 100
 
+'''
+Base URL of the Slack Web API, to run the bot against a local stand-in such
+as tests/fakeslack.py. None for https://slack.com/api/.
+'''
+SLACK_API_URL = None
+
+'''
+The bot only keeps the fields of the users and channels it needs (ids, names,
+a few flags) in memory. Other fields, like a user's 'profile', are fetched
+from Slack when a plugin first reads them. List the fields your plugins use
+in USER_FIELDS and CHANNEL_FIELDS to keep them as well, or use ['*'] to keep
+the complete records.
+'''
+USER_FIELDS = []
+CHANNEL_FIELDS = []
+
+'''
+The users and channels are downloaded when the bot starts, then kept up to date
+by the change events. Reconnecting only downloads them again once they are
+older than DIRECTORY_TTL seconds, in the background. Set DIRECTORY_CACHE to the
+path of a SQLite file to keep them on disk: the bot then starts from there
+right away, without waiting for the download.
+'''
+DIRECTORY_CACHE = None
+DIRECTORY_TTL = 3600
+
+'''
+With DIRECTORY_MODE = 'lazy', nothing is downloaded at startup: users and
+channels are fetched (users.info, conversations.info) when first referenced,
+and at most DIRECTORY_SIZE of each are kept. Only the ones fetched already can
+be found by name. DIRECTORY_CACHE is not used in this mode.
+'''
+DIRECTORY_MODE = 'full'
+DIRECTORY_SIZE = 10000
+
+'''
+With SEND_QUEUE, the messages sent by the plugins are queued and posted by a
+few sender threads, at most SEND_RATE per second to each channel (Slack allows
+about one), instead of blocking the plugin while Slack rate limits it. The
+send methods then return a concurrent.futures.Future of the result. With
+SEND_COALESCE, consecutive plain messages to the same channel and thread which
+queued up are posted as one.
+'''
+SEND_QUEUE = False
+SEND_RATE = 1
+SEND_COALESCE = False
+
+'''
+Pace the Web API calls to Slack's rate limits before making them: each method
+at the rate of its tier, and chat.postMessage at SEND_RATE messages per second
+per channel. Calls exceeding the budget wait for it, in whichever thread made them.
+'''
+RATE_LIMIT = True
+
+'''
+How the bot receives the events of the workspace:
+- 'rtm': over the RTM websocket (the default);
+- 'socket_mode': over SOCKET_MODE_CONNECTIONS Socket Mode websockets, opened
+  with the app level token SLACK_APP_TOKEN (xapp-...);
+- 'events_api': from the Events API requests Slack sends to
+  http://EVENTS_API_ADDR:EVENTS_API_PORT/EVENTS_API_PATH, signed with the
+  app's SIGNING_SECRET. Slack must reach it over HTTPS, e.g. through a
+  reverse proxy, which may spread the requests over several bots. Without
+  SIGNING_SECRET the bot won't start, unless EVENTS_API_INSECURE is set to
+  accept unauthenticated requests.
+Without RTM, the messages are sent with the Web API.
+'''
+TRANSPORT = 'rtm'
+SLACK_APP_TOKEN = None
+SOCKET_MODE_CONNECTIONS = 2
+SIGNING_SECRET = None
+EVENTS_API_ADDR = '127.0.0.1'
+EVENTS_API_PORT = 3000
+EVENTS_API_PATH = '/slack/events'
+EVENTS_API_INSECURE = False
+
+'''
+Serve several workspaces from one process: a list of dicts, one per
+workspace, with its 'name' (used in the logs and metrics) and the settings
+which differ from the ones here, e.g.
+
+WORKSPACES = [
+    {'name': 'acme', 'API_TOKEN': 'xoxb-...'},
+    {'name': 'globex', 'API_TOKEN': 'xoxb-...', 'ERRORS_TO': 'bots'},
+]
+
+The plugins are loaded once, and the workspaces share the worker pool, which
+takes their messages in turn, so that a busy workspace doesn't hold up the
+others. Needs the 'poll' or 'select' EVENT_LOOP.
+'''
+WORKSPACES = None
+
+'''
+Split the bot over several processes or machines. The 'ingest' node
+receives the events (with any TRANSPORT) and publishes them to the event
+queue; 'worker' nodes, which don't connect to the RTM api, consume them, run
+the plugins and send the replies with the Web API. The run_at_times plugins
+run on the ingest node. None runs everything in this process.
+
+The queue has EVENT_QUEUE_PARTITIONS partitions, each to be consumed by one
+worker: list the ones this worker consumes in WORKER_PARTITIONS (all of them
+by default). The messages of a channel go to the same partition, in order.
+EVENT_QUEUE is 'file', a queue kept in the EVENT_QUEUE_PATH directory, or an
+instance of slackbot.cluster.EventQueue for other backends.
+'''
+NODE_ROLE = None
+EVENT_QUEUE = 'file'
+EVENT_QUEUE_PATH = None
+EVENT_QUEUE_PARTITIONS = 8
+WORKER_PARTITIONS = None
+
 # API_TOKEN = '###token###'
 
 '''
@@ -41,6 +152,62 @@ effect.
 '''Specify a different reply when the bot is messaged with no matching cmd'''
 DEFAULT_REPLY = None
 
+'''
+How the RTM websocket is read. 'poll' reads it once a second; 'select' blocks
+on the socket readiness and dispatches incoming messages as they arrive;
+'asyncio' runs the dispatcher on an asyncio event loop, where `async def`
+plugins run as tasks and regular plugins on a thread pool executor.
+'''
+EVENT_LOOP = 'poll'
+
+'''
+Messages are handled by a pool of worker threads. With the 'shared' pool
+they are picked from a single queue, possibly out of order. The 'sharded'
+pool handles the messages of a channel (or, with WORKER_SHARD_KEY = 'thread',
+of a thread) one at a time and in order, and serves busy channels round robin
+so that they can't starve the others. None picks 'sharded' on worker nodes
+(see NODE_ROLE), to keep the order of the event queue, and 'shared' otherwise.
+'''
+WORKER_POOL = None
+WORKER_SHARD_KEY = 'channel'
+
+'''
+The shared pool queues messages in priority lanes: respond_to first, then
+direct messages, run_at_times calls and finally listen_to. QUEUE_MAXSIZE bounds
+the number of queued messages (0 for no limit), and QUEUE_OVERFLOW decides what
+happens when the queue is full: 'block' the reader until there is room,
+'drop_oldest' queued message or 'drop_listen_to' messages first, then the
+lowest priority ones. Dropped messages are counted per lane.
+'''
+QUEUE_MAXSIZE = 0
+QUEUE_OVERFLOW = 'block'
+
+'''
+The shared pool runs between WORKER_MIN and WORKER_MAX threads. It grows while
+messages wait more than WORKER_SCALE_WAIT seconds in the queue, also when all
+the workers are stuck in slow plugins, and threads
+above WORKER_MIN retire after WORKER_IDLE_TIMEOUT idle seconds. The sharded
+pool and the asyncio executor use WORKER_MAX threads.
+'''
+WORKER_MIN = 10
+WORKER_MAX = 20
+WORKER_SCALE_WAIT = 0.5
+WORKER_IDLE_TIMEOUT = 60
+
+'''
+Number of processes running the plugins registered with executor='process'.
+Defaults to the number of CPUs.
+'''
+PROCESS_WORKERS = None
+
+'''
+Serve the bot metrics (events received, queue wait, match time, plugin and
+Web API latencies, errors, ...) in the Prometheus text format on
+http://METRICS_ADDR:METRICS_PORT/metrics. Disabled when METRICS_PORT is None.
+'''
+METRICS_PORT = None
+METRICS_ADDR = '127.0.0.1'
+
 for key in os.environ:
     if key[:9] == 'SLACKBOT_':
         name = key[9:]
@@ -1,47 +1,196 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function, absolute_import
+import asyncio
+import functools
 import os
 import json
 import logging
+import queue
+import threading
 import time
 from ssl import SSLError
+from urllib.parse import urlsplit
 
 import slack_sdk
+from slack_sdk.errors import SlackApiError
 from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 
 from websocket import (
-    create_connection, WebSocketException, WebSocketConnectionClosedException
+    ABNF, create_connection, WebSocketException,
+    WebSocketConnectionClosedException
 )
 
-from slackbot.utils import get_http_proxy
+from slackbot import metrics
+from slackbot.dircache import DirectoryCache
+from slackbot.directory import (
+    CHANNEL_FIELDS, CHANNEL_ID_PREFIXES, USER_FIELDS, USER_ID_PREFIXES,
+    Directory, LazyDirectory
+)
+from slackbot.outbox import Outbox
+from slackbot.ratelimit import CHANNEL_RATES, RateLimiter
+from slackbot.utils import (
+    CircuitBreaker, SingleFlight, backoff_delay, get_http_proxy
+)
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
+WEBAPI_TIME = metrics.Histogram('slackbot_webapi_seconds',
+                                'Slack Web API call latency', ['method'])
+WEBAPI_ERRORS = metrics.Counter('slackbot_webapi_errors_total',
+                                'Failed Slack Web API calls', ['method'])
+RECONNECTS = metrics.Counter('slackbot_reconnects_total',
+                             'RTM reconnection attempts', ['result'])
+CIRCUIT_STATES = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN,
+                  CircuitBreaker.OPEN)
+CIRCUIT_STATE = metrics.Gauge(
+    'slackbot_rtm_circuit_state',
+    'State of the RTM reconnection circuit breaker: 0 closed, 1 half open, '
+    '2 open', ['workspace'])
+
+
+def _timed_api_call(api_call):
+    @functools.wraps(api_call)
+    def timed(api_method, **kwargs):
+        started = time.perf_counter()
+        try:
+            return api_call(api_method, **kwargs)
+        except Exception:
+            WEBAPI_ERRORS.inc(api_method)
+            raise
+        finally:
+            WEBAPI_TIME.observe(time.perf_counter() - started, api_method)
+    return timed
+
+
+def _async_timed_api_call(api_call):
+    @functools.wraps(api_call)
+    async def timed(api_method, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await api_call(api_method, **kwargs)
+        except Exception:
+            WEBAPI_ERRORS.inc(api_method)
+            raise
+        finally:
+            WEBAPI_TIME.observe(time.perf_counter() - started, api_method)
+    return timed
+
+
+def _call_channel(kwargs):
+    for args in (kwargs.get('json'), kwargs.get('params'), kwargs.get('data')):
+        if isinstance(args, dict) and args.get('channel'):
+            return args['channel']
+    return None
+
+
+def _paced_api_call(api_call, limiter):
+    @functools.wraps(api_call)
+    def paced(api_method, **kwargs):
+        limiter.acquire(api_method, _call_channel(kwargs))
+        return api_call(api_method, **kwargs)
+    return paced
+
+
+def _async_paced_api_call(api_call, limiter):
+    @functools.wraps(api_call)
+    async def paced(api_method, **kwargs):
+        delay = limiter.delay(api_method, _call_channel(kwargs))
+        if delay:
+            await asyncio.sleep(delay)
+        return await api_call(api_method, **kwargs)
+    return paced
+
 
 class SlackClient(object):
+    MAX_FRAMES_PER_READ = 100
+
     def __init__(self, token, timeout=None, bot_icon=None, bot_emoji=None, connect=True,
-                 rtm_start_args=None):
+                 rtm_start_args=None, base_url=None, user_fields=(),
+                 channel_fields=(), directory_cache=None, directory_ttl=3600,
+                 directory_mode='full', directory_size=10000, send_queue=False,
+                 send_rate=1.0, send_coalesce=False, rate_limit=True,
+                 workspace=None):
         self.token = token
+        # labels the metrics of the client, the team's domain by default
+        self.workspace = workspace
         self.bot_icon = bot_icon
         self.bot_emoji = bot_emoji
         self.username = None
         self.domain = None
         self.login_data = None
         self.websocket = None
-        self.users = {}
-        self.channels = {}
+        if directory_mode not in ('full', 'lazy'):
+            raise ValueError('Unknown directory mode {!r}'.format(directory_mode))
+        # in lazy mode, the users and channels are only fetched when first
+        # looked up, and the least recently used are dropped
+        self.directory_mode = directory_mode
+        if directory_mode == 'lazy':
+            directory = functools.partial(LazyDirectory, capacity=directory_size)
+        else:
+            # all of them; the ones missed while disconnected are only
+            # fetched when asked for by id (see get_user and get_channel)
+            directory = Directory
+        self._users = directory(
+            keys=('name',), fields=self._fields(USER_FIELDS, user_fields),
+            id_prefixes=USER_ID_PREFIXES,
+            loader=lambda id: self.webapi.users_info(user=id)['user'])
+        # direct message channels have no name but are indexed by user
+        self._channels = directory(
+            keys=('name', 'user'),
+            fields=self._fields(CHANNEL_FIELDS, channel_fields),
+            id_prefixes=CHANNEL_ID_PREFIXES,
+            loader=lambda id: self.webapi.conversations_info(
+                channel=id)['channel'])
+        # the directory is kept up to date by the change events, and only
+        # downloaded again once older than directory_ttl seconds
+        self.directory_ttl = directory_ttl
+        self.directory_updated = None
+        self._directory_cache = None
+        if directory_cache:
+            self._directory_cache = DirectoryCache(directory_cache)
+        self._refreshing = threading.Lock()
+        # paces the Web API calls to Slack's rate limits
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = RateLimiter(channel_rates=dict(
+                CHANNEL_RATES, **{'chat.postMessage': send_rate}))
+        self.directory_timings = None
+        self.circuit = CircuitBreaker(on_change=self._circuit_changed)
         self.dm_channels = {}  # map user id to direct message channel id
+        self._dm_flights = SingleFlight()
         self.connected = False
+        # logged in with web_connect, without a websocket to send on
+        self.webapi_only = False
         self.rtm_start_args = rtm_start_args
-
-        if timeout is None:
-            self.webapi = slack_sdk.WebClient(self.token)
-        else:
-            self.webapi = slack_sdk.WebClient(self.token, timeout=timeout)
+        self._async_webapi = None
+        # messages go through the outbox, which paces them per channel with
+        # the rate limiter's budget
+        self.outbox = None
+        if send_queue:
+            self.outbox = Outbox(rate=send_rate, coalesce=send_coalesce,
+                                 limiter=self.rate_limiter).start()
+
+        webapi_args = {}
+        if timeout is not None:
+            webapi_args['timeout'] = timeout
+        if base_url is not None:
+            webapi_args['base_url'] = base_url
+        self.webapi = slack_sdk.WebClient(self.token, **webapi_args)
+
+        self.webapi.api_call = _timed_api_call(self.webapi.api_call)
+        if self.rate_limiter is not None:
+            self.webapi.api_call = _paced_api_call(self.webapi.api_call,
+                                                   self.rate_limiter)
 
         rate_limit_handler = RateLimitErrorRetryHandler(max_retry_count=100)
-        # Enable rate limited error retries
+        # Enable rate limited error retries, for the limits the rate limiter
+        # doesn't know about
         self.webapi.retry_handlers.append(rate_limit_handler)
 
         if connect:
@@ -51,24 +200,68 @@ class SlackClient(object):
         reply = self.webapi.rtm_connect()
         self.parse_slack_login_data(reply)
         self.connected = True
+        self._circuit_changed(self.circuit.state)
+
+    def _circuit_changed(self, state):
+        CIRCUIT_STATE.set(CIRCUIT_STATES.index(state),
+                          self.workspace or self.domain or '')
+
+    def web_connect(self):
+        """
+        Log in without opening the RTM websocket, for the bots receiving the
+        events from another transport (see slackbot.transports). Messages
+        are then sent with the Web API.
+        """
+        auth = self.webapi.auth_test()
+        # https://<domain>.slack.com/
+        domain = (urlsplit(auth.get('url') or '').hostname or '').split('.')[0]
+        self.login_data = {
+            'self': {'id': auth['user_id'], 'name': auth['user']},
+            'team': {'id': auth['team_id'], 'name': auth.get('team'),
+                     'domain': domain},
+        }
+        self.domain = domain
+        self.username = auth['user']
+        self.webapi_only = True
+        self._sync_directory()
+        self.connected = True
 
     def reconnect(self):
+        """
+        Open a new websocket, retrying with exponential backoff and jitter.
+        After repeated failures the circuit breaker opens, and only lets an
+        attempt through every minute until one succeeds.
+
+        The directory is kept: the users and channels missed meanwhile are
+        resolved when first referenced, and the whole directory is only
+        downloaded again (in the background) once older than directory_ttl.
+        """
+        attempt = 0
+        # don't reconnect in lockstep with every other bot Slack dropped
+        time.sleep(backoff_delay(0))
         while True:
+            wait = self.circuit.retry_in()
+            if wait:
+                time.sleep(wait)
             try:
                 self.rtm_connect()
+            except Exception as e:
+                RECONNECTS.inc('failure')
+                self.circuit.failure()
+                delay = backoff_delay(attempt)
+                attempt += 1
+                logger.exception('failed to reconnect (attempt %d), retrying '
+                                 'in %.1fs: %s', attempt, delay, e)
+                time.sleep(delay)
+            else:
+                RECONNECTS.inc('success')
+                self.circuit.success()
                 logger.warning('reconnected to slack rtm websocket')
                 return
-            except Exception as e:
-                logger.exception('failed to reconnect: %s', e)
-                time.sleep(5)
-
-    def parse_slack_login_data(self, login_data):
-        self.login_data = login_data
-        self.domain = self.login_data['team']['domain']
-        self.username = self.login_data['self']['name']
 
+    def _connect_websocket(self):
         proxy, proxy_port, no_proxy = get_http_proxy(os.environ)
-        
+
         self.websocket = create_connection(
             self.login_data['url'],
             http_proxy_host=proxy,
@@ -78,19 +271,163 @@ class SlackClient(object):
 
         self.websocket.sock.setblocking(0)
 
-        logger.debug('Getting users')
-        for page in self.webapi.users_list(limit=1000):
-            self.parse_user_data(page['members'])
-        logger.debug('Getting channels')
-        for page in self.webapi.conversations_list(
-                exclude_archived=True,
-                types="public_channel,private_channel,im,mpim",
-                limit=1000
-        ):
-            self.parse_channel_data(page['channels'])
+    def parse_slack_login_data(self, login_data):
+        self.login_data = login_data
+        self.domain = self.login_data['team']['domain']
+        self.username = self.login_data['self']['name']
+
+        self._connect_websocket()
+        self._sync_directory()
+
+    def _sync_directory(self):
+        if self.directory_mode == 'lazy':
+            return
+        if self.directory_updated is None:
+            self._load_directory_cache()
+        if self.directory_updated is None:
+            # nothing to start from, the bot needs the directory right away
+            self.refresh_directory()
+        elif time.time() - self.directory_updated > self.directory_ttl:
+            threading.Thread(target=self.refresh_directory, daemon=True,
+                             name='directory-refresh').start()
+
+    def _directory_fields(self):
+        return {'users': self.users.fields, 'channels': self.channels.fields}
+
+    def _load_directory_cache(self):
+        if self._directory_cache is None:
+            return
+        started = time.time()
+        try:
+            snapshot = self._directory_cache.load(
+                self.login_data['team'].get('id'), self._directory_fields())
+        except Exception:
+            logger.exception('failed to load the directory cache')
+            return
+        if snapshot is None:
+            return
+        saved_at, users, channels = snapshot
+        self.users.update((u['id'], u) for u in users)
+        self._parse_channel_data(channels)
+        self.directory_updated = saved_at
+        logger.info('loaded %d users and %d channels from the directory '
+                    'cache in %.2fs', len(users), len(channels),
+                    time.time() - started)
+
+    def _list_pages(self, kind, method, key, kwargs, pages, timings):
+        """Fetch every page of the listing ``method`` onto ``pages``, each
+        as soon as the cursor of the previous one is known."""
+        cursor = None
+        try:
+            while True:
+                started = time.perf_counter()
+                page = getattr(self.webapi, method)(
+                    limit=1000, cursor=cursor, **kwargs)
+                wait = (self.rate_limiter.last_wait()
+                        if self.rate_limiter is not None else 0)
+                timings['wait'] += wait
+                timings['fetch'] += time.perf_counter() - started - wait
+                timings['pages'] += 1
+                pages.put((kind, page[key]))
+                cursor = (page.get('response_metadata') or {}).get('next_cursor')
+                if not cursor:
+                    break
+            pages.put((kind, None))
+        except Exception as e:
+            pages.put((kind, e))
+
+    def refresh_directory(self):
+        """
+        Download every user and channel of the workspace. Both listings are
+        fetched concurrently while the pages received are parsed, so this
+        takes about as long as the slower listing.
+        """
+        if not self._refreshing.acquire(False):
+            return
+        try:
+            started = time.perf_counter()
+            listings = {
+                'users': ('users_list', 'members', {}),
+                'channels': ('conversations_list', 'channels', dict(
+                    exclude_archived=True,
+                    types="public_channel,private_channel,im,mpim")),
+            }
+            parse = {'users': self.parse_user_data,
+                     'channels': self.parse_channel_data}
+            pages = queue.Queue()
+            ids = {}
+            timings = {}
+            for kind, (method, key, kwargs) in listings.items():
+                ids[kind] = []
+                timings[kind] = dict(pages=0, wait=0, fetch=0, parse=0, total=0)
+                threading.Thread(
+                    target=self._list_pages, daemon=True,
+                    name='directory-{}'.format(kind),
+                    args=(kind, method, key, kwargs, pages, timings[kind])).start()
+
+            remaining = len(listings)
+            while remaining:
+                kind, page = pages.get()
+                if page is None:
+                    remaining -= 1
+                    timings[kind]['total'] = time.perf_counter() - started
+                    continue
+                if isinstance(page, Exception):
+                    raise page
+                parse_started = time.perf_counter()
+                parse[kind](page)
+                ids[kind].extend(r['id'] for r in page)
+                timings[kind]['parse'] += time.perf_counter() - parse_started
+
+            self.directory_updated = time.time()
+            self.directory_timings = timings
+            logger.info('got the directory in %.2fs: %s',
+                        time.perf_counter() - started, '; '.join(
+                            '{} {} in {pages} pages, {total:.2f}s (waited '
+                            '{wait:.2f}s, fetched {fetch:.2f}s, parsed '
+                            '{parse:.2f}s)'.format(len(ids[k]), k, **timings[k])
+                            for k in listings))
+            if self._directory_cache is not None:
+                self._directory_cache.saved(self.login_data['team'].get('id'),
+                                            self._directory_fields(), ids)
+        except Exception:
+            if self.directory_updated is None:
+                raise
+            logger.exception('failed to refresh the directory')
+        finally:
+            self._refreshing.release()
+
+    @staticmethod
+    def _fields(fields, extra_fields):
+        if isinstance(extra_fields, str):
+            extra_fields = [f.strip() for f in extra_fields.split(',')]
+        # '*' keeps the complete records
+        if '*' in extra_fields:
+            return None
+        return fields + tuple(f for f in extra_fields if f)
+
+    @property
+    def users(self):
+        return self._users
+
+    @users.setter
+    def users(self, users):
+        self._users = self._users.replaced(users)
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @channels.setter
+    def channels(self, channels):
+        self._channels = self._channels.replaced(channels)
 
     def parse_channel_data(self, channel_data):
         logger.debug('Adding %d channels', len(channel_data))
+        self._parse_channel_data(channel_data)
+        self._cache_update('channels', channel_data)
+
+    def _parse_channel_data(self, channel_data):
         self.channels.update({c['id']: c for c in channel_data})
         # pre-load direct message channels
         for c in channel_data:
@@ -100,6 +437,17 @@ class SlackClient(object):
     def parse_user_data(self, user_data):
         logger.debug('Adding %d users', len(user_data))
         self.users.update({u['id']: u for u in user_data})
+        self._cache_update('users', user_data)
+
+    def _cache_update(self, kind, records):
+        if self._directory_cache is None:
+            return
+        directory = getattr(self, kind)
+        try:
+            self._directory_cache.update(
+                kind, [directory[r['id']] for r in records])
+        except Exception:
+            logger.exception('failed to update the directory cache')
 
     def send_to_websocket(self, data):
         """Send (data) directly to the websocket."""
@@ -107,56 +455,102 @@ class SlackClient(object):
         return self.websocket.send(data)
 
     def ping(self):
-        self.send_to_websocket({'type': 'ping'})
-
-    def websocket_safe_read(self):
-        """Returns data if available, otherwise ''. Newlines indicate multiple messages """
-        data = ''
-        while True:
+        if self.websocket is not None:
+            self.send_to_websocket({'type': 'ping'})
+
+    def _recv_frames(self, max_frames=None, reconnect=True):
+        """Yields the frames waiting on the websocket, at most max_frames.
+        Reconnects when the connection is lost, or raises
+        SlackConnectionError without ``reconnect``."""
+        count = 0
+        while max_frames is None or count < max_frames:
             try:
-                data += '{0}\n'.format(self.websocket.recv())
+                # the raw payload, the json decoder doesn't need a str copy
+                opcode, frame = self.websocket.recv_data()
             except WebSocketException as e:
                 if isinstance(e, WebSocketConnectionClosedException):
                     logger.warning('lost websocket connection, try to reconnect now')
                 else:
                     logger.warning('websocket exception: %s', e)
+                if not reconnect:
+                    raise SlackConnectionError(e)
                 self.reconnect()
+                continue
             except Exception as e:
                 if isinstance(e, SSLError) and e.errno == 2:
                     pass
+                elif isinstance(e, BlockingIOError):
+                    # same as above, over a plain ws:// connection
+                    pass
                 else:
                     logger.warning('Exception in websocket_safe_read: %s', e)
-                return data.rstrip()
+                return
+            count += 1
+            if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY) and frame:
+                yield frame
 
-    def rtm_read(self):
-        json_data = self.websocket_safe_read()
-        data = []
-        if json_data != '':
-            for d in json_data.split('\n'):
-                data.append(json.loads(d))
-        return data
+    def websocket_safe_read(self):
+        """Returns data if available, otherwise ''. Newlines indicate multiple messages """
+        return '\n'.join(frame.decode('utf-8') if isinstance(frame, bytes)
+                         else frame for frame in self._recv_frames())
+
+    def rtm_read(self, max_frames=None, reconnect=True):
+        """
+        Yields the events received on the websocket, decoding them one frame
+        at a time. Reads at most max_frames (MAX_FRAMES_PER_READ by default)
+        frames, so that a burst of events can't hold up the caller's loop;
+        the rest is left for the next read.
+
+        A lost connection is reopened right away, which may take a while
+        (see :meth:`reconnect`); without ``reconnect``, SlackConnectionError
+        is raised instead, for the caller to reconnect when it suits it.
+        """
+        for frame in self._recv_frames(max_frames or self.MAX_FRAMES_PER_READ,
+                                       reconnect):
+            try:
+                yield json_loads(frame)
+            except ValueError:
+                logger.warning('ignoring malformed rtm frame: %r', frame[:200])
 
     def rtm_send_message(self, channel, message, attachments=None, thread_ts=None):
+        """
+        Send a message over the websocket. With the outbox, returns a
+        :class:`concurrent.futures.Future` of the message being sent.
+        """
+        if self.webapi_only:
+            return self.send_message(channel, message, attachments=attachments,
+                                     thread_ts=thread_ts)
         channel = self._channelify(channel)
-        message_json = {
-            'type': 'message',
-            'channel': channel,
-            'text': message,
-            'attachments': attachments,
-            'thread_ts': thread_ts,
-            'unfurl_links': False,
-            'unfurl_media': False,
-            }
-        return self.send_to_websocket(message_json)
+
+        def send(text):
+            message_json = {
+                'type': 'message',
+                'channel': channel,
+                'text': text,
+                'attachments': attachments,
+                'thread_ts': thread_ts,
+                'unfurl_links': False,
+                'unfurl_media': False,
+                }
+            return self.send_to_websocket(message_json)
+
+        if self.outbox is None:
+            return send(message)
+        return self.outbox.put(channel, send, message, group=(
+            None if attachments else ('rtm', channel, thread_ts)))
 
     def upload_file(self, channel, fname, fpath, comment, thread_ts=None):
+        return self.webapi.files_upload(**self._upload_file_args(
+            channel, fname, fpath, comment, thread_ts))
+
+    def _upload_file_args(self, channel, fname, fpath, comment, thread_ts):
         channel = self._channelify(channel)
         fname = fname or os.path.basename(fpath)
-        return self.webapi.files_upload(fpath,
-                                 channels=channel,
-                                 filename=fname,
-                                 initial_comment=comment,
-                                 thread_ts=thread_ts)
+        return dict(file=fpath,
+                    channels=channel,
+                    filename=fname,
+                    initial_comment=comment,
+                    thread_ts=thread_ts)
 
     def upload_content(self, channel, fname, content, comment, thread_ts=None):
         return self.webapi.files_upload(None,
@@ -166,12 +560,29 @@ class SlackClient(object):
                                  initial_comment=comment,
                                  thread_ts=thread_ts)
 
-   
     def send_message(
         self, channel, message, attachments=None, blocks=None, as_user=True, thread_ts=None
     ):
+        """
+        Post a message with the Web API. With the outbox, returns a
+        :class:`concurrent.futures.Future` of Slack's response.
+        """
+        kwargs = self._post_message_args(
+            channel, message, attachments, blocks, as_user, thread_ts)
+        if self.outbox is None:
+            return self.webapi.chat_postMessage(**kwargs)
+
+        def send(text):
+            return self.webapi.chat_postMessage(**dict(kwargs, text=text))
+
+        return self.outbox.put(kwargs['channel'], send, message, group=(
+            None if attachments or blocks
+            else ('chat.postMessage', kwargs['channel'], thread_ts, as_user)))
+
+    def _post_message_args(self, channel, message, attachments, blocks, as_user,
+                           thread_ts):
         channel = self._channelify(channel)
-        return self.webapi.chat_postMessage(
+        return dict(
             channel=channel,
             text=message,
             username=self.login_data['self']['name'],
@@ -185,47 +596,157 @@ class SlackClient(object):
             unfurl_media=False
         )
 
+    @property
+    def async_webapi(self):
+        """
+        slack_sdk AsyncWebClient sharing this client's token, or None when
+        its aiohttp dependency is not installed.
+        """
+        if self._async_webapi is None:
+            try:
+                from slack_sdk.web.async_client import AsyncWebClient
+            except ImportError:
+                return None
+            self._async_webapi = AsyncWebClient(self.token,
+                                                timeout=self.webapi.timeout,
+                                                base_url=self.webapi.base_url)
+            self._async_webapi.api_call = _async_timed_api_call(
+                self._async_webapi.api_call)
+            if self.rate_limiter is not None:
+                self._async_webapi.api_call = _async_paced_api_call(
+                    self._async_webapi.api_call, self.rate_limiter)
+        return self._async_webapi
+
+    async def async_api_call(self, method, **kwargs):
+        """
+        Call a Web API ``method`` (e.g. 'chat_postMessage') from a coroutine,
+        with the async Web API client when aiohttp is available and on the
+        event loop's executor otherwise.
+        """
+        if self.async_webapi is not None:
+            return await getattr(self.async_webapi, method)(**kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(getattr(self.webapi, method), **kwargs))
+
+    async def async_send_message(
+        self, channel, message, attachments=None, blocks=None, as_user=True, thread_ts=None
+    ):
+        if self.outbox is not None:
+            return await asyncio.wrap_future(self.send_message(
+                channel, message, attachments, blocks, as_user, thread_ts))
+        return await self.async_api_call('chat_postMessage', **self._post_message_args(
+            channel, message, attachments, blocks, as_user, thread_ts))
+
+    async def async_upload_file(self, channel, fname, fpath, comment, thread_ts=None):
+        return await self.async_api_call('files_upload', **self._upload_file_args(
+            channel, fname, fpath, comment, thread_ts))
+
+    async def async_open_dm_channel(self, user_id):
+        channel_id = self._cached_dm_channel(user_id)
+        if channel_id is not None:
+            return channel_id
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_dm_channel, user_id)
+
     def get_channel(self, channel_id):
-        return Channel(self, self.channels[channel_id])
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels.resolve(channel_id)
+            if channel is None:
+                raise KeyError(channel_id)
+        return Channel(self, channel)
+
+    def _cached_dm_channel(self, user_id):
+        channel_id = self.dm_channels.get(user_id)
+        if channel_id is None:
+            channel_id = self.channels.lookup('user', user_id)
+            if channel_id is not None:
+                self.dm_channels[user_id] = channel_id
+        return channel_id
 
     def get_dm_channel(self, user_id):
         """Get the direct message channel for the given user id, opening
-        one if necessary."""
-        if user_id not in self.users:
+        one if necessary. The channels are remembered (across reconnections),
+        and concurrent calls for the same user share one conversations.open."""
+        channel_id = self._cached_dm_channel(user_id)
+        if channel_id is not None:
+            return channel_id
+
+        if self.get_user(user_id) is None:
             raise ValueError("Expected valid user_id, have no user '%s'" % (
                 user_id,))
-
-        if user_id in self.dm_channels:
-            return self.dm_channels[user_id]
-
-        # open a new channel
-        resp = self.webapi.conversations_open(users=[user_id])["channel"]["id"]
-        if not resp.body["ok"]:
-            raise ValueError("Could not open DM channel: %s" % resp.body)
-
+        return self._dm_flights.do(user_id,
+                                   lambda: self._open_dm_channel(user_id))
+
+    def _open_dm_channel(self, user_id):
+        try:
+            resp = self.webapi.conversations_open(users=[user_id])
+        except SlackApiError as e:
+            raise ValueError("Could not open DM channel: %s" % (e.response.data,))
         self.dm_channels[user_id] = resp['channel']['id']
-
         return self.dm_channels[user_id]
 
     def open_dm_channel(self, user_id):
-        return self.webapi.conversations_open(users=[user_id])["channel"]["id"]
+        return self.get_dm_channel(user_id)
 
     def find_channel_by_name(self, channel_name):
-        for channel_id, channel in self.channels.items():
-            try:
-                name = channel['name']
-            except KeyError:
-                name = self.users[channel['user']]['name']
-            if name == channel_name:
-                return channel_id
+        channel_id = self.channels.lookup('name', channel_name)
+        if channel_id is None:
+            # direct message channels go by the name of the user
+            channel_id = self.channels.lookup(
+                'user', self.users.lookup('name', channel_name))
+        return channel_id
+
+    def find_channel(self, name):
+        """
+        Id of the channel ``name`` stands for: a channel id or name, or a
+        user id or name for the direct message channel with them, or None.
+        Unlike find_channel_by_name, what the directory doesn't hold (e.g. in
+        lazy mode) is looked up with the Web API, going through the whole
+        listings for a name, so this is meant for the settings read at
+        startup.
+        """
+        channel_id = self.find_channel_by_name(name)
+        if channel_id is not None:
+            return channel_id
+        if self.channels.resolve(name) is not None:
+            return name
+        if self.users.resolve(name) is not None:
+            return self.get_dm_channel(name)
+        for channel in self._scan('conversations_list', 'channels',
+                                  exclude_archived=True,
+                                  types='public_channel,private_channel'):
+            if channel.get('name') == name:
+                self.channels[channel['id']] = channel
+                return channel['id']
+        for user in self._scan('users_list', 'members'):
+            if user.get('name') == name:
+                self.users[user['id']] = user
+                return self.get_dm_channel(user['id'])
+        return None
+
+    def _scan(self, method, key, **kwargs):
+        """The records of the listing ``method``, page by page."""
+        cursor = None
+        while True:
+            page = getattr(self.webapi, method)(limit=1000, cursor=cursor,
+                                                **kwargs)
+            for record in page[key]:
+                yield record
+            cursor = (page.get('response_metadata') or {}).get('next_cursor')
+            if not cursor:
+                return
 
     def get_user(self, user_id):
-        return self.users.get(user_id)
+        user = self.users.get(user_id)
+        if user is None:
+            # e.g. joined while the bot was disconnected
+            user = self.users.resolve(user_id)
+        return user
 
     def find_user_by_name(self, username):
-        for userid, user in self.users.items():
-            if user['name'] == username:
-                return userid
+        return self.users.lookup('name', username)
 
     def react_to_message(self, emojiname, channel, timestamp):
         self.webapi.reactions_add(
@@ -257,6 +778,12 @@ class SlackClient(object):
         if user_id:
             return self.get_dm_channel(user_id)
 
+        # an id the directory missed
+        if self.channels.resolve(s) is not None:
+            return s
+        if self.users.resolve(s) is not None:
+            return self.get_dm_channel(s)
+
         raise ValueError("Could not turn '%s' into any kind of channel name" % (
             user_id))
 
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Ways of receiving the events of the workspace other than the RTM websocket of
+:class:`~slackbot.slackclient.SlackClient` (see the TRANSPORT setting):
+
+* :class:`SocketModeTransport` keeps several Socket Mode websockets open, and
+  Slack spreads the events over them;
+* :class:`EventsAPITransport` receives the Events API requests over HTTP, so
+  that any number of bots behind a load balancer can share them.
+
+Both hand the events, which have the same shape as the RTM ones, to the
+dispatcher (see :meth:`~slackbot.dispatcher.MessageDispatcher.transport_loop`).
+"""
+
+from __future__ import absolute_import
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import slack_sdk
+from websocket import ABNF, create_connection, WebSocketException
+
+from slackbot import metrics
+from slackbot.utils import backoff_delay, get_http_proxy
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT_EVENTS = metrics.Counter('slackbot_transport_events_total',
+                                   'Events received', ['transport'])
+TRANSPORT_DUPLICATES = metrics.Counter(
+    'slackbot_transport_duplicates_total',
+    'Events Slack delivered again, and which were ignored', ['transport'])
+SOCKET_MODE_CONNECTIONS = metrics.Gauge('slackbot_socket_mode_connections',
+                                        'Open Socket Mode connections')
+
+
+class Transport(object):
+    """
+    Receives events and passes each of them once to the handler, even when
+    Slack delivers it again (e.g. after a lost acknowledgement). The last
+    ``dedupe_size`` event ids are remembered.
+    """
+
+    name = None
+
+    def __init__(self, dedupe_size=1000):
+        self.handler = None
+        self.dedupe_size = dedupe_size
+        self._seen = collections.OrderedDict()
+        self._seen_lock = threading.Lock()
+
+    def start(self, handler):
+        """Start receiving events, calling ``handler(event)`` for each of
+        them from the transport's threads."""
+        self.handler = handler
+
+    def stop(self):
+        pass
+
+    def _deliver(self, event_id, event):
+        if not event:
+            return
+        if event_id is not None:
+            with self._seen_lock:
+                if event_id in self._seen:
+                    TRANSPORT_DUPLICATES.inc(self.name)
+                    logger.debug('ignoring event %s, received already', event_id)
+                    return
+                self._seen[event_id] = True
+                while len(self._seen) > self.dedupe_size:
+                    self._seen.popitem(last=False)
+        TRANSPORT_EVENTS.inc(self.name)
+        self.handler(event)
+
+
+class SocketModeTransport(Transport):
+    """
+    Receives the events over ``connections`` Socket Mode websockets (Slack
+    allows up to 10 per app), opened with the app level token ``app_token``.
+    Each connection acknowledges its envelopes as they arrive, and is opened
+    again, with backoff, when it fails or Slack asks to refresh it.
+    """
+
+    name = 'socket_mode'
+
+    def __init__(self, app_token, connections=2, base_url=None, **kwargs):
+        super(SocketModeTransport, self).__init__(**kwargs)
+        webapi_args = {}
+        if base_url is not None:
+            webapi_args['base_url'] = base_url
+        self.app_token = app_token
+        self.webapi = slack_sdk.WebClient(**webapi_args)
+        self.connections = connections
+        self._stopped = threading.Event()
+        self._threads = []
+        self._sockets = set()
+        self._lock = threading.Lock()
+
+    def start(self, handler):
+        super(SocketModeTransport, self).start(handler)
+        self._stopped.clear()
+        for i in range(self.connections):
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name='socket-mode-{}'.format(i))
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            sockets = list(self._sockets)
+        for ws in sockets:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+
+    @property
+    def connected(self):
+        """Number of open connections."""
+        return len(self._sockets)
+
+    def _connect(self):
+        url = self.webapi.apps_connections_open(app_token=self.app_token)['url']
+        proxy, proxy_port, no_proxy = get_http_proxy(os.environ)
+        return create_connection(url, http_proxy_host=proxy,
+                                 http_proxy_port=proxy_port,
+                                 http_no_proxy=no_proxy)
+
+    def _run(self):
+        attempt = 0
+        while not self._stopped.is_set():
+            try:
+                ws = self._connect()
+            except Exception as e:
+                delay = backoff_delay(attempt)
+                attempt += 1
+                logger.warning('failed to open a socket mode connection, '
+                               'retrying in %.1fs: %s', delay, e)
+                self._stopped.wait(delay)
+                continue
+            attempt = 0
+            with self._lock:
+                self._sockets.add(ws)
+                SOCKET_MODE_CONNECTIONS.set(len(self._sockets))
+            try:
+                self._receive(ws)
+            except (WebSocketException, OSError) as e:
+                if not self._stopped.is_set():
+                    logger.warning('socket mode connection lost: %s', e)
+            finally:
+                with self._lock:
+                    self._sockets.discard(ws)
+                    SOCKET_MODE_CONNECTIONS.set(len(self._sockets))
+                ws.close()
+
+    def _receive(self, ws):
+        while not self._stopped.is_set():
+            opcode, data = ws.recv_data()
+            if opcode == ABNF.OPCODE_CLOSE:
+                return
+            try:
+                message = json.loads(data.decode('utf-8'))
+            except ValueError:
+                logger.warning('ignoring malformed socket mode frame: %r',
+                               data[:200])
+                continue
+            envelope_id = message.get('envelope_id')
+            if envelope_id:
+                # Slack sends the envelope again if not acknowledged within
+                # 3 seconds
+                ws.send(json.dumps({'envelope_id': envelope_id}))
+            kind = message.get('type')
+            if kind == 'events_api':
+                payload = message.get('payload') or {}
+                self._deliver(payload.get('event_id'), payload.get('event'))
+            elif kind == 'hello':
+                logger.info('socket mode connection open (%s in all)',
+                            message.get('num_connections'))
+            elif kind == 'disconnect':
+                logger.info('slack closes the socket mode connection: %s',
+                            message.get('reason'))
+                return
+            else:
+                logger.debug('ignoring socket mode %s message', kind)
+
+
+class _EventsHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        transport = self.server.transport
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.path.split('?')[0] != transport.path:
+            status, data = 404, {}
+        else:
+            status, data = transport.handle(self.headers, body)
+        response = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class EventsAPITransport(Transport):
+    """
+    Receives the Events API requests on http://addr:port/path, checking
+    their signature with the app's ``signing_secret`` and that they were
+    signed less than ``max_age`` seconds ago. Slack needs to reach it over
+    HTTPS, e.g. through a reverse proxy.
+
+    Without a signing secret, anyone reaching the port could make the bot
+    act, so it refuses to start unless ``insecure`` is set, e.g. for tests.
+    """
+
+    name = 'events_api'
+
+    def __init__(self, signing_secret, port=3000, addr='127.0.0.1',
+                 path='/slack/events', max_age=300, insecure=False, **kwargs):
+        super(EventsAPITransport, self).__init__(**kwargs)
+        self.signing_secret = signing_secret
+        self.insecure = insecure
+        self.port = port
+        self.addr = addr
+        self.path = path
+        self.max_age = max_age
+        self._server = None
+
+    def start(self, handler):
+        if not self.signing_secret:
+            if not self.insecure:
+                raise ValueError('The events api needs the app\'s signing '
+                                 'secret (SIGNING_SECRET), or EVENTS_API_INSECURE '
+                                 'to accept unauthenticated requests')
+            logger.warning('no signing secret, the events api requests are '
+                           'not authenticated')
+        super(EventsAPITransport, self).start(handler)
+        self._server = ThreadingHTTPServer((self.addr, self.port),
+                                           _EventsHandler)
+        self._server.daemon_threads = True
+        self._server.transport = self
+        threading.Thread(target=self._server.serve_forever, daemon=True,
+                         name='events-api').start()
+        logger.info('receiving events on http://%s:%s%s', self.addr,
+                    self.address[1], self.path)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def verify(self, headers, body):
+        """Whether the request was signed by Slack, recently."""
+        if not self.signing_secret:
+            return True
+        timestamp = headers.get('X-Slack-Request-Timestamp') or ''
+        try:
+            if abs(time.time() - int(timestamp)) > self.max_age:
+                return False
+        except ValueError:
+            return False
+        expected = 'v0=' + hmac.new(
+            self.signing_secret.encode('utf-8'),
+            b'v0:' + timestamp.encode('ascii') + b':' + body,
+            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected,
+                                   headers.get('X-Slack-Signature') or '')
+
+    def handle(self, headers, body):
+        """Returns the status and body of the response to an Events API
+        request."""
+        if not self.verify(headers, body):
+            logger.warning('rejected an events api request with a bad signature')
+            return 401, {'error': 'invalid signature'}
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, {'error': 'invalid json'}
+        kind = data.get('type')
+        if kind == 'url_verification':
+            return 200, {'challenge': data.get('challenge')}
+        if kind == 'event_callback':
+            self._deliver(data.get('event_id'), data.get('event'))
+        else:
+            logger.debug('ignoring events api %s request', kind)
+        return 200, {}
@@ -3,14 +3,23 @@
 import os
 import logging
 import tempfile
+import itertools
+import random
 import requests
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
 import _thread
 import queue
 
+from slackbot import metrics
 
 logger = logging.getLogger(__name__)
 
+QUEUE_WAIT = metrics.Histogram('slackbot_queue_wait_seconds',
+                               'Time tasks wait in the worker pool queue')
+
 
 def download_file(url, fpath, token=''):
     logger.debug('starting to fetch %s', url)
@@ -38,22 +47,561 @@ def create_tmp_file(content=''):
 
 
 class WorkerPool(object):
-    def __init__(self, func, nworker=10):
+    """
+    Pool of worker threads calling ``func`` on every task.
+
+    The pool starts ``nworker`` threads and grows up to ``max_worker`` while
+    tasks wait longer than ``scale_wait`` seconds in the queue, either as
+    measured when a task is picked or as estimated from the backlog and the
+    average handler latency. A monitor thread also adds workers while tasks
+    are queued and every worker is busy, e.g. stuck in slow handlers, since
+    then no worker picks a task to notice the wait. Threads beyond
+    ``nworker`` retire after ``idle_timeout`` seconds without work.
+
+    With ``lanes``, tasks are queued in a :class:`LaneQueue` (see there for
+    ``lane_of``, ``maxsize`` and ``overflow``), which calls ``on_drop(task)``
+    for the queued tasks it drops to make room.
+    """
+
+    def __init__(self, func, nworker=10, max_worker=None, idle_timeout=60,
+                 scale_wait=0.5, lanes=None, lane_of=None, maxsize=0,
+                 overflow='block', on_drop=None):
         self.nworker = nworker
+        self.max_worker = max(max_worker or nworker, nworker)
+        self.idle_timeout = idle_timeout
+        self.scale_wait = scale_wait
         self.func = func
-        self.queue = queue.Queue()
+        if lanes:
+            self.queue = LaneQueue(
+                lanes, lambda task: lane_of(task[1]), maxsize=maxsize,
+                overflow=overflow,
+                on_drop=on_drop and (lambda task: on_drop(task[1])))
+        else:
+            self.queue = queue.Queue(maxsize)
+        # moving averages, in seconds
+        self.wait_time = 0.0
+        self.latency = 0.0
+        self._workers = 0
+        self._busy = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._workers
 
     def start(self):
         for __ in range(self.nworker):
-            _thread.start_new_thread(self.do_work, tuple())
+            self._spawn()
+        if self.max_worker > self.nworker:
+            _thread.start_new_thread(self._monitor, tuple())
+
+    def _monitor(self):
+        while True:
+            time.sleep(self.scale_wait)
+            # no worker is free to pick the queued tasks up
+            if (self.queue.qsize() and self._busy >= self._workers and
+                    self._spawn()):
+                logger.debug('all workers busy, worker added, %d running',
+                             self._workers)
+
+    def _spawn(self):
+        with self._lock:
+            if self._workers >= self.max_worker:
+                return False
+            self._workers += 1
+        _thread.start_new_thread(self.do_work, tuple())
+        return True
 
     def add_task(self, msg):
-        self.queue.put(msg)
+        """Queue ``msg``; return False if the full queue dropped it."""
+        return self.queue.put((time.time(), msg))
 
     def do_work(self):
         while True:
-            msg = self.queue.get()
-            self.func(msg)
+            try:
+                enqueued, msg = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    if self._workers > self.nworker:
+                        self._workers -= 1
+                        logger.debug('worker retired, %d left', self._workers)
+                        return
+                continue
+
+            started = time.time()
+            QUEUE_WAIT.observe(started - enqueued)
+            self._autoscale(started - enqueued)
+            with self._lock:
+                self._busy += 1
+            try:
+                self.func(msg)
+            except Exception:
+                logger.exception('failed to run task %r', msg)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                self.latency += 0.2 * (time.time() - started - self.latency)
+
+    def _autoscale(self, wait):
+        self.wait_time += 0.2 * (wait - self.wait_time)
+        backlog = self.queue.qsize()
+        if not backlog:
+            return
+        estimate = backlog * self.latency / max(self._workers, 1)
+        if max(wait, estimate) > self.scale_wait and self._spawn():
+            logger.debug('worker added, %d running', self._workers)
+
+    def queue_depths(self):
+        if isinstance(self.queue, LaneQueue):
+            return self.queue.lane_sizes()
+        if isinstance(self.queue, FairQueue):
+            return self.queue.key_sizes()
+        return {'tasks': self.queue.qsize()}
+
+    def shed_counts(self):
+        return dict(getattr(self.queue, 'shed', {}))
+
+    def stats(self):
+        return {
+            'workers': self._workers,
+            'queued': self.queue.qsize(),
+            'wait_time': self.wait_time,
+            'latency': self.latency,
+        }
+
+
+class LaneQueue(object):
+    """
+    Queue with one FIFO lane per task kind, served in the priority order of
+    ``lanes``; ``lane_of(item)`` tells which lane an item goes to.
+
+    With a ``maxsize`` the total number of queued items is bounded, and the
+    ``overflow`` policy decides what happens to an item put in a full queue:
+
+    * 'block': wait until a worker makes room.
+    * 'drop_oldest': drop the oldest queued item.
+    * 'drop_listen_to': drop an item of the lowest priority lane (listen_to
+      comes last), but never one with a higher priority than the new item,
+      which is dropped itself instead.
+
+    Dropped items are counted per lane in ``shed``, and ``on_drop(item)`` is
+    called with the queued items dropped to make room.
+    """
+
+    POLICIES = ('block', 'drop_oldest', 'drop_listen_to')
+
+    def __init__(self, lanes, lane_of, maxsize=0, overflow='block',
+                 on_drop=None):
+        if overflow not in self.POLICIES:
+            raise ValueError('Unknown overflow policy {!r}'.format(overflow))
+        self.lanes = tuple(lanes)
+        self.lane_of = lane_of
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.shed = dict.fromkeys(self.lanes, 0)
+        self._lanes = dict((lane, deque()) for lane in self.lanes)
+        self._size = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self, item):
+        """Queue ``item``; return False if it was dropped."""
+        lane = self.lane_of(item)
+        dropped = []
+        queued = True
+        with self._lock:
+            while self.maxsize and self._size >= self.maxsize:
+                if self.overflow == 'block':
+                    self._not_full.wait()
+                    continue
+                victim = self._victim(lane)
+                if victim is None:
+                    self._count_shed(lane)
+                    queued = False
+                    break
+                dropped.append(self._lanes[victim].popleft()[1])
+                self._size -= 1
+                self._count_shed(victim)
+            else:
+                self._lanes[lane].append((next(self._seq), item))
+                self._size += 1
+                self._not_empty.notify()
+        if self.on_drop is not None:
+            # outside the lock, the callback may queue items again
+            for victim in dropped:
+                self.on_drop(victim)
+        return queued
+
+    def _victim(self, lane):
+        if self.overflow == 'drop_oldest':
+            queued = [l for l in self.lanes if self._lanes[l]]
+            return min(queued, key=lambda l: self._lanes[l][0][0])
+        priority = self.lanes.index(lane)
+        for victim in reversed(self.lanes[priority:]):
+            if self._lanes[victim]:
+                return victim
+        return None
+
+    def _count_shed(self, lane):
+        self.shed[lane] += 1
+        count = self.shed[lane]
+        if count & (count - 1) == 0:
+            logger.warning('task queue is full, %d %s tasks dropped so far',
+                           count, lane)
+
+    def get(self, timeout=None):
+        """Pop the next item, raising queue.Empty after ``timeout`` seconds
+        without one."""
+        with self._lock:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._size:
+                if timeout is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            for lane in self.lanes:
+                if self._lanes[lane]:
+                    __, item = self._lanes[lane].popleft()
+                    break
+            self._size -= 1
+            self._not_full.notify()
+            return item
+
+    def qsize(self):
+        return self._size
+
+    def lane_sizes(self):
+        with self._lock:
+            return dict((lane, len(self._lanes[lane])) for lane in self.lanes)
+
+
+class FairQueue(object):
+    """
+    Queue with a FIFO per key (e.g. per workspace), served in turn: every get
+    takes an item of the next key with items waiting, so that a busy key
+    can't starve the others. The items of a key are served in the priority
+    order of ``lanes``, as in a :class:`LaneQueue`.
+    """
+
+    def __init__(self, key_of, lanes=(None,), lane_of=None):
+        self.key_of = key_of
+        self.lanes = tuple(lanes)
+        self.lane_of = lane_of or (lambda item: None)
+        # key -> lane -> items, for the keys in the ready queue
+        self._queues = {}
+        self._ready = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def put(self, item):
+        key, lane = self.key_of(item), self.lane_of(item)
+        with self._lock:
+            lanes = self._queues.get(key)
+            if lanes is None:
+                lanes = self._queues[key] = dict(
+                    (l, deque()) for l in self.lanes)
+                self._ready.append(key)
+            lanes[lane].append(item)
+            self._size += 1
+            self._not_empty.notify()
+        return True
+
+    def get(self, timeout=None):
+        """Pop the next item, raising queue.Empty after ``timeout`` seconds
+        without one."""
+        with self._lock:
+            if not self._not_empty.wait_for(lambda: self._size, timeout):
+                raise queue.Empty
+            key = self._ready.popleft()
+            lanes = self._queues[key]
+            for lane in self.lanes:
+                if lanes[lane]:
+                    item = lanes[lane].popleft()
+                    break
+            self._size -= 1
+            if any(lanes.values()):
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+            return item
+
+    def qsize(self):
+        return self._size
+
+    def key_sizes(self):
+        with self._lock:
+            return dict((key, sum(len(l) for l in lanes.values()))
+                        for key, lanes in self._queues.items())
+
+
+class FairWorkerPool(WorkerPool):
+    """
+    :class:`WorkerPool` shared by several clients (e.g. the dispatchers of
+    the workspaces a bot serves), each having its tasks queued apart and
+    served in turn (see :class:`FairQueue`). Clients get a pool of their own
+    to add tasks to with :meth:`client`.
+    """
+
+    def __init__(self, nworker=10, max_worker=None, idle_timeout=60,
+                 scale_wait=0.5, lanes=(None,)):
+        super(FairWorkerPool, self).__init__(
+            self._run_task, nworker=nworker, max_worker=max_worker,
+            idle_timeout=idle_timeout, scale_wait=scale_wait)
+        # the pool's tasks are (enqueued, (key, lane, func, msg))
+        self.queue = FairQueue(lambda task: task[1][0], lanes=lanes,
+                               lane_of=lambda task: task[1][1])
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        super(FairWorkerPool, self).start()
+
+    @staticmethod
+    def _run_task(task):
+        key, lane, func, msg = task
+        func(msg)
+
+    def client(self, key, func, lane_of=None):
+        """A pool calling ``func`` on the tasks added to it, queued under
+        ``key``, in the lane ``lane_of(task)`` tells."""
+        return _FairPoolClient(self, key, func, lane_of)
+
+
+class _FairPoolClient(object):
+    def __init__(self, pool, key, func, lane_of):
+        self.pool = pool
+        self.key = key
+        self.func = func
+        self.lane_of = lane_of or (lambda msg: None)
+
+    def start(self):
+        self.pool.start()
+
+    def add_task(self, msg):
+        return self.pool.add_task((self.key, self.lane_of(msg), self.func, msg))
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    def qsize(self):
+        return self.pool.queue.key_sizes().get(self.key, 0)
+
+    def queue_depths(self):
+        return self.pool.queue_depths()
+
+    def shed_counts(self):
+        return {}
+
+    def stats(self):
+        return self.pool.stats()
+
+
+class ShardedWorkerPool(object):
+    """
+    Worker pool keeping the tasks sharing a key (e.g. a channel) in FIFO
+    order.
+
+    Each key has its own mailbox and at most one of its tasks runs at a time.
+    Keys with pending tasks wait in the ready queue of the shard they hash
+    to; every worker owns a shard, serves its keys round robin (one task per
+    turn, so a busy key can't starve the others) and steals ready keys from
+    the busiest shard when its own is empty.
+    """
+
+    def __init__(self, func, nworker=10, key=None):
+        self.nworker = nworker
+        self.func = func
+        self.key = key or (lambda msg: None)
+        self._cond = threading.Condition()
+        self._mailboxes = {}
+        self._running = set()
+        self._shards = [deque() for __ in range(nworker)]
+
+    def start(self):
+        for shard in range(self.nworker):
+            _thread.start_new_thread(self.do_work, (shard,))
+
+    def _shard(self, key):
+        return hash(key) % self.nworker
+
+    def add_task(self, msg):
+        key = self.key(msg)
+        with self._cond:
+            mailbox = self._mailboxes.setdefault(key, deque())
+            mailbox.append((time.time(), msg))
+            if len(mailbox) == 1 and key not in self._running:
+                self._shards[self._shard(key)].append(key)
+                self._cond.notify()
+
+    def _next_key(self, shard):
+        ready = self._shards[shard]
+        if not ready:
+            ready = max(self._shards, key=len)
+            if not ready:
+                return None
+            # steal from the tail, the owner works from the head
+            return ready.pop()
+        return ready.popleft()
+
+    def do_work(self, shard):
+        while True:
+            with self._cond:
+                key = self._next_key(shard)
+                while key is None:
+                    self._cond.wait()
+                    key = self._next_key(shard)
+                enqueued, msg = self._mailboxes[key].popleft()
+                self._running.add(key)
+            QUEUE_WAIT.observe(time.time() - enqueued)
+            try:
+                self.func(msg)
+            except Exception:
+                logger.exception('failed to run task %r', msg)
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+                    if self._mailboxes[key]:
+                        self._shards[self._shard(key)].append(key)
+                        self._cond.notify()
+                    else:
+                        del self._mailboxes[key]
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(m) for m in self._mailboxes.values())
+
+    @property
+    def size(self):
+        return self.nworker
+
+    def queue_depths(self):
+        return dict(('shard-{}'.format(shard), depth)
+                    for shard, depth in enumerate(self.shard_depths()))
+
+    def shed_counts(self):
+        return {}
+
+    def shard_depths(self):
+        """Number of queued tasks in each shard."""
+        depths = [0] * self.nworker
+        with self._cond:
+            for key, mailbox in self._mailboxes.items():
+                depths[self._shard(key)] += len(mailbox)
+        return depths
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time: callers asking for a key while its call
+    is in flight wait for it and share its result, or its exception.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def backoff_delay(attempt, base=1.0, cap=120.0):
+    """
+    Seconds to wait before retry number ``attempt`` (from 0): exponential
+    backoff with full jitter, so that clients failing together don't retry
+    in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``failure_threshold`` consecutive failures, then lets one
+    trial call through (half open) every ``reset_timeout`` seconds, and closes
+    again on the first success.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60.0,
+                 on_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.failures = 0
+        self._opened_at = None
+        self._state = self.CLOSED
+        self._lock = threading.Lock()
+
+    def _set(self, state):
+        if state != self._state:
+            logger.warning('circuit %s -> %s', self._state, state)
+            self._state = state
+            if self.on_change is not None:
+                self.on_change(state)
+
+    @property
+    def state(self):
+        with self._lock:
+            if (self._state == self.OPEN and
+                    time.monotonic() - self._opened_at >= self.reset_timeout):
+                self._set(self.HALF_OPEN)
+            return self._state
+
+    def retry_in(self):
+        """Seconds before the next call may be tried, 0 for right away."""
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._set(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._set(self.OPEN)
 
 
 def get_http_proxy(environ):
@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from slackbot.aiodispatcher import AsyncMessageDispatcher
+
+FAKE_CHANNEL = 'D12942JF92'
+
+
+class FakeClient:
+    webapi_only = False
+
+    def __init__(self):
+        self.rtm_messages = []
+        self.threads = []
+
+    def rtm_send_message(self, channel, message, attachments=None,
+                         thread_ts=None):
+        self.threads.append(threading.current_thread())
+        self.rtm_messages.append((channel, message))
+
+
+class FakePluginManager:
+    def __init__(self, func):
+        self.func = func
+
+    def get_plugins(self, category, text):
+        yield self.func, (text,)
+
+
+@pytest.fixture()
+def make_dispatcher():
+    def make(func):
+        dispatcher = AsyncMessageDispatcher(None, None, None, nworker=2)
+        dispatcher._client = FakeClient()
+        dispatcher._plugins = FakePluginManager(func)
+        return dispatcher
+    return make
+
+
+def run(dispatcher, msg):
+    async def main():
+        dispatcher._loop = asyncio.get_running_loop()
+        from concurrent.futures import ThreadPoolExecutor
+        dispatcher._executor = ThreadPoolExecutor(max_workers=2)
+        await dispatcher.async_dispatch_msg(msg)
+    asyncio.run(main())
+
+
+def test_coroutine_plugin_runs_on_the_loop(make_dispatcher):
+    async def plugin(message, text):
+        await asyncio.sleep(0)
+        await message.send(text.upper())
+
+    dispatcher = make_dispatcher(plugin)
+    run(dispatcher, ['listen_to', {'text': 'hi', 'channel': FAKE_CHANNEL}])
+    assert dispatcher._client.rtm_messages == [(FAKE_CHANNEL, 'HI')]
+    assert dispatcher._client.threads == [threading.main_thread()]
+
+
+def test_sync_plugin_runs_in_executor(make_dispatcher):
+    def plugin(message, text):
+        message.send(text)
+
+    dispatcher = make_dispatcher(plugin)
+    run(dispatcher, ['listen_to', {'text': 'hi', 'channel': FAKE_CHANNEL}])
+    assert dispatcher._client.rtm_messages == [(FAKE_CHANNEL, 'hi')]
+    assert dispatcher._client.threads != [threading.main_thread()]
+
+
+def test_coroutine_plugin_exception_is_reported(make_dispatcher):
+    async def plugin(message, text):
+        raise RuntimeError
+
+    dispatcher = make_dispatcher(plugin)
+    run(dispatcher, ['listen_to', {'text': 'hi', 'channel': FAKE_CHANNEL}])
+    assert len(dispatcher._client.rtm_messages) == 1
+    assert 'RuntimeError' in dispatcher._client.rtm_messages[0][1]
+    # sending the report may wait for the rate limit, off the loop
+    assert dispatcher._client.threads != [threading.main_thread()]
+
+
+def test_frames_buffered_in_the_ssl_layer_are_read(make_dispatcher):
+    import socket
+
+    class Sock(object):
+        def __init__(self, frames):
+            self.frames = frames
+            self._sock, self._peer = socket.socketpair()
+
+        def fileno(self):
+            return self._sock.fileno()
+
+        def pending(self):
+            return len(self.frames)
+
+    class Client(FakeClient):
+        def __init__(self):
+            super(Client, self).__init__()
+            self.websocket = type('Websocket', (), {})()
+            self.websocket.sock = Sock(list(range(5)))
+
+        def rtm_read(self, reconnect=True):
+            # capped at two frames a read
+            frames = self.websocket.sock.frames
+            for __ in range(min(2, len(frames))):
+                yield {'type': 'hello', 'n': frames.pop(0)}
+
+    dispatcher = make_dispatcher(None)
+    dispatcher._client = Client()
+    handled = []
+    dispatcher._handle_event = lambda event: handled.append(event['n'])
+
+    async def main():
+        dispatcher._loop = asyncio.get_running_loop()
+        dispatcher._watch_websocket()
+        # the socket itself never becomes readable
+        dispatcher._on_readable()
+        for __ in range(5):
+            await asyncio.sleep(0)
+        dispatcher._loop.remove_reader(dispatcher._sock)
+
+    asyncio.run(main())
+    assert handled == [0, 1, 2, 3, 4]
+
+
+def test_reconnecting_doesnt_block_the_loop(make_dispatcher):
+    import socket
+    from slackbot.slackclient import SlackConnectionError
+
+    class Client(FakeClient):
+        def __init__(self):
+            super(Client, self).__init__()
+            self.websocket = self.connect()
+            self.reconnected = threading.Event()
+
+        @staticmethod
+        def connect():
+            websocket = type('Websocket', (), {})()
+            websocket.sock, websocket.peer = socket.socketpair()
+            return websocket
+
+        def rtm_read(self, reconnect=True):
+            assert not reconnect
+            websocket = self.websocket
+            if websocket.peer.fileno() == -1:
+                raise SlackConnectionError('closed')
+            websocket.sock.recv(100)
+            yield {'type': 'hello'}
+
+        def reconnect(self):
+            time.sleep(0.2)
+            self.websocket = self.connect()
+            self.reconnected.set()
+
+    dispatcher = make_dispatcher(None)
+    dispatcher._client = client = Client()
+    handled = []
+    dispatcher._handle_event = handled.append
+
+    async def main():
+        dispatcher._loop = asyncio.get_running_loop()
+        from concurrent.futures import ThreadPoolExecutor
+        dispatcher._executor = ThreadPoolExecutor(max_workers=2)
+        dispatcher._watch_websocket()
+        client.websocket.peer.close()
+        ticks = 0
+        while not client.reconnected.is_set():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        # the loop kept running meanwhile
+        assert ticks > 5
+        await dispatcher._reconnecting
+        client.websocket.peer.send(b'x')
+        for __ in range(50):
+            if handled:
+                break
+            await asyncio.sleep(0.01)
+        dispatcher._loop.remove_reader(dispatcher._sock)
+
+    asyncio.run(main())
+    assert handled == [{'type': 'hello'}]
@@ -0,0 +1,82 @@
+import re
+import threading
+
+import pytest
+
+from slackbot import bot as bot_module
+from slackbot.bot import MultiBot
+from slackbot.manager import CommandRegistry, PluginsManager
+from tests import fakeslack
+from tests.fakeslack import FakeSlack
+
+
+@pytest.fixture
+def slacks():
+    slacks = [FakeSlack(users=3, channels=2).start() for __ in range(2)]
+    yield slacks
+    for slack in slacks:
+        slack.stop()
+
+
+@pytest.fixture
+def plugins(monkeypatch):
+    import slackbot
+    monkeypatch.setattr('slackbot.bot.settings', slackbot.settings)
+    loaded = []
+    monkeypatch.setattr(PluginsManager, 'init_plugins',
+                        lambda self: loaded.append(self))
+    # plain dicts work as well as registries
+    monkeypatch.setattr(PluginsManager, 'commands', {
+        'respond_to': {
+            re.compile('ping'): lambda message: message.reply('pong')},
+        'listen_to': {}, 'default_reply': CommandRegistry()})
+    return loaded
+
+
+def test_multibot_serves_each_workspace(slacks, plugins):
+    bot = MultiBot([{'name': 'ws{}'.format(i), 'TRANSPORT': 'socket_mode',
+                     'API_TOKEN': fakeslack.TOKEN,
+                     'SLACK_APP_TOKEN': fakeslack.APP_TOKEN,
+                     'SLACK_API_URL': slack.api_url}
+                    for i, slack in enumerate(slacks)])
+    assert [b.name for b in bot.bots] == ['ws0', 'ws1']
+    threads = []
+    for b in bot.bots:
+        thread = threading.Thread(target=b.serve, daemon=True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for slack in slacks:
+            slack.wait_connected(count=2)
+            slack.post_message('C00000001', 'U00000001',
+                               '<@{}> ping'.format(fakeslack.BOT_ID))
+        for slack in slacks:
+            reply = slack.bot_messages.get(timeout=5)
+            assert reply['text'] == '<@U00000001>: pong'
+        usage = bot.directory_usage()
+        assert sorted(usage) == ['ws0', 'ws1']
+        assert usage['ws0']['users']['records'] == len(
+            bot.bots[0]._client.users)
+        assert usage['ws0']['users']['bytes'] > 0
+    finally:
+        for b in bot.bots:
+            b._transport.stop()
+
+
+def test_multibot_loads_the_plugins_once(slacks, plugins, monkeypatch):
+    bot = MultiBot([{'TRANSPORT': 'socket_mode', 'API_TOKEN': fakeslack.TOKEN,
+                     'SLACK_APP_TOKEN': fakeslack.APP_TOKEN,
+                     'SLACK_API_URL': slack.api_url} for slack in slacks])
+    served = []
+    for b in bot.bots:
+        monkeypatch.setattr(b, 'serve', lambda b=b: served.append(b.name))
+    bot.run()
+    assert len(plugins) == 1
+    assert sorted(served) == ['workspace0', 'workspace1']
+
+
+def test_multibot_needs_a_threaded_event_loop(plugins, monkeypatch):
+    monkeypatch.setattr(bot_module.settings, 'EVENT_LOOP', 'asyncio',
+                        raising=False)
+    with pytest.raises(ValueError):
+        MultiBot([])
@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+from slackbot.cluster import (FileEventQueue, IngestDispatcher,
+                              MemoryEventQueue, QueueTransport,
+                              WorkerDispatcher)
+from slackbot.slackclient import SlackClient
+from slackbot.transports import SocketModeTransport
+from slackbot.utils import ShardedWorkerPool
+from tests import fakeslack
+from tests.fakeslack import FakeSlack
+
+
+def message(channel, text):
+    return {'type': 'message', 'channel': channel, 'user': 'U1',
+            'text': text}
+
+
+def test_messages_of_a_channel_share_a_partition():
+    events = MemoryEventQueue(partitions=4)
+    channels = ['C{}'.format(i) for i in range(20)]
+    for i in range(3):
+        for channel in channels:
+            events.publish(message(channel, str(i)))
+    seen = {}
+    for partition in range(4):
+        while True:
+            event = events.get(partition, timeout=0)
+            if event is None:
+                break
+            assert events.partition_of(event['channel']) == partition
+            seen.setdefault(event['channel'], []).append(event['text'])
+    assert seen == dict((channel, ['0', '1', '2']) for channel in channels)
+    # the channels are spread over the partitions
+    assert len(set(map(events.partition_of, channels))) > 1
+
+
+def test_directory_events_go_to_every_partition():
+    events = MemoryEventQueue(partitions=3)
+    assert events.publish({'type': 'team_join', 'user': {'id': 'U2'}}) == [
+        0, 1, 2]
+    assert events.publish({'type': 'presence_change'}) == []
+    for partition in range(3):
+        assert events.get(partition, timeout=0)['type'] == 'team_join'
+
+
+def test_file_queue_resumes_from_the_saved_offset(tmp_path):
+    events = FileEventQueue(str(tmp_path), partitions=2, poll_interval=0.01)
+    partition = events.partition_of('C1')
+    for i in range(3):
+        events.publish(message('C1', str(i)))
+    assert events.get(partition, timeout=0)['text'] == '0'
+    assert events.get(1 - partition, timeout=0) is None
+    events.close()
+
+    # a line being written isn't read yet
+    with open(str(tmp_path / '{}.log'.format(partition)), 'ab') as f:
+        f.write(b'{"type": "mess')
+    events = FileEventQueue(str(tmp_path), partitions=2, poll_interval=0.01)
+    assert [events.get(partition, timeout=0)['text']
+            for __ in range(2)] == ['1', '2']
+    assert events.get(partition, timeout=0.05) is None
+    events.close()
+
+
+def test_file_queue_needs_a_path():
+    with pytest.raises(ValueError):
+        FileEventQueue(None)
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack(users=3, channels=2).start()
+    yield slack
+    slack.stop()
+
+
+class Plugins(object):
+    def __init__(self):
+        self.scheduled = []
+
+    def get_plugins(self, category, text):
+        if category == 'respond_to':
+            yield (lambda message: message.reply('pong ' + text)), ()
+
+    def get_run_at_times_plugins(self):
+        self.scheduled.append(True)
+        return []
+
+
+def test_workers_reply_to_the_events_the_ingest_node_publishes(fake_slack,
+                                                               tmp_path):
+    ingest_client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                                connect=False)
+    ingest_client.web_connect()
+    ingest_plugins = Plugins()
+    ingest = IngestDispatcher(
+        ingest_client, ingest_plugins, None,
+        FileEventQueue(str(tmp_path), partitions=2, poll_interval=0.01))
+    ingest.start()
+    assert ingest_plugins.scheduled
+    transport = SocketModeTransport(fakeslack.APP_TOKEN,
+                                    base_url=fake_slack.api_url)
+    threading.Thread(target=ingest.transport_loop, args=(transport,),
+                     daemon=True).start()
+
+    workers = []
+    for partition in range(2):
+        client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                             connect=False)
+        client.web_connect()
+        plugins = Plugins()
+        worker = WorkerDispatcher(client, plugins, None)
+        # the channels' messages are handled in order
+        assert isinstance(worker._pool, ShardedWorkerPool)
+        worker.start()
+        assert not plugins.scheduled
+        events = FileEventQueue(str(tmp_path), partitions=2,
+                                poll_interval=0.01)
+        workers.append(QueueTransport(events, partitions=[partition]))
+        threading.Thread(target=worker.transport_loop, args=(workers[-1],),
+                         daemon=True).start()
+    try:
+        fake_slack.wait_connected(count=2)
+        for channel in ['C00000001', 'C00000002']:
+            fake_slack.post_message(channel, 'U00000001',
+                                    '<@{}> ping'.format(fakeslack.BOT_ID))
+        replies = [fake_slack.bot_messages.get(timeout=5) for __ in range(2)]
+        assert sorted((r['channel'], r['text']) for r in replies) == [
+            ('C00000001', '<@U00000001>: pong ping'),
+            ('C00000002', '<@U00000001>: pong ping')]
+        assert fake_slack.calls['rtm.connect'] == 0
+    finally:
+        transport.stop()
+        for worker in workers:
+            worker.stop()
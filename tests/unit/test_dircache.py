@@ -0,0 +1,29 @@
+from slackbot.dircache import DirectoryCache
+
+FIELDS = {'users': ('id', 'name'), 'channels': None}
+
+
+def test_save_and_load(tmpdir):
+    path = str(tmpdir.join('directory.db'))
+    cache = DirectoryCache(path)
+    assert cache.load('T1', FIELDS) is None
+    cache.update('users', [{'id': 'U1', 'name': 'alice'},
+                           {'id': 'U2', 'name': 'bob'}])
+    cache.update('channels', [{'id': 'C1', 'name': 'general', 'topic': 'x'}])
+    cache.saved('T1', FIELDS, {'users': ['U1'], 'channels': ['C1']})
+    cache.update('users', [{'id': 'U1', 'name': 'alicia'}])
+    cache.close()
+
+    cache = DirectoryCache(path)
+    saved_at, users, channels = cache.load('T1', FIELDS)
+    assert saved_at > 0
+    assert users == [{'id': 'U1', 'name': 'alicia'}]
+    assert channels == [{'id': 'C1', 'name': 'general', 'topic': 'x'}]
+    assert cache.load('T2', FIELDS) is None
+    # snapshots lacking the fields needed are ignored
+    assert cache.load('T1', {'users': ('id', 'name', 'tz'),
+                             'channels': None}) is None
+    assert cache.load('T1', {'users': None, 'channels': None}) is None
+    assert cache.load('T1', {'users': ('name',), 'channels': ('id',)})
+    cache.clear()
+    assert cache.load('T1', FIELDS) is None
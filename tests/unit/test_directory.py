@@ -0,0 +1,159 @@
+import pickle
+import threading
+import time
+
+from slackbot.directory import Directory, LazyDirectory, Record
+
+
+def test_lookup_follows_changes():
+    users = Directory({'U1': {'id': 'U1', 'name': 'alice'}})
+    assert users.lookup('name', 'alice') == 'U1'
+    users['U2'] = {'id': 'U2', 'name': 'bob'}
+    users['U1'] = {'id': 'U1', 'name': 'carol'}
+    assert users.lookup('name', 'alice') is None
+    assert users.lookup('name', 'carol') == 'U1'
+    del users['U2']
+    assert users.lookup('name', 'bob') is None
+    assert users.pop('U1')['name'] == 'carol'
+    assert users.lookup('name', 'carol') is None
+    assert users.pop('U1', None) is None
+    assert users.lookup('name', None) is None
+
+
+def test_name_taken_over_by_another_record():
+    channels = Directory(keys=('name', 'user'))
+    channels.update({'C1': {'name': 'general'}, 'D1': {'user': 'U1'}})
+    channels['C2'] = {'name': 'general'}
+    # renaming C1 must not drop the name now belonging to C2
+    channels['C1'] = {'name': 'old-general'}
+    assert channels.lookup('name', 'general') == 'C2'
+    assert channels.lookup('user', 'U1') == 'D1'
+    channels.clear()
+    assert channels.lookup('name', 'general') is None
+
+
+def test_compact_records_fetch_other_fields_on_demand():
+    full = {'id': 'U1', 'name': 'alice', 'profile': {'email': 'a@b.c'}}
+    fetched = []
+
+    def loader(id):
+        fetched.append(id)
+        return full
+
+    users = Directory({'U1': full}, fields=('real_name',), loader=loader)
+    record = users['U1']
+    assert isinstance(record, Record)
+    assert users.fields == ('id', 'name', 'real_name')
+    assert dict(record) == {'id': 'U1', 'name': 'alice'}
+    assert record['name'] == 'alice' and record.get('real_name') is None
+    assert 'real_name' not in record
+    assert fetched == []
+    assert record['profile']['email'] == 'a@b.c'
+    assert 'profile' in record
+    assert fetched == ['U1']
+    users['U1'] = dict(full, name='alicia')
+    assert users.lookup('name', 'alicia') == 'U1'
+    assert users['U1']['profile']
+    assert fetched == ['U1', 'U1']
+
+
+def test_compact_record_pickles_as_a_dict():
+    users = Directory({'U1': {'id': 'U1', 'name': 'alice', 'tz': 'UTC'}},
+                      fields=())
+    copy = pickle.loads(pickle.dumps(users['U1']))
+    assert type(copy) is dict and copy == {'id': 'U1', 'name': 'alice'}
+
+
+def test_lazy_directory_resolves_on_first_lookup():
+    calls = []
+
+    def loader(id):
+        calls.append(id)
+        if id == 'U0000404':
+            raise KeyError(id)
+        return {'id': id, 'name': id.lower(), 'profile': {}}
+
+    users = LazyDirectory(loader=loader, fields=(), capacity=2)
+    assert users.lookup('name', 'u0000001') is None
+    assert users['U0000001']['name'] == 'u0000001'
+    assert users.lookup('name', 'u0000001') == 'U0000001'
+    assert 'U0000002' in users and users.get('U0000404') is None
+    # names are not resolved
+    assert 'general' not in users and users.get('general') is None
+    assert calls == ['U0000001', 'U0000002', 'U0000404']
+    # the full record fetched on the way is kept too
+    assert users['U0000001']['profile'] == {}
+    assert calls == ['U0000001', 'U0000002', 'U0000404']
+
+    # least recently used first out
+    users['U0000001']
+    users['U0000003']
+    assert sorted(dict.keys(users)) == ['U0000001', 'U0000003']
+    assert users.lookup('name', 'u0000002') is None
+
+
+def test_lazy_directory_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def loader(id):
+        calls.append(id)
+        started.set()
+        release.wait(5)
+        return {'id': id, 'name': 'alice'}
+
+    users = LazyDirectory(loader=loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        users['U0000001']['name'])) for __ in range(5)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ['U0000001']
+    assert results == ['alice'] * 5
+
+
+def test_memory_usage_grows_with_the_records():
+    users = Directory()
+    empty = users.memory_usage()
+    users['U1'] = {'id': 'U1', 'name': 'alice'}
+    one = users.memory_usage()
+    assert one > empty
+    users['U2'] = {'id': 'U2', 'name': 'bob' * 100}
+    assert users.memory_usage() > one + 300
+
+
+def test_memory_usage_can_be_sampled():
+    users = Directory()
+    for i in range(1000):
+        users['U{:04d}'.format(i)] = {'id': 'U{:04d}'.format(i), 'name': 'x'}
+    exact = users.memory_usage()
+    assert abs(users.memory_usage(sample=10) - exact) < exact * 0.05
+
+
+def test_lazy_directory_only_resolves_its_ids_and_remembers_failures():
+    calls = []
+
+    def loader(id):
+        calls.append(id)
+        raise KeyError(id)
+
+    users = LazyDirectory(loader=loader, id_prefixes=('U', 'W'),
+                          negative_ttl=0.05)
+    # a channel id is never a user
+    assert 'C0000001' not in users and 'C0000001' not in users
+    assert calls == []
+    for __ in range(3):
+        assert users.get('U0000404') is None
+    assert calls == ['U0000404']
+    time.sleep(0.06)
+    assert 'U0000404' not in users
+    assert calls == ['U0000404', 'U0000404']
+    # known again once added
+    users['U0000404'] = {'id': 'U0000404', 'name': 'back'}
+    assert users['U0000404']['name'] == 'back'
@@ -30,10 +30,13 @@ class FakePluginManager:
 
 
 class FakeClient:
+    webapi_only = False
+
     def __init__(self):
         self.rtm_messages = []
 
-    def rtm_send_message(self, channel, message, attachments=None):
+    def rtm_send_message(self, channel, message, attachments=None,
+                         thread_ts=None):
         self.rtm_messages.append((channel, message))
 
 
@@ -211,3 +214,112 @@ def test_none_text(dispatcher):
     # Should not raise a TypeError
     msg = dispatcher.filter_text(msg)
     assert msg is None
+
+
+class StopLoop(Exception):
+    pass
+
+
+class FakeWebsocket:
+    def __init__(self, sock):
+        self.sock = sock
+
+
+class FakeRTMClient(FakeClient):
+    def __init__(self, sock):
+        super().__init__()
+        self.websocket = FakeWebsocket(sock)
+        self.pings = 0
+
+    def rtm_read(self):
+        return [{'type': 'message', 'text': self.websocket.sock.recv(1024)}]
+
+    def ping(self):
+        self.pings += 1
+
+
+def test_select_loop_dispatches_when_socket_is_readable(dispatcher,
+                                                        monkeypatch):
+    import socket
+    a, b = socket.socketpair()
+    dispatcher._client = FakeRTMClient(a)
+    dispatcher._plugins.get_run_at_times_plugins = lambda: []
+    received = []
+
+    def handle_event(event):
+        received.append(event['text'])
+        raise StopLoop
+
+    monkeypatch.setattr(dispatcher, '_handle_event', handle_event)
+    b.send(b'frame')
+    with pytest.raises(StopLoop):
+        dispatcher.select_loop()
+    assert received == [b'frame']
+    assert dispatcher._client.pings == 0
+    a.close()
+    b.close()
+
+
+def test_dispatch_msg_coroutine_plugin(dispatcher):
+    async def coroutine_plugin(message):
+        await message.send('from a coroutine')
+
+    dispatcher._plugins.coroutine = coroutine_plugin
+    dispatcher.dispatch_msg(
+        ['listen_to', {'text': 'coroutine', 'channel': FAKE_CHANNEL}])
+    assert dispatcher._client.rtm_messages == [
+        (FAKE_CHANNEL, 'from a coroutine')]
+
+
+def test_dispatch_msg_metrics(dispatcher, monkeypatch):
+    monkeypatch.setattr('slackbot.dispatcher.Message', FakeMessage)
+    name = '{}.raising'.format(__name__)
+    errors = slackbot.dispatcher.PLUGIN_ERRORS.value(name)
+    calls = slackbot.dispatcher.PLUGIN_TIME.count(name)
+    dispatcher.dispatch_msg(
+        ['reply_to', {'text': 'raising', 'channel': FAKE_CHANNEL}])
+    assert slackbot.dispatcher.PLUGIN_ERRORS.value(name) == errors + 1
+    assert slackbot.dispatcher.PLUGIN_TIME.count(name) == calls + 1
+    assert slackbot.dispatcher.MATCH_TIME.count('reply_to') >= 1
+    assert 'slackbot_queue_depth{queue="listen_to"} 0' in (
+        slackbot.metrics.REGISTRY.exposition())
+
+
+@pytest.mark.parametrize('overflow', ['drop_oldest', 'drop_listen_to'])
+def test_scheduled_run_dropped_by_the_full_queue_runs_again(monkeypatch,
+                                                            overflow):
+    from slackbot.scheduler import IntervalSchedule, Job
+    monkeypatch.setattr('slackbot.settings.QUEUE_MAXSIZE', 1, raising=False)
+    monkeypatch.setattr('slackbot.settings.QUEUE_OVERFLOW', overflow,
+                        raising=False)
+    dispatcher = slackbot.dispatcher.MessageDispatcher(None, None, None)
+
+    def job(client):
+        pass
+    j = Job(job, IntervalSchedule(10))
+    dispatcher._scheduler.add(j, now=0)
+    dispatcher._scheduler.run_pending(now=10)
+    assert j.running
+    # queued behind the scheduled run, which is dropped to make room
+    dispatcher._pool.add_task(('listen_to', {'channel': FAKE_CHANNEL}))
+    if overflow == 'drop_listen_to':
+        dispatcher._pool.add_task(('respond_to', {'channel': FAKE_CHANNEL}))
+    assert not j.running
+    # a worker picks the message up, the next run is queued
+    dispatcher._pool.queue.get()
+    dispatcher._scheduler.run_pending(now=20)
+    assert j.running
+    assert dispatcher._pool.queue.get()[1] == ('call_func', job)
+
+
+def test_message_from_a_user_missing_from_the_directory(dispatcher):
+    class Client(FakeClient):
+        def get_user(self, user_id):
+            # resolved with the Web API, e.g. joined while disconnected
+            return {'id': user_id, 'name': 'newcomer'}
+
+    dispatcher._client = Client()
+    dispatcher._on_new_message({'user': 'U00000099', 'text': 'hello',
+                                'channel': FAKE_CHANNEL})
+    assert dispatcher._pool.queue.get()[1] == ('listen_to', {
+        'user': 'U00000099', 'text': 'hello', 'channel': FAKE_CHANNEL})
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from slackbot.limits import PluginLimits, PluginTimeout, PluginBusy
+
+
+def make_plugin(**limits):
+    def plugin():
+        pass
+    for k, v in limits.items():
+        setattr(plugin, k, v)
+    return plugin
+
+
+def test_timeout_releases_caller():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=0.05)
+    release = threading.Event()
+    with pytest.raises(PluginTimeout):
+        limits.run(plugin, release.wait)
+    stats = limits.stats()['{}.plugin'.format(__name__)]
+    assert stats['timeouts'] == 1
+    assert stats['running'] == 1
+    release.set()
+    time.sleep(0.05)
+    assert limits.stats()['{}.plugin'.format(__name__)]['running'] == 0
+
+
+def test_exceptions_propagate_with_timeout():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=1)
+
+    def call():
+        raise KeyError('boom')
+    with pytest.raises(KeyError):
+        limits.run(plugin, call)
+
+
+def test_max_concurrency_reject():
+    limits = PluginLimits()
+    plugin = make_plugin(max_concurrency=1, on_busy='reject')
+    started, release = threading.Event(), threading.Event()
+
+    def call():
+        started.set()
+        release.wait()
+    t = threading.Thread(target=limits.run, args=(plugin, call))
+    t.start()
+    started.wait()
+    with pytest.raises(PluginBusy):
+        limits.run(plugin, call)
+    release.set()
+    t.join()
+    limits.run(plugin, lambda: None)
+    stats = limits.stats()['{}.plugin'.format(__name__)]
+    assert (stats['calls'], stats['rejected']) == (2, 1)
+
+
+def test_max_concurrency_queue():
+    limits = PluginLimits()
+    plugin = make_plugin(max_concurrency=2)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+    threads = [threading.Thread(target=limits.run, args=(plugin, call))
+               for __ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak[0] == 2
+    stats = limits.stats()['{}.plugin'.format(__name__)]
+    assert stats['calls'] == 6
+    assert stats['queued'] >= 1
+
+
+def test_async_timeout_cancels_coroutine():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=0.05)
+    cancelled = []
+
+    async def call():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(PluginTimeout):
+        asyncio.run(limits.async_run(plugin, call))
+    assert cancelled == [True]
+    assert limits.stats()['{}.plugin'.format(__name__)]['running'] == 0
+
+
+def test_waiting_for_a_slot_times_out():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=0.1, max_concurrency=1)
+    release = threading.Event()
+    with pytest.raises(PluginTimeout):
+        limits.run(plugin, release.wait)
+    started = time.time()
+    with pytest.raises(PluginTimeout):
+        limits.run(plugin, lambda: None)
+    assert time.time() - started < 1
+    assert limits.stats()['{}.plugin'.format(__name__)]['timeouts'] == 2
+    release.set()
+
+
+def test_async_timed_out_thread_keeps_its_slot():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=0.05, max_concurrency=1)
+    release = threading.Event()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        with pytest.raises(PluginTimeout):
+            await limits.async_run(
+                plugin, lambda: loop.run_in_executor(None, release.wait),
+                cancel=False)
+        stats = limits.stats()['{}.plugin'.format(__name__)]
+        assert stats['running'] == 1
+        # the thread still holds the only slot
+        with pytest.raises(PluginTimeout):
+            await limits.async_run(plugin, lambda: asyncio.sleep(0))
+        release.set()
+        await asyncio.sleep(0.05)
+        await limits.async_run(plugin, lambda: asyncio.sleep(0))
+
+    asyncio.run(main())
+    stats = limits.stats()['{}.plugin'.format(__name__)]
+    assert (stats['running'], stats['calls'], stats['timeouts']) == (0, 2, 2)
+
+
+def test_on_done_waits_for_the_abandoned_call():
+    limits = PluginLimits()
+    plugin = make_plugin(timeout=0.05)
+    release = threading.Event()
+    done = threading.Event()
+    with pytest.raises(PluginTimeout):
+        limits.run(plugin, release.wait, on_done=done.set)
+    assert not done.is_set()
+    release.set()
+    assert done.wait(1)
+
+    busy = make_plugin(max_concurrency=1, on_busy='reject')
+    release.clear()
+    t = threading.Thread(target=limits.run, args=(busy, release.wait))
+    t.start()
+    time.sleep(0.05)
+    skipped = []
+    with pytest.raises(PluginBusy):
+        limits.run(busy, lambda: None, on_done=lambda: skipped.append(True))
+    assert skipped == [True]
+    release.set()
+    t.join()
@@ -25,3 +25,29 @@ def test_get_plugins_none_text():
     for func, args in p.get_plugins('respond_to', None):
         assert func is None
         assert args is None
+
+
+def test_get_plugins_preserves_registration_order():
+    p = PluginsManager()
+    first = lambda x: x
+    second = lambda x: x
+    catchall = lambda x: x
+    p.commands['listen_to'][re.compile(r'deploy (\w+)')] = first
+    p.commands['listen_to'][re.compile(r'^.*$')] = catchall
+    p.commands['listen_to'][re.compile(r'DEPLOY', re.IGNORECASE)] = second
+    try:
+        assert list(p.get_plugins('listen_to', 'deploy web')) == [
+            (first, ('web',)), (catchall, ()), (second, ())]
+        assert list(p.get_plugins('listen_to', 'hi')) == [(catchall, ())]
+    finally:
+        p.commands['listen_to'].clear()
+
+
+def test_get_plugins_with_plain_dict_commands(monkeypatch):
+    func = lambda x: x
+    monkeypatch.setattr(PluginsManager, 'commands', {
+        'respond_to': {re.compile(r'hello (\w+)'): func}})
+    p = PluginsManager()
+    assert list(p.get_plugins('respond_to', 'hello world')) == [
+        (func, ('world',))]
+    assert list(p.get_plugins('respond_to', 'bye')) == [(None, None)]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import re
+
+import pytest
+
+from slackbot.matcher import (AhoCorasick, LiteralScanner, PatternIndex,
+                              required_literals)
+
+
+def test_required_literals():
+    assert required_literals(re.compile(r'^reply_webapi$')) == {'reply_webapi'}
+    assert required_literals(re.compile(r'upload \<?(.*)\>?')) == {'upload '}
+    assert required_literals(re.compile(r'(foo|bar)baz?')) == {'foo', 'bar'}
+    assert required_literals(re.compile(r'HeLLo$', re.IGNORECASE)) == {'hello'}
+    assert required_literals(re.compile(u'你好')) == {u'你好'}
+    assert required_literals(re.compile(r'^.*$')) is None
+    assert required_literals(re.compile(r'x{0,3}')) is None
+    assert required_literals(re.compile(r'(foo|.*)')) is None
+
+
+def test_aho_corasick():
+    ac = AhoCorasick(['he', 'she', 'his', 'hers'])
+    assert ac.search('ushers') == {0, 1, 3}
+    assert ac.search('nothing') == set()
+
+
+def test_literal_scanner_finds_overlapping_words():
+    words = ['he', 'she', 'his', 'hers', 'h']
+    scanner = LiteralScanner(words)
+    for text in ['ushers', 'nothing', 'hishe', '', 'xhx']:
+        assert scanner.search(text) == AhoCorasick(words).search(text)
+    assert LiteralScanner(['a.b', 'c']).search('axb') == set()
+
+
+@pytest.mark.parametrize('min_patterns', [0, 100])
+def test_pattern_index_same_results_as_regex_scan(min_patterns):
+    patterns = [
+        re.compile(r'hello$', re.IGNORECASE),
+        re.compile(r'^.*$'),
+        re.compile(r'give me (.*)'),
+        re.compile(r'(cat|dog)s?'),
+        re.compile(r'stat (.*) (.*)', re.IGNORECASE),
+        re.compile(u'你好'),
+        re.compile(r'kelvin', re.IGNORECASE),
+    ]
+    index = PatternIndex(patterns, min_patterns=min_patterns)
+    texts = ['hello', 'HELLO', 'give me a dog', 'stat 1 2', 'STAT a b',
+             u'你好!', '', 'nothing here', u'Kelvin', 'cats and dogs']
+    for text in texts:
+        expected = [(p, p.search(text).groups()) for p in patterns
+                    if p.search(text)]
+        assert [(p, m.groups()) for p, m in index.search(text)] == expected
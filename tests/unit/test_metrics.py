@@ -0,0 +1,72 @@
+import urllib.request
+
+import pytest
+
+from slackbot import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_exposition(registry):
+    counter = metrics.Counter('events_total', 'Events', ['type'],
+                              registry=registry)
+    counter.inc('message')
+    counter.inc('message', amount=2)
+    counter.inc('user "change"')
+    histogram = metrics.Histogram('latency_seconds', 'Latency',
+                                  buckets=(0.1, 1), registry=registry)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    metrics.Callback('workers', 'Workers', lambda: 3, registry=registry)
+
+    assert registry.exposition() == '\n'.join([
+        '# HELP events_total Events',
+        '# TYPE events_total counter',
+        'events_total{type="message"} 3',
+        'events_total{type="user \\"change\\""} 1',
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        'latency_seconds_sum 5.55',
+        'latency_seconds_count 3',
+        '# HELP workers Workers',
+        '# TYPE workers gauge',
+        'workers 3',
+    ]) + '\n'
+
+
+def test_http_server(registry):
+    metrics.Counter('hits_total', 'Hits', registry=registry).inc()
+    server = metrics.start_http_server(0, registry=registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        body = urllib.request.urlopen(url).read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert 'hits_total 1' in body
+
+
+def test_webapi_calls_are_timed():
+    from slackbot.slackclient import (
+        _timed_api_call, WEBAPI_TIME, WEBAPI_ERRORS
+    )
+
+    def api_call(api_method, **kwargs):
+        if kwargs.get('fail'):
+            raise RuntimeError
+        return 'ok'
+
+    timed = _timed_api_call(api_call)
+    before = WEBAPI_TIME.count('test.method')
+    assert timed('test.method', json={}) == 'ok'
+    with pytest.raises(RuntimeError):
+        timed('test.method', fail=True)
+    assert WEBAPI_TIME.count('test.method') == before + 2
+    assert WEBAPI_ERRORS.value('test.method') >= 1
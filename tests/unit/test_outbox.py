@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from slackbot.outbox import Outbox
+from slackbot.ratelimit import RateLimiter
+
+
+@pytest.fixture
+def outbox():
+    outbox = Outbox(rate=20, coalesce=True, max_length=20).start()
+    yield outbox
+    outbox.stop(1)
+
+
+def test_outbox_paces_each_channel(outbox):
+    sent = []
+
+    def sender(channel):
+        return lambda text: sent.append((channel, text, time.monotonic()))
+
+    started = time.monotonic()
+    futures = [outbox.put(channel, sender(channel), str(i))
+               for i in range(3) for channel in ('C1', 'C2')]
+    for future in futures:
+        future.result(timeout=2)
+    for channel in ('C1', 'C2'):
+        times = [t for c, __, t in sent if c == channel]
+        assert [text for c, text, __ in sent if c == channel] == ['0', '1', '2']
+        # the first goes right away, the others at 20 per second
+        assert times[0] - started < 0.04
+        assert times[2] - times[0] >= 0.09
+    assert outbox.pending() == 0
+
+
+def test_outbox_coalesces_queued_messages(outbox):
+    sent = []
+    send = lambda text: sent.append(text) or len(sent)
+    first = outbox.put('C1', send, 'a', group='C1')
+    first.result(timeout=1)
+    # these queue up behind the rate limit
+    futures = [outbox.put('C1', send, text, group=group)
+               for text, group in [('b', 'C1'), ('c', 'C1'), ('x' * 19, 'C1'),
+                                   ('d', 'thread'), ('e', None), ('f', None)]]
+    results = [future.result(timeout=2) for future in futures]
+    assert sent == ['a', 'b\nc', 'x' * 19, 'd', 'e', 'f']
+    assert results == [2, 2, 3, 4, 5, 6]
+
+
+def test_outbox_reports_failures_and_cancellations(outbox):
+    sent = []
+
+    def send(text):
+        if text == 'boom':
+            raise ValueError(text)
+        sent.append(text)
+
+    outbox.put('C1', send, 'a').result(timeout=1)
+    failed = outbox.put('C1', send, 'boom')
+    cancelled = outbox.put('C1', send, 'b')
+    assert cancelled.cancel()
+    last = outbox.put('C1', send, 'c')
+    with pytest.raises(ValueError):
+        failed.result(timeout=1)
+    last.result(timeout=1)
+    assert sent == ['a', 'c']
+
+
+def test_outbox_sends_the_queue_before_stopping():
+    sent = []
+    outbox = Outbox(rate=100).start()
+    for i in range(5):
+        outbox.put('C1', sent.append, str(i))
+    outbox.stop(2)
+    assert sent == ['0', '1', '2', '3', '4']
+    with pytest.raises(RuntimeError):
+        outbox.put('C1', sent.append, '5')
+
+
+def test_outbox_slow_channel_doesnt_hold_up_the_others(outbox):
+    release = threading.Event()
+    slow = outbox.put('C1', lambda text: release.wait(2), 'slow')
+    sent = []
+    futures = [outbox.put('C2', sent.append, str(i)) for i in range(3)]
+    for future in futures:
+        future.result(timeout=1)
+    assert sent == ['0', '1', '2'] and not slow.done()
+    release.set()
+    slow.result(timeout=1)
+
+
+def test_outbox_shares_the_limiter_budget():
+    limiter = RateLimiter(channel_rates={'chat.postMessage': 10})
+    outbox = Outbox(rate=10, limiter=limiter).start()
+    waits = []
+
+    def send(text):
+        # what the paced Web API call does
+        waits.append(limiter.acquire('chat.postMessage', 'C1'))
+
+    try:
+        started = time.monotonic()
+        for future in [outbox.put('C1', send, str(i)) for i in range(3)]:
+            future.result(timeout=2)
+        # paced once, by the outbox, on the limiter's bucket
+        assert waits == [0, 0, 0]
+        assert time.monotonic() - started >= 0.15
+    finally:
+        outbox.stop(1)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+import pytest
+
+from slackbot import procpool
+
+CHANNEL = 'C0X4HEKPA'
+USER = 'U0X4QA7R7'
+
+
+class FakeClient:
+    login_data = {'self': {'id': 'U0X642GBF', 'name': 'testbot'}}
+    users = {USER: {'id': USER, 'name': 'user'}}
+    channels = {CHANNEL: {'id': CHANNEL, 'name': 'random'}}
+
+    def __init__(self):
+        self.calls = []
+
+    def rtm_send_message(self, *args, **kwargs):
+        self.calls.append(('rtm_send_message', args, kwargs))
+
+    def upload_file(self, *args, **kwargs):
+        self.calls.append(('upload_file', args, kwargs))
+
+    def find_user_by_name(self, username):
+        return None
+
+
+def cpu_plugin(message, n):
+    message.reply('pid {} sum {}'.format(os.getpid(), sum(range(int(n)))))
+    message.channel.upload_content('a.txt', 'content')
+
+
+def upload_plugin(message):
+    with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+        f.write(b'chart')
+        f.flush()
+        message.reply_upload_file('chart.txt', f.name)
+
+
+def failing_plugin(message):
+    message.send('working on it')
+    raise RuntimeError('boom')
+
+
+def run(func, *args):
+    client = FakeClient()
+    body = {'text': 'x', 'channel': CHANNEL, 'user': USER, 'ts': '1.0'}
+    result = procpool.submit(func, client, body, args).result(timeout=30)
+    return client, result
+
+
+def test_actions_are_recorded_in_the_child():
+    client, (actions, error) = run(cpu_plugin, '10')
+    assert error is None
+    method, args, kwargs = actions[0]
+    assert method == 'rtm_send_message'
+    assert args[0] == CHANNEL
+    assert args[1].startswith('<@{}>: pid '.format(USER))
+    assert args[1].endswith(' sum 45')
+    assert str(os.getpid()) not in args[1]
+    assert actions[1][0] == 'upload_content'
+
+
+def test_replay_uploads_file_content():
+    client, result = run(upload_plugin)
+    procpool.replay(client, result)
+    method, args, kwargs = client.calls[0]
+    assert method == 'upload_file'
+    assert args[:3] == (CHANNEL, 'chart.txt', b'chart')
+
+
+def test_replay_raises_plugin_errors_after_replaying():
+    client, result = run(failing_plugin)
+    with pytest.raises(procpool.ProcessPluginError) as e:
+        procpool.replay(client, result)
+    assert 'RuntimeError: boom' in str(e.value)
+    assert client.calls[0][1][:2] == (CHANNEL, 'working on it')
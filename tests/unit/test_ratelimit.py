@@ -0,0 +1,54 @@
+import time
+
+from slackbot.ratelimit import TokenBucket, method_rate
+
+
+def test_method_rate():
+    assert method_rate('users.list') == 20 / 60.0
+    assert method_rate('no.such_method') is None
+
+
+def test_token_bucket_allows_bursts_then_paces():
+    bucket = TokenBucket(rate=100, capacity=3)
+    assert [bucket.delay() for __ in range(3)] == [0, 0, 0]
+    assert 0.005 < bucket.delay() <= 0.01
+    assert 0.015 < bucket.delay() <= 0.02
+    started = time.monotonic()
+    assert bucket.acquire() > 0
+    assert time.monotonic() - started >= 0.02
+    assert bucket.tokens < 1
+
+
+def test_rate_limiter_budgets():
+    from slackbot.ratelimit import RateLimiter
+    limiter = RateLimiter(window=3)
+    # tier 3: 50 per minute, up to 3 seconds worth at once
+    assert limiter.remaining('reactions.add') == 2.5
+    assert [limiter.delay('reactions.add') for __ in range(2)] == [0, 0]
+    assert 0.5 < limiter.delay('reactions.add') <= 0.6
+    assert limiter.remaining('auth.test') is None
+    assert limiter.delay('auth.test') == 0
+    # chat.postMessage is limited in each channel
+    assert limiter.delay('chat.postMessage', 'C1') == 0
+    assert limiter.delay('chat.postMessage', 'C2') == 0
+    assert limiter.last_wait() == 0
+    assert 0.9 < limiter.delay('chat.postMessage', 'C1') <= 1
+    assert limiter.last_wait() > 0.9
+    assert sorted(map(str, limiter.budget())) == [
+        "('chat.postMessage', 'C1')", "('chat.postMessage', 'C2')",
+        'reactions.add']
+
+
+def test_rate_limiter_is_shared_across_threads():
+    import threading
+    from slackbot.ratelimit import RateLimiter
+    limiter = RateLimiter(channel_rates={'chat.postMessage': 50})
+    threads = [threading.Thread(target=limiter.acquire,
+                                args=('chat.postMessage', 'C1'))
+               for __ in range(6)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - started >= 0.09
@@ -0,0 +1,106 @@
+import time
+from datetime import datetime
+
+import pytest
+
+from slackbot.scheduler import (
+    CronSchedule, IntervalSchedule, Job, Scheduler
+)
+
+
+def ts(*args):
+    return datetime(*args).timestamp()
+
+
+def test_cron_schedule():
+    every_5 = CronSchedule('*/5 * * * *')
+    assert every_5.next_after(ts(2020, 1, 1, 10, 3, 30)) == ts(2020, 1, 1, 10, 5)
+    assert every_5.next_after(ts(2020, 1, 1, 10, 5)) == ts(2020, 1, 1, 10, 10)
+
+    workdays = CronSchedule('30 9 * * 1-5')
+    # 2020-01-03 is a friday
+    assert workdays.next_after(ts(2020, 1, 3, 10)) == ts(2020, 1, 6, 9, 30)
+
+    yearly = CronSchedule('0 0 1 1 *')
+    assert yearly.next_after(ts(2020, 6, 1)) == ts(2021, 1, 1)
+
+    # day of month or day of week, like cron
+    either = CronSchedule('0 12 13 * 5')
+    assert either.next_after(ts(2020, 1, 1)) == ts(2020, 1, 3, 12)
+    assert either.next_after(ts(2020, 1, 10, 13)) == ts(2020, 1, 13, 12)
+
+    sunday = CronSchedule('0 0 * * 7')
+    assert sunday.next_after(ts(2020, 1, 1)) == ts(2020, 1, 5)
+
+
+def test_cron_schedule_invalid():
+    for expr in ['* * * *', '60 * * * *', '0 0 31 2 *']:
+        with pytest.raises(ValueError):
+            CronSchedule(expr).next_after(time.time())
+
+
+def job(missed='run_once'):
+    def func(client):
+        pass
+    return Job(func, IntervalSchedule(10), missed=missed)
+
+
+def test_scheduler_fixed_rate_without_overlap():
+    submitted = []
+    scheduler = Scheduler(submitted.append)
+    j = job()
+    scheduler.add(j, now=100)
+    scheduler.run_pending(now=105)
+    assert submitted == []
+    scheduler.run_pending(now=110.5)
+    assert submitted == [j.func]
+    # still running at the next deadline: runs once right after
+    scheduler.run_pending(now=120.2)
+    scheduler.run_pending(now=130.2)
+    assert submitted == [j.func]
+    scheduler.job_done(j.func)
+    assert submitted == [j.func, j.func]
+    scheduler.job_done(j.func)
+    assert submitted == [j.func, j.func]
+    # deadlines stay on the original grid
+    scheduler.run_pending(now=140.1)
+    assert len(submitted) == 3
+
+
+@pytest.mark.parametrize('missed,runs', [
+    ('run_once', 1), ('skip', 0), ('catch_up', 4)])
+def test_scheduler_missed_runs(missed, runs):
+    submitted = []
+    scheduler = Scheduler(submitted.append)
+    j = job(missed)
+    scheduler.add(j, now=100)
+    # woke up long after 110, 120, 130 and 140
+    scheduler.run_pending(now=145)
+    for __ in range(5):
+        scheduler.job_done(j.func)
+    assert len(submitted) == runs
+
+
+@pytest.mark.parametrize('missed', ['run_once', 'skip'])
+def test_scheduler_jitter_isnt_a_missed_run(missed, caplog):
+    submitted = []
+    scheduler = Scheduler(submitted.append)
+    j = Job(job().func, IntervalSchedule(60), jitter=30, missed=missed)
+    scheduler.add(j, now=0)
+    for now in range(631):
+        scheduler.run_pending(now=now)
+        if j.running:
+            scheduler.job_done(j.func)
+    assert len(submitted) == 10
+    assert 'missed' not in caplog.text
+
+
+def test_scheduler_job_dropped_by_the_queue_runs_again():
+    submitted = []
+    scheduler = Scheduler(lambda func: submitted.append(func) or False)
+    j = job()
+    scheduler.add(j, now=0)
+    scheduler.run_pending(now=10)
+    assert not j.running
+    scheduler.run_pending(now=20)
+    assert len(submitted) == 2
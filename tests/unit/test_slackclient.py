@@ -1,6 +1,12 @@
+import time
+
 import pytest
+from slack_sdk.errors import SlackApiError
+from websocket import ABNF
 
 from slackbot.slackclient import SlackClient
+from tests import fakeslack
+from tests.fakeslack import FakeSlack
 from . import slackclient_data
 
 
@@ -85,3 +91,297 @@ def test_init_with_timeout():
     expected_timeout = 42  # seconds
     client = SlackClient(None, connect=False, timeout=expected_timeout)
     assert client.webapi.timeout == expected_timeout
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack(users=3, channels=2).start()
+    yield slack
+    slack.stop()
+
+
+def test_against_fake_slack(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url)
+    fake_slack.wait_connected()
+    assert client.username == fakeslack.BOT_NAME
+    assert len(client.users) == 4
+    assert client.find_channel_by_name('channel2') == 'C00000002'
+    assert client.dm_channels['U00000001'] == 'D00000001'
+
+    ts = fake_slack.post_message('C00000001', 'U00000001', 'hello')
+    deadline = time.time() + 5
+    events = []
+    while not events and time.time() < deadline:
+        events = [e for e in client.rtm_read() if e['type'] == 'message']
+    assert [(e['text'], e['ts']) for e in events] == [('hello', ts)]
+
+    client.rtm_send_message('channel1', 'hi')
+    client.send_message('C00000002', 'hi there')
+    sent = [fake_slack.bot_messages.get(timeout=5) for __ in range(2)]
+    assert sorted((m['via'], m['channel'], m['text']) for m in sent) == [
+        ('chat.postMessage', 'C00000002', 'hi there'),
+        ('rtm', 'C00000001', 'hi')]
+
+
+def test_fake_slack_rate_limits(fake_slack):
+    fake_slack.rate_limits = {'reactions.add': (1, 60)}
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         connect=False)
+    client.webapi.retry_handlers[:] = []
+    client.react_to_message('+1', 'C00000001', '1.000001')
+    with pytest.raises(SlackApiError) as e:
+        client.react_to_message('+1', 'C00000001', '1.000001')
+    assert e.value.response.status_code == 429
+    assert int(e.value.response.headers['Retry-After']) > 0
+    assert fake_slack.rate_limited['reactions.add'] == 1
+
+
+class FramesWebsocket(object):
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.reads = 0
+
+    def recv_data(self):
+        if not self.frames:
+            raise BlockingIOError(11, 'Resource temporarily unavailable')
+        self.reads += 1
+        return self.frames.pop(0)
+
+
+def test_rtm_read_decodes_frame_by_frame():
+    client = SlackClient(None, connect=False)
+    client.websocket = FramesWebsocket([
+        (ABNF.OPCODE_TEXT, b'{"type": "hello"}'),
+        (ABNF.OPCODE_PONG, b''),
+        (ABNF.OPCODE_TEXT, b'{"type": "message",\n "text": "a\\nb"}'),
+        (ABNF.OPCODE_TEXT, b'{"type": '),
+        (ABNF.OPCODE_TEXT, '{"type": "goodbye"}'),
+    ])
+    events = client.rtm_read()
+    assert next(events) == {'type': 'hello'}
+    assert client.websocket.reads == 1
+    assert list(events) == [{'type': 'message', 'text': 'a\nb'},
+                            {'type': 'goodbye'}]
+
+
+def test_rtm_read_caps_the_frames_per_read():
+    client = SlackClient(None, connect=False)
+    client.websocket = FramesWebsocket(
+        [(ABNF.OPCODE_TEXT, b'{"n": %d}' % i) for i in range(5)])
+    assert [e['n'] for e in client.rtm_read(max_frames=3)] == [0, 1, 2]
+    assert [e['n'] for e in client.rtm_read(max_frames=3)] == [3, 4]
+    assert list(client.rtm_read()) == []
+
+
+def test_find_channel_by_name_follows_user_renames(slack_client):
+    dm_id = slack_client.find_channel_by_name('user')
+    user_id = slack_client.find_user_by_name('user')
+    slack_client.parse_user_data([dict(slack_client.users[user_id],
+                                       name='renamed')])
+    assert slack_client.find_channel_by_name('user') is None
+    assert slack_client.find_channel_by_name('renamed') == dm_id
+    assert slack_client._channelify('renamed') == dm_id
+
+
+def test_directory_keeps_declared_fields(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         user_fields=['tz'])
+    user = client.get_user('U00000001')
+    assert 'tz' in client.users.fields and 'profile' not in dict(user)
+    assert user['profile']['email'] == 'user1@example.com'
+    assert fake_slack.calls['users.info'] == 1
+
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         user_fields='*')
+    assert client.get_user('U00000001')['profile']
+
+
+def test_directory_cache_warm_start(fake_slack, tmpdir):
+    path = str(tmpdir.join('directory.db'))
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_cache=path)
+    assert fake_slack.calls['users.list'] == 1
+    client.parse_user_data([dict(fake_slack.users[1], name='renamed')])
+    client.reconnect()
+    assert fake_slack.calls['users.list'] == 1
+
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_cache=path)
+    assert fake_slack.calls['users.list'] == 1
+    assert client.find_user_by_name('renamed') == 'U00000001'
+    assert client.find_channel_by_name('channel1') == 'C00000001'
+    assert client.dm_channels['U00000002'] == 'D00000002'
+
+    # a stale snapshot is used, then refreshed in the background
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_cache=path, directory_ttl=0)
+    assert client.find_user_by_name('renamed') == 'U00000001'
+    deadline = time.time() + 5
+    while client.find_user_by_name('user1') is None and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.find_user_by_name('user1') == 'U00000001'
+
+
+def test_directory_listings_are_fetched_concurrently():
+    slack = FakeSlack(users=2500, channels=500, latency=0.2).start()
+    try:
+        client = SlackClient(fakeslack.TOKEN, base_url=slack.api_url,
+                             connect=False)
+        client.login_data = {'team': {'id': 'T00000001'}}
+        started = time.time()
+        client.refresh_directory()
+        elapsed = time.time() - started
+    finally:
+        slack.stop()
+    timings = client.directory_timings
+    assert len(client.users) == 2501 and len(client.channels) == 3000
+    assert timings['users']['pages'] == 3
+    assert timings['channels']['pages'] == 3
+    # the sum of both listings would be 6 pages of 0.2s
+    assert elapsed < 1.0
+
+
+def test_lazy_directory_mode(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_mode='lazy')
+    assert fake_slack.calls['users.list'] == 0
+    assert fake_slack.calls['conversations.list'] == 0
+    assert len(client.users) == 0
+    assert client.users.get('U00000002')['name'] == 'user2'
+    assert client._channelify('C00000001') == 'C00000001'
+    assert client.find_channel_by_name('channel1') == 'C00000001'
+    assert fake_slack.calls['users.info'] == 1
+    assert fake_slack.calls['conversations.info'] == 1
+    # user ids aren't looked up as channels, nor unknown ids twice
+    for __ in range(3):
+        assert client._channelify('U00000002').startswith('D')
+        assert client.users.get('U00000404') is None
+    assert fake_slack.calls['conversations.info'] == 1
+    assert fake_slack.calls['users.info'] == 2
+
+
+def test_reconnect_keeps_the_directory(fake_slack, monkeypatch):
+    monkeypatch.setattr('slackbot.slackclient.backoff_delay', lambda n: 0)
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url)
+    fake_slack.wait_connected()
+    fake_slack.users.append({'id': 'U00000099', 'name': 'newcomer'})
+    fake_slack.disconnect()
+    deadline = time.time() + 5
+    while fake_slack.calls['rtm.connect'] < 2 and time.time() < deadline:
+        list(client.rtm_read())
+        time.sleep(0.01)
+    fake_slack.wait_connected()
+    assert fake_slack.calls['rtm.connect'] == 2
+    assert fake_slack.calls['users.list'] == 1
+    assert fake_slack.calls['conversations.list'] == 1
+    assert client.circuit.state == 'closed'
+    # someone who joined while the bot was away is only fetched when asked
+    # for explicitly
+    assert 'U00000099' not in client.users
+    assert client.users.get('U00000099') is None
+    assert 'C00000099' not in client.channels
+    assert fake_slack.calls['users.info'] == 0
+    assert fake_slack.calls['conversations.info'] == 0
+    assert client.get_user('U00000099')['name'] == 'newcomer'
+    assert client.find_user_by_name('newcomer') == 'U00000099'
+    assert fake_slack.calls['users.info'] == 1
+
+
+def test_send_queue(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         send_queue=True, send_coalesce=True)
+    fake_slack.wait_connected()
+    assert client.send_message('C00000001', 'line 0').result(timeout=5)['ok']
+    # these wait for the next second
+    futures = [client.send_message('C00000001', 'line %d' % i)
+               for i in range(1, 5)]
+    responses = [future.result(timeout=5) for future in futures]
+    assert len(set(response['ts'] for response in responses)) == 1
+    sent = [fake_slack.bot_messages.get(timeout=5)['text'] for __ in range(2)]
+    assert sent == ['line 0', 'line 1\nline 2\nline 3\nline 4']
+    assert fake_slack.calls['chat.postMessage'] == 2
+    client.outbox.stop(1)
+
+
+def test_web_api_calls_are_paced(fake_slack):
+    # the fake measures the window from when the requests arrive, allow for
+    # their latency
+    fake_slack.rate_limits = dict(fakeslack.SLACK_RATE_LIMITS,
+                                  **{'chat.postMessage': (1, 0.9)})
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url)
+    client.webapi.retry_handlers[:] = []
+    started = time.time()
+    for i in range(3):
+        client.send_message('C00000001', str(i))
+    client.send_message('C00000002', 'elsewhere')
+    # no 429, 1 message per second in each channel
+    assert 2 <= time.time() - started < 3
+    assert fake_slack.rate_limited['chat.postMessage'] == 0
+    assert client.rate_limiter.remaining('chat.postMessage', 'C00000001') < 1
+
+
+def test_dm_channels_are_opened_once(fake_slack, monkeypatch):
+    import threading
+    monkeypatch.setattr('slackbot.slackclient.backoff_delay', lambda n: 0)
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url)
+    assert client.open_dm_channel('U00000001') == 'D00000001'
+    assert fake_slack.calls['conversations.open'] == 0
+
+    fake_slack.users.append({'id': 'U00000099', 'name': 'newcomer'})
+    fake_slack.latency = 0.1
+    opened = []
+    threads = [threading.Thread(
+        target=lambda: opened.append(client.open_dm_channel('U00000099')))
+        for __ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert opened == ['D00000099'] * 5
+    assert fake_slack.calls['conversations.open'] == 1
+
+    fake_slack.latency = 0
+    client.reconnect()
+    assert client.get_dm_channel('U00000099') == 'D00000099'
+    assert client._channelify('newcomer') == 'D00000099'
+    assert fake_slack.calls['conversations.open'] == 1
+
+
+def test_get_dm_channel_errors(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url)
+    with pytest.raises(ValueError):
+        client.get_dm_channel('U12345678')
+
+
+def test_find_channel_in_lazy_mode(fake_slack):
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_mode='lazy')
+    assert client.find_channel_by_name('channel2') is None
+    assert client.find_channel('C00000002') == 'C00000002'
+    assert fake_slack.calls['conversations.list'] == 0
+    assert client.find_channel('channel1') == 'C00000001'
+    assert fake_slack.calls['conversations.list'] == 1
+    # remembered
+    assert client.find_channel_by_name('channel1') == 'C00000001'
+    assert client.find_channel('user2').startswith('D')
+    assert client.find_channel('nowhere') is None
+
+
+def test_errors_to_in_lazy_mode(fake_slack):
+    from slackbot.dispatcher import MessageDispatcher
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         directory_mode='lazy')
+    for errors_to in ['channel2', 'C00000002']:
+        dispatcher = MessageDispatcher(client, None, errors_to)
+        assert dispatcher._errors_to == 'C00000002'
+
+
+def test_circuit_state_is_reported_per_workspace(fake_slack):
+    from slackbot.slackclient import CIRCUIT_STATE
+    clients = [SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                           workspace=name) for name in ('ws0', 'ws1')]
+    for __ in range(clients[0].circuit.failure_threshold):
+        clients[0].circuit.failure()
+    samples = CIRCUIT_STATE.samples()
+    assert 'slackbot_rtm_circuit_state{workspace="ws0"} 2' in samples
+    assert 'slackbot_rtm_circuit_state{workspace="ws1"} 0' in samples
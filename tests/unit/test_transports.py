@@ -0,0 +1,173 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from slackbot.dispatcher import Message, MessageDispatcher
+from slackbot.slackclient import SlackClient
+from slackbot.transports import EventsAPITransport, SocketModeTransport
+from tests import fakeslack
+from tests.fakeslack import FakeSlack
+
+
+@pytest.fixture
+def fake_slack():
+    slack = FakeSlack(users=3, channels=2).start()
+    yield slack
+    slack.stop()
+
+
+def collect(transport):
+    events = queue.Queue()
+    transport.start(events.put)
+    return events
+
+
+def drain(events, count):
+    return [events.get(timeout=5) for __ in range(count)]
+
+
+def test_socket_mode_spreads_and_acknowledges_events(fake_slack):
+    transport = SocketModeTransport(fakeslack.APP_TOKEN, connections=3,
+                                    base_url=fake_slack.api_url)
+    events = collect(transport)
+    try:
+        fake_slack.wait_connected(count=3)
+        for i in range(6):
+            fake_slack.post_message('C00000001', 'U00000001', str(i))
+        assert sorted(e['text'] for e in drain(events, 6)) == list('012345')
+        deadline = time.time() + 5
+        while fake_slack.unacked and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(fake_slack.acks) == 6
+        assert fake_slack.calls['apps.connections.open'] == 3
+    finally:
+        transport.stop()
+
+
+def test_socket_mode_ignores_redeliveries_and_reconnects(fake_slack,
+                                                         monkeypatch):
+    monkeypatch.setattr('slackbot.transports.backoff_delay', lambda n: 0)
+    transport = SocketModeTransport(fakeslack.APP_TOKEN, connections=2,
+                                    base_url=fake_slack.api_url)
+    # keep the envelopes unacknowledged
+    monkeypatch.setattr(fake_slack, 'unacked', _Unforgetful())
+    events = collect(transport)
+    try:
+        fake_slack.wait_connected(count=2)
+        fake_slack.post_message('C00000001', 'U00000001', 'once')
+        assert drain(events, 1)[0]['text'] == 'once'
+        fake_slack.redeliver()
+        with pytest.raises(queue.Empty):
+            events.get(timeout=0.2)
+
+        fake_slack.disconnect()
+        fake_slack.wait_connected(count=2)
+        fake_slack.post_message('C00000001', 'U00000001', 'again')
+        assert drain(events, 1)[0]['text'] == 'again'
+        assert fake_slack.calls['apps.connections.open'] == 4
+    finally:
+        transport.stop()
+
+
+def test_socket_mode_skips_malformed_frames(fake_slack):
+    transport = SocketModeTransport(fakeslack.APP_TOKEN, connections=1,
+                                    base_url=fake_slack.api_url)
+    events = collect(transport)
+    try:
+        fake_slack.wait_connected()
+        fake_slack._connections[0].send('{"type": "events_a')
+        fake_slack.post_message('C00000001', 'U00000001', 'after')
+        assert drain(events, 1)[0]['text'] == 'after'
+        assert fake_slack.calls['apps.connections.open'] == 1
+    finally:
+        transport.stop()
+
+
+class _Unforgetful(dict):
+    def pop(self, key, default=None):
+        return self.get(key, default)
+
+
+@pytest.fixture
+def events_api(fake_slack):
+    transport = EventsAPITransport(fakeslack.SIGNING_SECRET, port=0)
+    events = collect(transport)
+    fake_slack.events_url = 'http://{}:{}/slack/events'.format(
+        *transport.address)
+    yield fake_slack, events
+    transport.stop()
+
+
+def test_events_api_receives_signed_events(events_api):
+    slack, events = events_api
+    status, body = slack.post_event_callback(None, payload={
+        'type': 'url_verification', 'challenge': 'abc'})
+    assert (status, body) == (200, b'{"challenge": "abc"}')
+
+    slack.post_message('C00000001', 'U00000001', 'hello')
+    assert drain(events, 1)[0]['text'] == 'hello'
+
+    event = {'type': 'message', 'channel': 'C00000001', 'user': 'U00000001',
+             'text': 'retried', 'ts': slack.next_ts()}
+    payload = slack._event_callback(event)
+    assert slack.post_event_callback(None, payload=payload)[0] == 200
+    assert slack.post_event_callback(None, payload=payload,
+                                     retry_num=1)[0] == 200
+    assert [e['text'] for e in drain(events, 1)] == ['retried']
+    with pytest.raises(queue.Empty):
+        events.get(timeout=0.2)
+
+
+def test_events_api_rejects_unsigned_requests(events_api):
+    slack, events = events_api
+    event = {'type': 'message', 'channel': 'C00000001', 'text': 'forged'}
+    assert slack.post_event_callback(event, signing_secret='guess')[0] == 401
+    assert slack.post_event_callback(
+        event, timestamp=time.time() - 600)[0] == 401
+    assert events.empty()
+
+
+def test_events_api_needs_a_signing_secret():
+    transport = EventsAPITransport(None, port=0)
+    with pytest.raises(ValueError):
+        transport.start(lambda event: None)
+    transport = EventsAPITransport(None, port=0, insecure=True)
+    transport.start(lambda event: None)
+    transport.stop()
+
+
+def test_dispatching_socket_mode_events(fake_slack, monkeypatch):
+    monkeypatch.setattr('slackbot.settings.DEFAULT_REPLY', 'sorry')
+
+    class Plugins(object):
+        def get_plugins(self, category, text):
+            if category == 'respond_to':
+                yield (lambda message: message.reply('pong ' + text)), ()
+
+        def get_run_at_times_plugins(self):
+            return []
+
+    client = SlackClient(fakeslack.TOKEN, base_url=fake_slack.api_url,
+                         connect=False)
+    client.web_connect()
+    assert client.username == fakeslack.BOT_NAME
+    assert client.domain == 'fake'
+    assert client.find_channel_by_name('channel2') == 'C00000002'
+    dispatcher = MessageDispatcher(client, Plugins(), None)
+    dispatcher.start()
+    transport = SocketModeTransport(fakeslack.APP_TOKEN,
+                                    base_url=fake_slack.api_url)
+    threading.Thread(target=dispatcher.transport_loop, args=(transport,),
+                     daemon=True).start()
+    try:
+        fake_slack.wait_connected(count=2)
+        fake_slack.post_message('C00000001', 'U00000001',
+                                '<@{}> ping'.format(fakeslack.BOT_ID))
+        reply = fake_slack.bot_messages.get(timeout=5)
+        assert (reply['via'], reply['channel'], reply['text']) == (
+            'chat.postMessage', 'C00000001', '<@U00000001>: pong ping')
+        assert fake_slack.calls['rtm.connect'] == 0
+    finally:
+        transport.stop()
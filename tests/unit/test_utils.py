@@ -9,3 +9,211 @@ def test_get_http_proxy():
 
     environ = {'no_proxy': '*.slack.com'}
     assert get_http_proxy(environ) == (None, None, '*.slack.com')
+
+
+def test_sharded_worker_pool_keeps_per_key_order():
+    import threading
+    import time
+    from slackbot.utils import ShardedWorkerPool
+
+    handled = []
+    done = threading.Event()
+    total = 200
+
+    def work(msg):
+        key, seq = msg
+        if key == 'busy':
+            time.sleep(0.001)
+        handled.append(msg)
+        if len(handled) == total:
+            done.set()
+
+    pool = ShardedWorkerPool(work, nworker=4, key=lambda msg: msg[0])
+    keys = ['busy', 'C1', 'C2', 'C3', 'C4']
+    for seq in range(total // len(keys)):
+        for key in keys:
+            pool.add_task((key, seq))
+    assert sum(pool.shard_depths()) == total
+    pool.start()
+    assert done.wait(10)
+    for key in keys:
+        assert [seq for k, seq in handled if k == key] == list(
+            range(total // len(keys)))
+    assert pool.qsize() == 0
+
+
+LANES = ('respond_to', 'direct', 'call_func', 'listen_to')
+
+
+def make_lane_queue(**kwargs):
+    from slackbot.utils import LaneQueue
+    return LaneQueue(LANES, lambda item: item[0], **kwargs)
+
+
+def test_lane_queue_serves_lanes_by_priority():
+    q = make_lane_queue()
+    for item in [('listen_to', 1), ('respond_to', 2), ('listen_to', 3),
+                 ('direct', 4), ('call_func', 5)]:
+        q.put(item)
+    assert [q.get()[1] for __ in range(5)] == [2, 4, 5, 1, 3]
+
+
+def test_lane_queue_drop_oldest():
+    q = make_lane_queue(maxsize=2, overflow='drop_oldest')
+    assert q.put(('respond_to', 1))
+    assert q.put(('listen_to', 2))
+    assert q.put(('listen_to', 3))
+    assert q.shed == {'respond_to': 1, 'direct': 0, 'call_func': 0,
+                      'listen_to': 0}
+    assert [q.get()[1] for __ in range(2)] == [2, 3]
+
+
+def test_lane_queue_drop_listen_to():
+    q = make_lane_queue(maxsize=2, overflow='drop_listen_to')
+    q.put(('listen_to', 1))
+    q.put(('respond_to', 2))
+    assert q.put(('respond_to', 3))
+    assert q.lane_sizes()['listen_to'] == 0
+    # never drop a respond_to for a listen_to
+    assert not q.put(('listen_to', 4))
+    assert q.shed['listen_to'] == 2
+    assert [q.get()[1] for __ in range(2)] == [2, 3]
+
+
+def test_lane_queue_block():
+    import threading
+    q = make_lane_queue(maxsize=1, overflow='block')
+    q.put(('listen_to', 1))
+    t = threading.Thread(target=q.put, args=(('listen_to', 2),))
+    t.start()
+    t.join(0.05)
+    assert t.is_alive()
+    assert q.get() == ('listen_to', 1)
+    t.join(1)
+    assert q.get() == ('listen_to', 2)
+
+
+def test_worker_pool_autoscaling():
+    import threading
+    import time
+    from slackbot.utils import WorkerPool
+
+    done = threading.Semaphore(0)
+
+    def work(msg):
+        time.sleep(0.02)
+        done.release()
+
+    pool = WorkerPool(work, nworker=1, max_worker=4, idle_timeout=0.1,
+                      scale_wait=0.01)
+    pool.start()
+    for i in range(20):
+        pool.add_task(i)
+    for i in range(20):
+        assert done.acquire(timeout=5)
+    assert pool.stats()['latency'] > 0
+    assert 1 < pool.size <= 4
+
+    deadline = time.time() + 5
+    while pool.size > 1 and time.time() < deadline:
+        time.sleep(0.05)
+    assert pool.size == 1
+
+
+def test_worker_pool_grows_while_all_workers_are_stuck():
+    import threading
+    import time
+    from slackbot.utils import WorkerPool
+
+    release = threading.Event()
+    pool = WorkerPool(lambda msg: release.wait(5), nworker=2, max_worker=4,
+                      scale_wait=0.05)
+    pool.start()
+    try:
+        for i in range(6):
+            pool.add_task(i)
+        deadline = time.time() + 2
+        while pool.size < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert pool.size == 4
+    finally:
+        release.set()
+
+
+def test_single_flight_shares_errors():
+    import pytest
+    from slackbot.utils import SingleFlight
+    flights = SingleFlight()
+    with pytest.raises(ValueError):
+        flights.do('k', lambda: int('x'))
+    assert flights.do('k', lambda: 1) == 1
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    from slackbot.utils import backoff_delay
+    delays = [backoff_delay(3) for __ in range(100)]
+    assert all(0 <= d <= 8 for d in delays)
+    assert len(set(delays)) > 1
+    assert backoff_delay(50, cap=120) <= 120
+
+
+def test_circuit_breaker():
+    import time
+    from slackbot.utils import CircuitBreaker
+    states = []
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05,
+                             on_change=states.append)
+    breaker.failure()
+    assert breaker.state == 'closed'
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert 0 < breaker.retry_in() <= 0.05
+    time.sleep(0.06)
+    assert breaker.state == 'half_open'
+    assert breaker.retry_in() == 0
+    # a failed trial opens it again right away
+    breaker.failure()
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    breaker.success()
+    assert breaker.state == 'closed'
+    assert states == ['open', 'half_open', 'open', 'closed']
+
+
+def test_fair_queue_serves_keys_in_turn():
+    from slackbot.utils import FairQueue
+    q = FairQueue(lambda item: item[0], lanes=('high', 'low'),
+                  lane_of=lambda item: item[1])
+    for i in range(3):
+        q.put(('busy', 'low', i))
+    q.put(('quiet', 'low', 0))
+    q.put(('busy', 'high', 3))
+    assert q.key_sizes() == {'busy': 4, 'quiet': 1}
+    assert [q.get() for __ in range(5)] == [
+        ('busy', 'high', 3), ('quiet', 'low', 0), ('busy', 'low', 0),
+        ('busy', 'low', 1), ('busy', 'low', 2)]
+    assert q.qsize() == 0
+
+
+def test_fair_worker_pool_runs_the_clients_tasks():
+    import threading
+    from slackbot.utils import FairWorkerPool
+    done = []
+    finished = threading.Semaphore(0)
+    pool = FairWorkerPool(nworker=1, max_worker=1)
+
+    def record(name):
+        def func(msg):
+            done.append((name, msg))
+            finished.release()
+        return func
+    a = pool.client('a', record('a'))
+    b = pool.client('b', record('b'))
+    for i in range(3):
+        a.add_task(i)
+    b.add_task(0)
+    a.start()
+    b.start()
+    for __ in range(4):
+        assert finished.acquire(timeout=5)
+    assert done == [('a', 0), ('b', 0), ('a', 1), ('a', 2)]